@@ -0,0 +1,218 @@
+"""Micro-benchmarks of the hot paths of the rating models
+
+Usage: python benchmark.py lstm [--batch_sizes 8 32 128] [--seq_lens 10 30 60]
+       python benchmark.py batching [--num_items 763] [--seq_len 30] [--vec_dim 1024]
+
+Both take --store=DATA_PATH/cache/HASH (or its embs.npy), an LSTM store of
+the embedding cache, to time real inputs instead of random ones: its width,
+SEQ_LEN and length distribution (from len.npy). Add --layer for a store
+written with CACHE_ALL_LAYERS.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
+
+from net import BiLSTM, BiLSTMAttn
+from utils import BucketedBatches, RowSubset, to_float_tensor
+
+
+def timeit(fn, repeat):
+    """Return the median wall time of `fn()` in milliseconds"""
+    fn()  # warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def load_store(path, layer=None):
+    """Memory-map an LSTM store of the embedding cache (a cache directory or its embs.npy)
+
+    Return:
+    X -- (items, SEQ_LEN, dim) embeddings, layer `layer` of an all-layers store
+    L -- number of tokens of each item, at least 1 and at most SEQ_LEN
+    """
+    embs_path = os.path.join(path, 'embs.npy') if os.path.isdir(path) else path
+    X = np.load(embs_path, mmap_mode='r')
+    if X.ndim == 4:
+        if layer is None:
+            raise SystemExit(f'{embs_path} holds every layer, choose one with --layer.')
+        X = X[layer]
+    if X.ndim != 3:
+        raise SystemExit(f'{embs_path} holds averaged embeddings, the benchmarks need an LSTM store.')
+    L = np.load(os.path.join(os.path.dirname(embs_path), 'len.npy'))
+    return X, np.clip(L, 1, X.shape[1])
+
+
+def masked_last_state(net, pack, batch_size, seq_lens, h0, c0):
+    """The dense-mask reduction BiLSTM.forward used to pick the last states"""
+    x, _ = net.lstm(pack, (h0, c0))
+    x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True)
+    x = x.permute(0, 2, 1)
+    mask = torch.zeros(x.size())
+    for i in range(batch_size):
+        mask[i, :net.hidden_dim, seq_lens[i]-1] = 1
+        mask[i, net.hidden_dim:, 0] = 1
+    return (x * mask).sum(dim=2)
+
+
+def h_n_last_state(net, pack, h0, c0):
+    _, (h_n, _) = net.lstm(pack, (h0, c0))
+    return torch.cat((h_n[-2], h_n[-1]), dim=1)
+
+
+def lstm_batches(args, rng):
+    """Yield the (x, seq_lens) batches to time: random ones for every --seq_lens and
+    --batch_sizes, or with --store, batches of --batch_sizes random items of the store"""
+    if args.store is None:
+        for seq_len in args.seq_lens:
+            for batch_size in args.batch_sizes:
+                seq_lens = sorted(rng.randint(1, seq_len + 1, batch_size), reverse=True)
+                seq_lens[0] = seq_len
+                yield torch.randn(batch_size, seq_len, args.vec_dim), seq_lens
+        return
+    X, L = load_store(args.store, args.layer)
+    for batch_size in args.batch_sizes:
+        rows = rng.choice(len(X), min(batch_size, len(X)), replace=False)
+        rows = rows[np.argsort(-L[rows], kind='stable')]
+        seq_lens = L[rows].tolist()
+        # chopped to the longest item, as BucketedBatches does
+        yield to_float_tensor(X[rows][:, :seq_lens[0]]), seq_lens
+
+
+def bench_lstm(args):
+    """Compare the old mask-based and the h_n last-state selection of BiLSTM"""
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    if args.store is None:
+        vec_dim, max_seq_len = args.vec_dim, max(args.seq_lens)
+    else:
+        X, _ = load_store(args.store, args.layer)
+        _, max_seq_len, vec_dim = X.shape
+        print(f'{len(X)} items of {args.store}, SEQ_LEN {max_seq_len}, dim {vec_dim}')
+    net = BiLSTM(vec_dim, max_seq_len, args.hidden_dim, args.num_layers,
+                 0.0, None, True, False)
+    net.eval()
+    print(f'{"batch":>6}{"seq_len":>8}{"mask ms":>10}{"h_n ms":>10}{"speedup":>9}{"max diff":>10}')
+    with torch.no_grad():
+        for x, seq_lens in lstm_batches(args, rng):
+            batch_size, seq_len = len(seq_lens), seq_lens[0]
+            pack = pack_padded_sequence(x, seq_lens, batch_first=True)
+            h0 = torch.randn(args.num_layers*2, batch_size, args.hidden_dim)
+            c0 = torch.randn(args.num_layers*2, batch_size, args.hidden_dim)
+            old = masked_last_state(net, pack, batch_size, seq_lens, h0, c0)
+            new = h_n_last_state(net, pack, h0, c0)
+            diff = (old - new).abs().max().item()
+            t_old = timeit(lambda: masked_last_state(net, pack, batch_size, seq_lens, h0, c0),
+                           args.repeat)
+            t_new = timeit(lambda: h_n_last_state(net, pack, h0, c0), args.repeat)
+            print(f'{batch_size:>6}{seq_len:>8}{t_old:>10.3f}{t_new:>10.3f}'
+                  f'{t_old / t_new:>8.2f}x{diff:>10.1e}')
+
+
+def per_batch_sorted(X, y, L, batch_size):
+    """The batching RatingModel.train used to do: sort and gather batch by batch"""
+    from torch.utils.data.sampler import BatchSampler, RandomSampler
+    for inds in BatchSampler(RandomSampler(X), batch_size=batch_size, drop_last=False):
+        y_batch = y[inds]
+        seq_lengths = [L[ii] for ii in inds]
+        sort_idx = sorted(range(len(seq_lengths)), key=lambda k: seq_lengths[k], reverse=True)
+        seq_lengths.sort(reverse=True)
+        X_batch = to_float_tensor(X[np.array(inds)[sort_idx]])
+        y_batch = torch.from_numpy(y_batch[sort_idx]).float()
+        yield inds, X_batch, y_batch, seq_lengths
+
+
+def bench_batching(args):
+    """Time one training epoch over a memory-mapped cache, per-batch sorting vs BucketedBatches"""
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.store is None:
+            num_items = args.num_items or 763
+            X = np.lib.format.open_memmap(os.path.join(tmp, 'embs.npy'), mode='w+', dtype=np.float32,
+                                          shape=(num_items, args.seq_len, args.vec_dim))
+            for start in range(0, num_items, 256):
+                X[start:start + 256] = rng.randn(*X[start:start + 256].shape)
+            X.flush()
+            X = np.load(os.path.join(tmp, 'embs.npy'), mmap_mode='r')
+            y = rng.rand(num_items, 1)
+            L = rng.randint(1, args.seq_len + 1, num_items)
+        else:
+            X, L = load_store(args.store, args.layer)
+            print(f'{len(X)} items of {args.store}, SEQ_LEN {X.shape[1]}, dim {X.shape[2]}, {X.dtype}, '
+                  f'mean length {L.mean():.1f}')
+            if args.num_items and args.num_items < len(X):
+                # a random sample of the store, like one split
+                rows = np.sort(rng.choice(len(X), args.num_items, replace=False))
+                X, L = RowSubset(X, rows), L[rows]
+            y = rng.rand(len(L), 1)
+        _, seq_len, vec_dim = X.shape
+
+        net = BiLSTMAttn(vec_dim, seq_len, args.hidden_dim, args.num_layers,
+                         0.2, None, True, False)
+        optimizer = torch.optim.Adam(net.parameters())
+        loss_func = nn.MSELoss()
+
+        def epoch(batches, model):
+            for inds, X_batch, y_batch, seq_lengths in batches:
+                if not model:
+                    continue
+                pack = pack_padded_sequence(X_batch, seq_lengths, batch_first=True)
+                output_scores, _ = net(pack, len(seq_lengths), seq_lengths)
+                optimizer.zero_grad()
+                loss_func(output_scores, y_batch).backward()
+                optimizer.step()
+
+        print(f'{"batching":>26}{"data ms":>10}{"epoch ms":>10}')
+        runs = [('per-batch sort', lambda: per_batch_sorted(X, y, L, args.batch_size))]
+        for bucket_batches in args.bucket_batches:
+            runs.append((f'BucketedBatches({bucket_batches})',
+                         lambda b=bucket_batches: BucketedBatches(X, y, L, args.batch_size,
+                                                                  bucket_batches=b)))
+        for name, batches in runs:
+            t_data = timeit(lambda: epoch(batches(), False), args.repeat)
+            t_epoch = timeit(lambda: epoch(batches(), True), max(1, args.repeat // 5))
+            print(f'{name:>26}{t_data:>10.1f}{t_epoch:>10.1f}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+    lstm = subparsers.add_parser('lstm', help=bench_lstm.__doc__)
+    lstm.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32, 128])
+    lstm.add_argument('--seq_lens', type=int, nargs='+', default=[10, 30, 60])
+    lstm.add_argument('--vec_dim', type=int, default=300)
+    lstm.add_argument('--hidden_dim', type=int, default=300)
+    lstm.add_argument('--num_layers', type=int, default=1)
+    lstm.add_argument('--repeat', type=int, default=20)
+    lstm.add_argument('--store', default=None, help='time batches of this LSTM store of the embedding cache')
+    lstm.add_argument('--layer', type=int, default=None, help='layer of an all-layers --store')
+    lstm.set_defaults(func=bench_lstm)
+    batching = subparsers.add_parser('batching', help=bench_batching.__doc__)
+    batching.add_argument('--num_items', type=int, default=None,
+                          help='default: 763 random items, or every item of --store')
+    batching.add_argument('--batch_size', type=int, default=32)
+    batching.add_argument('--bucket_batches', type=int, nargs='+', default=[1, 8])
+    batching.add_argument('--seq_len', type=int, default=30)
+    batching.add_argument('--vec_dim', type=int, default=1024)
+    batching.add_argument('--hidden_dim', type=int, default=512)
+    batching.add_argument('--num_layers', type=int, default=2)
+    batching.add_argument('--repeat', type=int, default=10)
+    batching.add_argument('--store', default=None, help='time epochs over this LSTM store of the embedding cache')
+    batching.add_argument('--layer', type=int, default=None, help='layer of an all-layers --store')
+    batching.set_defaults(func=bench_batching)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
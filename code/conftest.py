@@ -0,0 +1,23 @@
+"""Fixtures shared by the tests"""
+import pytest
+import torch
+
+WORDS = "some of the cats were chasing a mouse i think it is good dogs and you know uh yeah people".split()
+
+
+@pytest.fixture
+def tiny_bert(tmp_path, monkeypatch):
+    """Serve a small BERT for every `from_pretrained`"""
+    transformers = pytest.importorskip('transformers')
+    vocab_file = tmp_path / 'vocab.txt'
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", "'"] + WORDS) + "\n")
+    torch.manual_seed(0)
+    tokenizer = transformers.BertTokenizer(str(vocab_file))
+    # the rating model expects the hidden size of BERT base
+    config = transformers.BertConfig(vocab_size=len(tokenizer.vocab), hidden_size=768, num_hidden_layers=2,
+                                     num_attention_heads=2, intermediate_size=32, output_hidden_states=True)
+    model = transformers.BertModel(config)
+    model.eval()
+    monkeypatch.setattr(transformers.BertTokenizer, 'from_pretrained', classmethod(lambda cls, *a, **k: tokenizer))
+    monkeypatch.setattr(transformers.BertModel, 'from_pretrained', classmethod(lambda cls, *a, **k: model))
+    return tokenizer, model
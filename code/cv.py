@@ -0,0 +1,128 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+
+from models import RatingModel
+from utils import RowSubset
+
+
+class FoldFilter(logging.Filter):
+    """Tag the log records of a worker with the fold it is training"""
+    fold = '-'
+
+    def filter(self, record):
+        record.fold = self.fold
+        return True
+
+
+_FOLD_FILTER = FoldFilter()
+
+
+def init_fold_worker(num_threads, log_file):
+    """Set up a worker process: limit its threads and log to the run's log file"""
+    torch.set_num_threads(num_threads)
+    formatter = logging.Formatter('%(levelname)s:%(name)s:[fold %(fold)s] %(message)s')
+    handlers = [logging.StreamHandler()]
+    if log_file is not None:
+        handlers.append(logging.FileHandler(log_file))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.addFilter(_FOLD_FILTER)
+        root.addHandler(handler)
+
+
+def train_fold(cfg, fold, store, train_idx, val_idx, labels, sen_len, save_path, tag=None):
+    """Train one cross-validation fold
+
+    Positional arguments:
+    cfg -- configuration dictionary
+    fold -- fold number, starting at 1
+    store -- (path to the memory-mapped embedding store, layer to slice or
+             None, rows of the examples), see `open_store`
+    train_idx, val_idx -- indices of the training/validation examples
+    labels -- normalized labels of all examples
+    sen_len -- lengths of all examples
+    save_path -- where the folds save their checkpoints
+
+    Keyword arguments:
+    tag -- how log lines refer to this job, the fold number by default
+
+    Return:
+    fold, and the train loss, validation loss and validation r of every epoch
+    """
+    _FOLD_FILTER.fold = fold if tag is None else tag
+    logging.info(f'Fold #{fold}\n- - - - - - - - - - - - -')
+    # every fold has its own seed, so results do not depend on how folds are scheduled
+    torch.manual_seed(cfg.SEED * cfg.KFOLDS + fold)
+    word_embs_np = open_store(*store)
+    X = {"train": RowSubset(word_embs_np, train_idx), "val": RowSubset(word_embs_np, val_idx)}
+    y = {"train": labels[train_idx], "val": labels[val_idx]}
+    L = {"train": sen_len[train_idx].tolist(), "val": sen_len[val_idx].tolist()}
+    cfg.BATCH_ITEM_NUM = len(train_idx)//cfg.TRAIN.BATCH_SIZE
+    r_model = RatingModel(cfg, os.path.join(save_path, format(fold)))
+    r_model.train(X, y, L)
+    return (fold, np.array(r_model.train_loss_history), np.array(r_model.val_loss_history),
+            np.array(r_model.val_r_history))
+
+
+def open_store(embs_path, layer, rows):
+    """Memory-map the embedding store and view the rows of one run"""
+    all_embs = np.load(embs_path, mmap_mode='r')
+    if layer is not None:
+        all_embs = all_embs[layer]
+    return RowSubset(all_embs, rows)
+
+
+def run_folds(cfg, folds, store, labels, sen_len, save_path, log_file=None):
+    """Train all cross-validation folds, `cfg.CV_WORKERS` of them at a time
+
+    Workers are spawned processes that memory-map the embedding store
+    themselves, so only file paths and indices are sent to them. Each uses
+    `cfg.CV_THREADS` torch threads (0: the cores split evenly).
+
+    Return:
+    train loss, validation loss and validation r, (epochs, folds) each
+    """
+    folds = list(folds)
+    train_loss_history = np.zeros((cfg.TRAIN.TOTAL_EPOCH, len(folds)))
+    val_loss_history = np.zeros((cfg.TRAIN.TOTAL_EPOCH, len(folds)))
+    val_r_history = np.zeros((cfg.TRAIN.TOTAL_EPOCH, len(folds)))
+    jobs = [(cfg, fold, store, train_idx, val_idx, labels, sen_len, save_path)
+            for fold, (train_idx, val_idx) in enumerate(folds, 1)]
+
+    results = run_jobs(jobs, cfg.CV_WORKERS, cfg.CV_THREADS, log_file)
+    for fold, train_loss, val_loss, val_r in results:
+        train_loss_history[:, fold-1] = train_loss
+        val_loss_history[:, fold-1] = val_loss
+        val_r_history[:, fold-1] = val_r
+    return train_loss_history, val_loss_history, val_r_history
+
+
+def run_jobs(jobs, num_workers, num_threads=0, log_file=None):
+    """Run `train_fold` on every tuple of arguments in `jobs`
+
+    With more than one worker, the jobs are spread over a pool of spawned
+    processes using `num_threads` torch threads each (0: the cores split
+    evenly).
+
+    Return:
+    the results of `train_fold`, in the order of `jobs`
+    """
+    num_workers = min(num_workers, len(jobs))
+    if num_workers <= 1:
+        return [train_fold(*job) for job in jobs]
+    num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_workers)
+    logging.info(f'Running {len(jobs)} training jobs in {num_workers} processes, '
+                 f'{num_threads} threads each.')
+    with concurrent.futures.ProcessPoolExecutor(num_workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=init_fold_worker,
+                                                initargs=(num_threads, log_file)) as pool:
+        futures = [pool.submit(train_fold, *job) for job in jobs]
+        return [future.result() for future in futures]
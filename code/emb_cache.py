@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from utils import mkdir_p, save_manifest, load_manifest
+
+
+def content_hash(obj):
+    """Return the sha1 hex digest of the JSON encoding of `obj`"""
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache(object):
+    """Content-addressed, item-indexed store of sentence/word embeddings
+
+    Every configuration that changes the embeddings (encoder, layer, SEQ_LEN,
+    contextual flags, preprocessing version, dtype) gets its own directory,
+    named after the hash of `key_fields` and described by `manifest.json`.
+    Inside, `embs.npy` and `len.npy` hold one row per item, and `index.json`
+    lists the [item ID, text hash] pair of every row. Any seed, split or
+    PREDON set is assembled by gathering its rows, and only items that are not
+    stored yet (or whose text changed) are encoded and appended.
+
+    Appending rewrites the store, so only one process should extend a given
+    store at a time. The new store is filled on disk, and `journal.json`
+    (the items being appended) with `journal_progress.json` (how many are
+    written) let an interrupted extension resume where it stopped.
+    """
+
+    def __init__(self, root, key_fields):
+        """Positional arguments:
+        root -- directory that holds all caches
+        key_fields -- dict() describing how the embeddings are computed
+        """
+        self.key_fields = key_fields
+        self.cache_dir = os.path.join(root, content_hash(key_fields)[:16])
+        self.manifest_path = os.path.join(self.cache_dir, 'manifest.json')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        self.embs_path = os.path.join(self.cache_dir, 'embs.npy')
+        self.len_path = os.path.join(self.cache_dir, 'len.npy')
+        self.journal_path = os.path.join(self.cache_dir, 'journal.json')
+        self.progress_path = os.path.join(self.cache_dir, 'journal_progress.json')
+        self.index = []
+        if os.path.isfile(self.index_path) and os.path.isfile(self.embs_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+
+    def lookup(self, items):
+        """Return the row of each item, None for items that are not stored
+
+        items -- list of [item ID, text hash] pairs
+        """
+        rows = {tuple(it): row for row, it in enumerate(self.index)}
+        return [rows.get(tuple(it)) for it in items]
+
+    def has(self, items):
+        return None not in self.lookup(items)
+
+    def extend(self, new_items, row_shape=None, dtype=np.float32, item_axis=0):
+        """Allocate a store with room for the rows of `new_items` after the stored ones
+
+        The new store is written in place on disk. `save_progress` journals
+        how many new rows are written, and an interrupted extension with the
+        same items and layout is resumed instead of allocated again.
+
+        Keyword arguments:
+        row_shape -- shape of the entry of one item; taken from the current
+                     store if None
+        item_axis -- axis of the store that indexes items
+
+        Return:
+        out -- memory-mapped array, stored rows already copied in; the new
+               items go to rows len(self.index), len(self.index)+1, ...
+        lens -- memory-mapped lengths of all rows, filled in for the stored ones
+        new_items -- `new_items`, in the order of their rows
+        done -- number of new items whose rows are already written
+        """
+        num_old = len(self.index)
+        old = np.load(self.embs_path, mmap_mode='r') if num_old else None
+        if row_shape is None:
+            row_shape = old.shape[:item_axis] + old.shape[item_axis+1:]
+        shape = tuple(row_shape[:item_axis]) + (num_old + len(new_items),) + tuple(row_shape[item_axis:])
+        journal = {'num_old': num_old, 'shape': list(shape), 'dtype': np.dtype(dtype).str,
+                   'row_shape': list(row_shape), 'item_axis': item_axis,
+                   'items': [list(it) for it in new_items]}
+        resumed = self.resume(journal)
+        if resumed is not None:
+            return resumed
+        mkdir_p(self.cache_dir)
+        out = np.lib.format.open_memmap(self.embs_path + '.tmp', mode='w+',
+                                        dtype=dtype, shape=shape)
+        lens = np.lib.format.open_memmap(self.len_path + '.tmp', mode='w+',
+                                         dtype=np.int64, shape=(shape[item_axis],))
+        if num_old:
+            lead = (slice(None),) * item_axis
+            for start in range(0, num_old, 256):
+                end = min(start + 256, num_old)
+                out[lead + (slice(start, end),)] = old[lead + (slice(start, end),)]
+            lens[:num_old] = np.load(self.len_path)
+        # the journal is only valid once the stored rows are copied
+        self.save_progress(out, lens, 0)
+        save_manifest(self.journal_path, journal)
+        return out, lens, list(new_items), 0
+
+    def resume(self, journal):
+        """Reopen the store of an interrupted `extend` with the same items (in any
+        order) and layout as `journal`, return None if there is none"""
+        if not (os.path.isfile(self.journal_path) and os.path.isfile(self.progress_path)):
+            return None
+        old_journal = load_manifest(self.journal_path)
+        if any(old_journal.get(k) != journal[k] for k in ('num_old', 'shape', 'dtype', 'row_shape', 'item_axis')) \
+                or sorted(old_journal['items']) != sorted(journal['items']):
+            logging.info(f'Discarding the interrupted extension of {self.cache_dir}, it holds other items.')
+            return None
+        done = load_manifest(self.progress_path)['done']
+        # the journal has to describe the files it comes with
+        try:
+            out = np.load(self.embs_path + '.tmp', mmap_mode='r+')
+            lens = np.load(self.len_path + '.tmp', mmap_mode='r+')
+        except (OSError, ValueError):
+            out = lens = None
+        shape = tuple(journal['shape'])
+        if (out is None or out.shape != shape or out.dtype != np.dtype(journal['dtype'])
+                or lens.shape != (shape[journal['item_axis']],) or not 0 <= done <= len(journal['items'])):
+            logging.info(f'Discarding the interrupted extension of {self.cache_dir}, '
+                         f'its files do not match the journal.')
+            return None
+        logging.info(f'Resuming the extension of {self.cache_dir} after {done} items.')
+        return out, lens, old_journal['items'], done
+
+    def save_progress(self, out, lens, done):
+        """Record that the rows of the first `done` new items are written"""
+        out.flush()
+        lens.flush()
+        save_manifest(self.progress_path, {'done': done})
+
+    def commit(self, new_items, out, lens):
+        """Replace the store by the one allocated with `extend`"""
+        out.flush()
+        lens.flush()
+        os.replace(self.embs_path + '.tmp', self.embs_path)
+        os.replace(self.len_path + '.tmp', self.len_path)
+        self.index = self.index + [list(it) for it in new_items]
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        os.remove(self.journal_path)
+        os.remove(self.progress_path)
+        if not os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'w') as f:
+                json.dump(self.key_fields, f, indent=1)
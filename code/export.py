@@ -0,0 +1,253 @@
+"""Export a trained checkpoint as a TorchScript inference artifact
+
+Usage: python ./code/export.py --conf=CONF.yml --epoch=N [--quantize]
+
+The checkpoint {OUT_PATH}{EXPERIMENT_NAME}/Model/RNet_epoch_N.pth is turned
+into {OUT_PATH}{EXPERIMENT_NAME}/Export/RNet_epoch_N[_int8].pt, a scripted
+module mapping (embeddings, lengths) to normalized scores:
+- the BatchNorm layers of RateNet are folded into the preceding Linear layers
+  and the dropout layers are dropped,
+- the LSTM starts from its zero or learned initial state (zeros replace a
+  random one, cfg.LSTM.INIT_STATE), so its predictions are deterministic,
+- with --quantize, the LSTM and Linear layers are dynamically quantized to int8.
+The configuration needed to use it (SEQ_LEN, MIN_VALUE, MAX_VALUE, ...) is
+stored in the artifact as `config.json`. The exported and the eager model are
+then timed on the cfg.PREDON split.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+import run
+from run import cfg
+from cv import open_store
+from models import RatingModel
+from utils import mkdir_p, to_float_tensor
+
+# the configuration fields a consumer of the artifact needs
+EXPORT_FIELDS = ['MIN_VALUE', 'MAX_VALUE', 'SINGLE_SENTENCE', 'IS_ELMO', 'IS_BERT', 'ELMO_LAYER',
+                 'ELMO_MODE', 'BERT_LAYER', 'BERT_LARGE', 'GLOVE_DIM', 'PREDICTION_TYPE']
+
+
+def fold_batchnorm(linear, bn):
+    """Return a Linear layer computing bn(linear(x)) with the running statistics of `bn`"""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    folded = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight * scale[:, None])
+        bias = linear.bias if linear.bias is not None else torch.zeros_like(bn.running_mean)
+        folded.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return folded
+
+
+class InferenceRateNet(nn.Module):
+    """RateNet for inference: Linear+BatchNorm folded, no dropout"""
+
+    def __init__(self, net):
+        super(InferenceRateNet, self).__init__()
+        self.fc1 = fold_batchnorm(net.fc1[0], net.fc1[1])
+        self.fc2 = fold_batchnorm(net.fc2[0], net.fc2[1])
+        self.get_score = net.get_score
+
+    def forward(self, x, lengths):
+        """
+
+        x - Tensor shape (batch_size, emb_dim)
+        lengths - unused, for the signature of InferenceLSTM
+
+        output - Tensor shape (batch_size,)
+        """
+        h = torch.relu(self.fc1(x))
+        h = torch.relu(self.fc2(h))
+        return self.get_score(h)[:, 0]
+
+
+class InferenceLSTM(nn.Module):
+    """BiLSTM/BiLSTMAttn for inference: zero or learned initial state, unsorted batches"""
+    __constants__ = ['bidirect', 'has_attn', 'learned_state']
+
+    def __init__(self, net):
+        super(InferenceLSTM, self).__init__()
+        self.lstm = net.lstm
+        self.bidirect = net.bidirect
+        self.learned_state = net.init_state.mode == 'learned'
+        if self.learned_state:
+            self.h0 = net.init_state.h0
+            self.c0 = net.init_state.c0
+        self.has_attn = hasattr(net, 'attention')
+        if self.has_attn:
+            self.attention = net.attention
+        self.get_score = net.get_score
+
+    def forward(self, x, lengths):
+        """
+
+        x - Tensor shape (batch_size, seq_len, vec_dim), padded
+        lengths - int64 Tensor shape (batch_size,), in any order
+
+        output - Tensor shape (batch_size,)
+        """
+        pack = pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        if self.learned_state:
+            # the state of every example sits at its position in `lengths`
+            hx = (self.h0.expand(-1, x.shape[0], -1), self.c0.expand(-1, x.shape[0], -1))
+            packed_out, (h_n, _) = self.lstm(pack, hx)
+        else:
+            # without an initial state, the LSTM starts from zeros
+            packed_out, (h_n, _) = self.lstm(pack)
+        if self.has_attn:
+            out, _ = pad_packed_sequence(packed_out, batch_first=True, total_length=x.shape[1])
+            feats, _ = self.attention(out, lengths)
+        elif self.bidirect:
+            feats = torch.cat((h_n[-2], h_n[-1]), dim=1)
+        else:
+            feats = h_n[-1]
+        return self.get_score(feats)[:, 0]
+
+
+def inference_module(net, lstm_flag):
+    module = InferenceLSTM(net) if lstm_flag else InferenceRateNet(net)
+    return module.eval()
+
+
+def export(net, path, quantize=False):
+    """Script the inference version of `net` and save it to `path`
+
+    Return:
+    the scripted module
+    """
+    module = inference_module(net, cfg.LSTM.FLAG)
+    if quantize:
+        module = torch.ao.quantization.quantize_dynamic(module, {nn.LSTM, nn.Linear},
+                                                        dtype=torch.qint8)
+    scripted = torch.jit.script(module)
+    config = {k: cfg[k] for k in EXPORT_FIELDS}
+    config['LSTM'] = dict(cfg.LSTM)
+    config['QUANTIZED'] = quantize
+    torch.jit.save(scripted, path, _extra_files={'config.json': json.dumps(config)})
+    logging.info(f'Save inference model to {path}')
+    return scripted
+
+
+def predict(score_fn, X, sl, batch_size):
+    """Score all examples in batches of `batch_size`, in item order
+
+    Positional arguments:
+    score_fn -- maps (float tensor, lengths sorted in decreasing order) to scores
+    X -- vector representations for all examples
+    sl -- length of the sequence of every example
+    """
+    preds = np.zeros(X.shape[0])
+    with torch.no_grad():
+        for count in range(0, X.shape[0], batch_size):
+            sort_idx = np.argsort(-sl[count:count + batch_size], kind='stable')
+            rows = count + sort_idx
+            seq_lengths = sl[rows].tolist()
+            X_batch = X[rows]
+            if cfg.LSTM.FLAG:
+                X_batch = X_batch[:, :seq_lengths[0], :]
+            preds[rows] = score_fn(to_float_tensor(X_batch), seq_lengths).numpy()
+    return preds
+
+
+def benchmark(name, score_fn, X, sl, batch_size, repeat):
+    """Time `predict` over all examples, return the predictions and log latency/throughput"""
+    preds = predict(score_fn, X, sl, batch_size)  # warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predict(score_fn, X, sl, batch_size)
+        times.append(time.perf_counter() - start)
+    total = float(np.median(times))
+    num_batches = -(-X.shape[0] // batch_size)
+    logging.info(f'{name:>10} batch {batch_size:>4}: {1000 * total / num_batches:8.3f} ms/batch, '
+                 f'{X.shape[0] / total:10.1f} items/sec')
+    return preds, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a checkpoint for inference')
+    parser.add_argument('--conf', dest='config_file', default='unspecified')
+    parser.add_argument('--epoch', dest='epoch', type=int, default=None,
+                        help='epoch of the checkpoint, default: cfg.EVAL.BEST_EPOCH')
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None,
+                        help='path of the checkpoint, default: {OUT_PATH}{EXPERIMENT_NAME}/Model/RNet_epoch_N.pth')
+    parser.add_argument('--quantize', dest='quantize', action='store_true',
+                        help='dynamically quantize the LSTM/Linear layers to int8')
+    parser.add_argument('--out', dest='out', default=None, help='path of the artifact')
+    parser.add_argument('--out_path', dest='out_path', default=None)
+    parser.add_argument('--data_path', dest='data_path', default='./datasets')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5)
+    parser.add_argument('--no_benchmark', dest='benchmark', action='store_false')
+    opt = parser.parse_args()
+
+    if opt.config_file != "unspecified":
+        run.cfg_setup(opt.config_file)
+    if opt.out_path is not None:
+        cfg.OUT_PATH = opt.out_path
+    cfg.TRAIN.FLAG = False
+    cfg.CUDA = False
+    logging.basicConfig(level=logging.INFO)
+    torch.manual_seed(cfg.SEED)
+
+    epoch = cfg.EVAL.BEST_EPOCH if opt.epoch is None else opt.epoch
+    exp_path = cfg.OUT_PATH + cfg.EXPERIMENT_NAME
+    cfg.RESUME_DIR = opt.checkpoint or os.path.join(exp_path, "Model", f"RNet_epoch_{epoch}.pth")
+    out = opt.out
+    if out is None:
+        mkdir_p(os.path.join(exp_path, "Export"))
+        suffix = "_int8" if opt.quantize else ""
+        out = os.path.join(exp_path, "Export", f"RNet_epoch_{epoch}{suffix}.pt")
+
+    eager = RatingModel(cfg, exp_path)
+    eager.load_network()
+    eager.RNet.eval()
+    exported = export(eager.RNet, out, opt.quantize)
+    if not opt.benchmark:
+        return
+
+    labels, sen_len, store = run.load_split(cfg.PREDON, opt.data_path)
+    X = open_store(*store)
+    max_diff = cfg.MAX_VALUE - cfg.MIN_VALUE
+    logging.info(f'Benchmarking on {len(labels)} {cfg.PREDON} items, '
+                 f'{torch.get_num_threads()} threads')
+
+    def eager_fn(X_batch, seq_lengths):
+        if cfg.LSTM.FLAG:
+            pack = pack_padded_sequence(X_batch, seq_lengths, batch_first=True)
+            return eager.RNet(pack, len(seq_lengths), seq_lengths)[0][:, 0]
+        return eager.RNet(X_batch)[0][:, 0]
+
+    def exported_fn(X_batch, seq_lengths):
+        return exported(X_batch, torch.tensor(seq_lengths, dtype=torch.int64))
+
+    # the eager network, from a zero state when it draws random ones
+    random_state = cfg.LSTM.FLAG and cfg.LSTM.INIT_STATE == 'random'
+    reference = inference_module(eager.RNet, cfg.LSTM.FLAG)
+
+    def reference_fn(X_batch, seq_lengths):
+        if random_state:
+            return reference(X_batch, torch.tensor(seq_lengths, dtype=torch.int64))
+        return eager_fn(X_batch, seq_lengths)
+
+    for batch_size in sorted({1, cfg.TRAIN.BATCH_SIZE}):
+        eager_preds, t_eager = benchmark('eager', eager_fn, X, sen_len, batch_size, opt.repeat)
+        preds, t_exported = benchmark('exported', exported_fn, X, sen_len, batch_size, opt.repeat)
+        logging.info(f'batch {batch_size}: {t_eager / t_exported:.2f}x speedup')
+    # how far folding, scripting and quantization moved the predictions, on the rating scale
+    reference_preds = predict(reference_fn, X, sen_len, cfg.TRAIN.BATCH_SIZE)
+    logging.info(f'max |exported - eager| = {np.abs(preds - reference_preds).max() * max_diff:.2e}'
+                 f'{" (zero initial state)" if random_state else ""}')
+    logging.info(f'r: eager {np.corrcoef(eager_preds, labels)[0, 1]:.4f}, '
+                 f'exported {np.corrcoef(preds, labels)[0, 1]:.4f}')
+
+
+if __name__ == "__main__":
+    main()
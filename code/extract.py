@@ -0,0 +1,204 @@
+"""Staged extraction of ELMo/BERT embeddings into the (memory-mapped) cache
+
+The items go through the stages in chunks of a few encoder batches:
+tokenization, in a pool of cfg.EMBED_WORKERS processes (or a thread with
+0), the encoder forward passes, and a writer that pads the outputs and
+copies them into their rows of the preallocated output. The stages run
+concurrently and are connected by bounded queues, and the throughput of
+every stage is logged at the end, so the bottleneck is visible.
+
+The cfg of `run` is passed in rather than imported: `python code/run.py`
+runs as `__main__`, and importing `run` here would load a second copy with
+the default settings.
+"""
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import time
+
+from easydict import EasyDict as edict
+import torch
+from tqdm import tqdm
+
+from models import iter_bert_batches, iter_elmo_raw_batches, elmo_outputs, scatter_batch
+from token_cache import TokenCache
+from utils import pipeline, StageStats
+
+# part of the cache key of ELMo/BERT stores; bump when stores written by earlier
+# extractions must not be reused (2: `python code/run.py` extracted with the default cfg)
+EXTRACT_VERSION = 2
+
+# encoder batches per chunk: enough to sort by length, few enough to keep the queues small
+CHUNK_BATCHES = 8
+
+# cfg and tokenizer of a tokenization worker
+_CFG = None
+_ENCODER = None
+
+
+def max_seq_len(cfg, single_sentence):
+    """Number of tokens kept per item"""
+    # BERT with context keeps the first 30 tokens of a 30+120 token window
+    return cfg.LSTM.SEQ_LEN if single_sentence or not cfg.IS_BERT else 30
+
+
+def tokenize_items(cfg, item_texts, single_sentence, encoder, progress=True):
+    """Tokenize items for the ELMo/BERT encoder of cfg (GloVe takes the texts)
+
+    Positional arguments: the cfg of `run`, the rest see `run.encode_items`;
+    only `encoder.bert_tokenizer` is used
+    """
+    if cfg.IS_BERT:
+        from models import bert_inputs, bert_context_inputs
+        max_context_utterances = cfg.MAX_CONTEXT_UTTERANCES if cfg.MAX_CONTEXT_UTTERANCES > -1 else None
+        bert_items = []
+        for texts in tqdm(item_texts, total=len(item_texts), disable=not progress or len(item_texts) < 100):
+            if single_sentence:
+                bert_items.append(bert_inputs(texts[0], encoder.bert_tokenizer))
+            else:
+                bert_items.append(bert_context_inputs(texts[0],
+                                                      texts[1],
+                                                      encoder.bert_tokenizer,
+                                                      max_sentence_len=30,
+                                                      max_context_len=120,
+                                                      max_context_utterances=max_context_utterances))
+        return bert_items
+    elif cfg.IS_ELMO:
+        from models import elmo_inputs
+        return [elmo_inputs(texts[0], None if single_sentence else texts[1], LSTM=cfg.LSTM.FLAG)
+                for texts in item_texts]
+    if single_sentence:
+        # only including the target utterance
+        return [texts[0] for texts in item_texts]
+    # discourse context + target utterance
+    return [texts[1] + texts[0] for texts in item_texts]
+
+
+def init_tokenize_worker(worker_cfg, encoder):
+    """Set up a tokenization process with the cfg and tokenizer of the parent"""
+    global _CFG, _ENCODER
+    torch.set_num_threads(1)
+    _CFG = worker_cfg
+    _ENCODER = encoder
+
+
+def tokenize_chunk(positions, item_texts, single_sentence, cfg=None, encoder=None):
+    """Tokenize a chunk, with the cfg and tokenizer of the worker unless they are given
+
+    Return: positions, inputs (see `tokenize_items`), entries the chunk
+    added to the `TokenCache` of the encoder, seconds it took
+    """
+    start = time.perf_counter()
+    cfg = _CFG if cfg is None else cfg
+    encoder = _ENCODER if encoder is None else encoder
+    token_cache = encoder.get('bert_tokenizer')
+    if not isinstance(token_cache, TokenCache):
+        token_cache = None
+    num_entries = len(token_cache.entries) if token_cache else 0
+    inputs = tokenize_items(cfg, item_texts, single_sentence, encoder, progress=False)
+    new_entries = token_cache.new_entries(num_entries) if token_cache else []
+    return positions, inputs, new_entries, time.perf_counter() - start
+
+
+def bounded_map(pool, fn, chunks, ahead):
+    """`fn(*chunk)` of every chunk in `pool`, in order, with at most `ahead` chunks submitted in advance"""
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.submit(fn, *chunk))
+        if len(pending) > ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def extract_embeddings(cfg, item_texts, single_sentence, encoder, out, out_idx, all_layers=False, on_chunk=None):
+    """Encode items with the ELMo/BERT encoder of cfg into the rows `out_idx` of `out`
+
+    Positional arguments: the cfg of `run`, the rest see `run.encode_items`
+
+    Keyword arguments:
+    on_chunk -- called with (positions, sen_len) once the items at `positions`
+                (a range, chunks come in order) are written
+
+    Return:
+    out -- with the embeddings of the items written into it
+    sen_len -- number of tokens of each item
+    """
+    is_bert = cfg.IS_BERT
+    num_items = len(item_texts)
+    sen_len = [0] * num_items
+    chunk_size = cfg.EMBED_BATCH_SIZE * CHUNK_BATCHES
+    chunks = ((range(start, min(start + chunk_size, num_items)), item_texts[start:start + chunk_size],
+               single_sentence) for start in range(0, num_items, chunk_size))
+    tokenize_stats = StageStats('tokenize', workers=max(1, cfg.EMBED_WORKERS))
+
+    def encode(chunk):
+        positions, inputs = chunk
+        if is_bert:
+            batches = iter_bert_batches(inputs,
+                                        encoder.bert_model,
+                                        layer=None if all_layers else cfg.BERT_LAYER,
+                                        GPU=cfg.CUDA,
+                                        LSTM=cfg.LSTM.FLAG,
+                                        max_seq_len=max_seq_len(cfg, single_sentence),
+                                        batch_size=cfg.EMBED_BATCH_SIZE)
+        else:
+            # ELMo, the averaging/padding is left to the writer
+            batches = iter_elmo_raw_batches(inputs, encoder.elmo, batch_size=cfg.EMBED_BATCH_SIZE)
+        return positions, list(batches)
+
+    def write(chunk):
+        positions, batches = chunk
+        for batch in batches:
+            if is_bert:
+                idx, batch_embs, sl = batch
+            else:
+                idx, raw_embs = batch
+                batch_embs, sl = elmo_outputs(raw_embs,
+                                              layer=None if all_layers else cfg.ELMO_LAYER,
+                                              not_contextual=single_sentence,
+                                              LSTM=cfg.LSTM.FLAG,
+                                              seq_len=cfg.LSTM.SEQ_LEN)
+            scatter_batch(out, [out_idx[positions[k]] for k in idx], batch_embs, all_layers=all_layers)
+            for k, l in zip(idx, sl):
+                sen_len[positions[k]] = l
+        return (positions,)
+
+    def tokenized(results):
+        for positions, inputs, new_entries, seconds in results:
+            tokenize_stats.add(len(positions), seconds)
+            if new_entries:
+                # tokenizations of the workers go to the cache of this process
+                encoder.bert_tokenizer.update(new_entries)
+            yield positions, inputs
+
+    # the tokenization workers only need the tokenizer
+    token_encoder = edict(bert_tokenizer=encoder.bert_tokenizer) if is_bert else edict()
+    pool = None
+    if cfg.EMBED_WORKERS > 0:
+        pool = concurrent.futures.ProcessPoolExecutor(cfg.EMBED_WORKERS,
+                                                      mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=init_tokenize_worker,
+                                                      initargs=(cfg, token_encoder))
+        results = bounded_map(pool, tokenize_chunk, chunks, ahead=2 * cfg.EMBED_WORKERS)
+    else:
+        results = (tokenize_chunk(*chunk, cfg=cfg, encoder=token_encoder) for chunk in chunks)
+
+    start_t = time.time()
+    stats = [tokenize_stats]
+    try:
+        with tqdm(total=num_items) as progress:
+            for (positions,) in pipeline(tokenized(results), [('encode', encode), ('write', write)],
+                                         stats=stats):
+                progress.update(len(positions))
+                if on_chunk is not None:
+                    on_chunk(positions, sen_len)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    elapsed = time.time() - start_t
+    for stage_stats in stats:
+        logging.info(f'Stage {stage_stats}')
+    logging.info(f'Extracted {num_items} items in {elapsed:.2f}sec, {num_items / elapsed:.1f} items/sec')
+    return out, sen_len
@@ -0,0 +1,76 @@
+"""Load test for the prediction service of serve.py
+
+Usage: python ./code/loadtest.py [--url=http://127.0.0.1:8000/predict] [--concurrency=8] [--requests=200]
+                                 [--sentences=./datasets/qualitative.txt] [--batch=1]
+
+Sends --requests requests of --batch sentences each from --concurrency
+clients, and reports latency percentiles and throughput.
+"""
+import argparse
+import concurrent.futures
+import json
+import time
+import urllib.request
+
+import numpy as np
+
+SENTENCES = ["I ate some of the cookies.",
+             "Some of the students passed the exam.",
+             "We talked to some people about it, yeah.",
+             "Some kids like to play outside when it is warm."]
+
+
+def post(url, body):
+    """Send one request, return its latency in seconds"""
+    data = json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        json.loads(response.read())
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the prediction service')
+    parser.add_argument('--url', dest='url', default='http://127.0.0.1:8000/predict')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=8)
+    parser.add_argument('--requests', dest='requests', type=int, default=200)
+    parser.add_argument('--batch', dest='batch', type=int, default=1, help='sentences per request')
+    parser.add_argument('--sentences', dest='sentences', default=None,
+                        help='file with one sentence per line, default: a few examples')
+    opt = parser.parse_args()
+
+    sentences = SENTENCES
+    if opt.sentences is not None:
+        with open(opt.sentences, 'r') as f:
+            sentences = [line.strip() for line in f if line.strip()]
+    bodies = []
+    for i in range(opt.requests):
+        batch = [sentences[(i * opt.batch + j) % len(sentences)] for j in range(opt.batch)]
+        bodies.append({'sentence': batch[0]} if opt.batch == 1 else
+                      {'items': [{'sentence': s} for s in batch]})
+
+    post(opt.url, bodies[0])  # warm-up
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(opt.concurrency) as pool:
+        for future in concurrent.futures.as_completed([pool.submit(post, opt.url, b) for b in bodies]):
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors += 1
+                print(f'Request failed: {e}')
+    elapsed = time.perf_counter() - start
+
+    latencies = 1000 * np.array(latencies)
+    print(f'{len(latencies)} requests ({opt.batch} sentences each, {errors} errors) '
+          f'from {opt.concurrency} clients in {elapsed:.2f}sec')
+    if len(latencies):
+        print(f'latency p50 {np.percentile(latencies, 50):.1f} ms, p99 {np.percentile(latencies, 99):.1f} ms, '
+              f'max {latencies.max():.1f} ms')
+    print(f'{len(latencies) / elapsed:.1f} requests/sec, {len(latencies) * opt.batch / elapsed:.1f} sentences/sec')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from itertools import combinations
 import logging
 import os
@@ -6,21 +7,18 @@ import ssl
 import sys
 import time
 
-from allennlp.commands.elmo import ElmoEmbedder
 from easydict import EasyDict as edict
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.optim as optim
-import torchtext.vocab as vocab
-from torch.utils.data.sampler import SequentialSampler, BatchSampler, RandomSampler
 from torch.nn.utils import clip_grad_value_
 from torch.nn.utils.rnn import pack_padded_sequence
 
-from utils import mkdir_p, weights_init, save_model
+from token_cache import TokenCache, bert_text
+from utils import mkdir_p, weights_init, save_model, to_float_tensor, lengths_tensor, BucketedBatches, \
+    save_manifest
 ssl._create_default_https_context = ssl._create_unverified_context
 
 
@@ -35,7 +33,8 @@ BERT_DIM = 768
 BERT_LARGE_DIM = 1024
 GLOVE_DIM = 100
 ELMO_DIM = 1024
-glove = vocab.GloVe(name='6B', dim=GLOVE_DIM)
+# bump whenever preprocess_utterance/tokenization changes, invalidates cached embeddings
+PREPROCESS_VERSION = 1
 
 torch.manual_seed(1)
 
@@ -43,6 +42,8 @@ _UNK = torch.randn(GLOVE_DIM,)
 _PAD = torch.randn(GLOVE_DIM,)
 _BOS = torch.randn(GLOVE_DIM,)
 _EOS = torch.randn(GLOVE_DIM,)
+_GLOVE = None
+_GLOVE_MATRIX = None
 
 
 def build_state_dict(config_net):
@@ -60,6 +61,7 @@ class RatingModel(object):
         output_dir -- path to save checkpoints and logs
         """
         self.cfg = cfg
+        self.output_dir = output_dir
         if self.cfg.TRAIN.FLAG:
             self.model_dir = os.path.join(output_dir, 'Model')
             self.best_model_dir = os.path.join(output_dir, 'Best Model')
@@ -74,6 +76,8 @@ class RatingModel(object):
         self.dropout = [self.cfg.TRAIN.DROPOUT.FC_1, self.cfg.TRAIN.DROPOUT.FC_2]
         self.drop_prob = self.cfg.LSTM.DROP_PROB
         self.interval = self.cfg.TRAIN.INTERVAL
+        # epochs saved to 'Model' besides every `interval`-th one
+        self.save_epochs = set()
         self.loss_func = nn.MSELoss()
 
         self.train_loss_history = []
@@ -83,6 +87,9 @@ class RatingModel(object):
         self.best_val_loss = float("inf")
         self.best_val_r = 0.
         self.best_val_epoch = 0
+        # per-epoch metrics and the best TRAIN.BEST_K checkpoints, see write_manifest
+        self.epoch_metrics = []
+        self.best_checkpoints = []
 
         # gpu
         self.gpus = []
@@ -111,13 +118,15 @@ class RatingModel(object):
                                        self.cfg.LSTM.LAYERS,
                                        self.drop_prob, self.dropout,
                                        self.cfg.LSTM.BIDIRECTION,
-                                       self.cfg.CUDA)
+                                       self.cfg.CUDA,
+                                       init_state=self.cfg.LSTM.INIT_STATE)
             else:
                 self.RNet = BiLSTM(vec_dim, self.cfg.LSTM.SEQ_LEN,
                                    self.cfg.LSTM.HIDDEN_DIM,
                                    self.cfg.LSTM.LAYERS,
                                    self.drop_prob, self.dropout,
-                                   self.cfg.LSTM.BIDIRECTION, self.cfg.CUDA)
+                                   self.cfg.LSTM.BIDIRECTION, self.cfg.CUDA,
+                                   init_state=self.cfg.LSTM.INIT_STATE)
         else:
             self.RNet = RateNet(vec_dim, self.dropout)
         self.RNet.apply(weights_init)
@@ -127,12 +136,20 @@ class RatingModel(object):
             self.RNet.load_state_dict(build_state_dict(self.load_checkpoint))
             logging.info(f'Load from: {self.load_checkpoint}')
 
+    def batch_lengths(self, seq_lengths):
+        """The lengths the attention masks with, on the device once per batch; None without attention"""
+        if not self.cfg.LSTM.ATTN:
+            return None
+        return lengths_tensor(seq_lengths, self.cfg.CUDA)
+
     def train(self, X, y, L):
         """Training process
 
         Positional arguments:
         X -- dict(), keys = ["train", "val"]
-             vector representations for train/val examples
+             vector representations for train/val examples, anything that
+             supports gathering rows by an index array (e.g. a memory-mapped
+             cache or a `RowSubset` of it)
         y -- dict(), keys = ["train", "val"]
              human judgments for training examples
         L -- dict(), keys = ["train", "val"]
@@ -158,15 +175,15 @@ class RatingModel(object):
         count = self.cfg.TRAIN.START_EPOCH*self.cfg.BATCH_ITEM_NUM
 
         count_loss = []
+        train_batches = BucketedBatches(X_train, y_train, L_train, self.batch_size,
+                                        bucket_batches=self.cfg.TRAIN.BUCKET_BATCHES,
+                                        chop=self.cfg.LSTM.FLAG, pin=self.cfg.CUDA)
         if epoch == 0:
             # Purely random
             save_model(self.RNet, epoch, self.model_dir)
         while epoch < self.total_epoch:
             epoch += 1
             start_t = time.time()
-            batch_inds = list(BatchSampler(RandomSampler(X_train),
-                                           batch_size=self.batch_size,
-                                           drop_last=False))
 
             if epoch % self.lr_decay_per_epoch == 0:
                 # update learning rate
@@ -175,25 +192,17 @@ class RatingModel(object):
                 for param_group in optimizer.param_groups:
                     param_group['lr'] = lr
             total_loss = 0
-            for i, inds in enumerate(batch_inds, 0):
-                y_batch = y_train[inds]
-                X_batch = X_train[inds]
-                seq_lengths = [L_train[ii] for ii in inds]
-
-                sort_idx = sorted(range(len(seq_lengths)), key=lambda k: seq_lengths[k], reverse=True)
-                seq_lengths.sort(reverse=True)
-                X_batch = X_batch[sort_idx].float()
-                y_batch = y_batch[sort_idx]
-                y_batch = torch.from_numpy(y_batch).float()
-
+            # batches come out sorted by length, gathered straight from the (memory-mapped) cache
+            for i, (inds, X_batch, y_batch, seq_lengths) in enumerate(train_batches, 0):
                 if self.cfg.CUDA:
-                    X_batch = X_batch.cuda()
-                    y_batch = y_batch.cuda()
+                    X_batch = X_batch.cuda(non_blocking=True)
+                    y_batch = y_batch.cuda(non_blocking=True)
 
                 if self.cfg.LSTM.FLAG:
                     pack = pack_padded_sequence(X_batch, seq_lengths,
                                                 batch_first=True)
-                    output_scores, _ = self.RNet(pack, len(seq_lengths), seq_lengths)
+                    output_scores, _ = self.RNet(pack, len(seq_lengths), seq_lengths,
+                                                 lengths=self.batch_lengths(seq_lengths))
                 else:
                     output_scores, _ = self.RNet(X_batch)
                 optimizer.zero_grad()
@@ -217,8 +226,7 @@ class RatingModel(object):
                     self.best_val_r = val_r
                     self.best_val_loss = val_loss
                     self.best_val_epoch = epoch
-                    # save current best
-                    # save_model(self.RNet, epoch, self.best_model_dir)
+                self.update_best_checkpoints(epoch, val_r)
                 self.val_loss_history.append(val_loss)
                 self.val_r_history.append(val_r)
             else:
@@ -226,71 +234,86 @@ class RatingModel(object):
                 val_r = 0
             self.train_loss_history.append(total_loss)
 
-            logging.info(f'[{epoch}/{self.total_epoch}][{i+1}/{len(batch_inds)}]'
+            logging.info(f'[{epoch}/{self.total_epoch}][{i+1}/{len(train_batches)}]'
                          f' total train loss: {total_loss:.4f}; total val loss: {val_loss:.4f}'
                          f' val r: {val_r:.4f}; time: {(end_t-start_t):.2f}sec')
 
-            if epoch % self.interval == 0 or epoch == 1:
+            checkpoint = None
+            if epoch % self.interval == 0 or epoch == 1 or epoch == self.total_epoch or epoch in self.save_epochs:
                 count_loss = []
                 save_model(self.RNet, epoch, self.model_dir)
-        # save checkpoint for the last epoch
-        save_model(self.RNet, self.total_epoch, self.model_dir)
+                checkpoint = os.path.join('Model', f'RNet_epoch_{epoch}.pth')
+            self.epoch_metrics.append({'epoch': epoch, 'train_loss': total_loss,
+                                       'val_loss': val_loss if X_val is not None else None,
+                                       'val_r': val_r if X_val is not None else None,
+                                       'checkpoint': checkpoint})
+            self.write_manifest()
+        if self.total_epoch <= self.cfg.TRAIN.START_EPOCH:
+            # save checkpoint for the last epoch
+            save_model(self.RNet, self.total_epoch, self.model_dir)
         logging.info(f'Best epoch {self.best_val_epoch} with val_r = {self.best_val_r:.4f}.')
 
+    def update_best_checkpoints(self, epoch, val_r):
+        """Keep the checkpoints of the TRAIN.BEST_K epochs with the highest val_r in 'Best Model'"""
+        if self.cfg.TRAIN.BEST_K <= 0 or np.isnan(val_r):
+            return
+        best = self.best_checkpoints + [{'epoch': epoch, 'val_r': val_r,
+                                         'checkpoint': os.path.join('Best Model', f'RNet_epoch_{epoch}.pth')}]
+        best.sort(key=lambda b: b['val_r'], reverse=True)
+        self.best_checkpoints = best[:self.cfg.TRAIN.BEST_K]
+        for b in best[self.cfg.TRAIN.BEST_K:]:
+            if b['epoch'] != epoch:
+                os.remove(os.path.join(self.output_dir, b['checkpoint']))
+        if epoch in [b['epoch'] for b in self.best_checkpoints]:
+            save_model(self.RNet, epoch, self.best_model_dir)
+
+    def write_manifest(self):
+        """Write the metrics of every epoch so far and the best checkpoints to metrics.json
+
+        Checkpoint paths are relative to the output directory.
+        """
+        save_manifest(os.path.join(self.output_dir, 'metrics.json'),
+                      {'epochs': self.epoch_metrics,
+                       'best': self.best_checkpoints})
+
     def validation(self, X_val, y_val, L_val=None):
         self.RNet.eval()
-        batch_inds = list(BatchSampler(RandomSampler(X_val),
-                                       batch_size=self.batch_size,
-                                       drop_last=False))
+        # no shuffling: the whole split is sorted by length, which minimizes padding
+        val_batches = BucketedBatches(X_val, y_val, L_val, self.batch_size, shuffle=False,
+                                      bucket_batches=0, chop=self.cfg.LSTM.FLAG,
+                                      pin=self.cfg.CUDA)
         total_val_loss = 0
-        y_preds_lst = []
+        y_preds = []
         val_inds = []
         with torch.no_grad():
-            for i, inds in enumerate(batch_inds, 0):
-                val_inds += inds
-                y_batch = y_val[inds]
-                X_batch = X_val[inds]
-                seq_lengths = [L_val[ii] for ii in inds]
-
-                sort_idx = sorted(range(len(seq_lengths)), key=lambda k: seq_lengths[k], reverse=True)
-                seq_lengths.sort(reverse=True)
-                X_batch = X_batch[sort_idx].float()
-                y_batch = y_batch[sort_idx]
-                y_batch = torch.from_numpy(y_batch).float()
-
+            for i, (inds, X_batch, y_batch, seq_lengths) in enumerate(val_batches, 0):
+                val_inds.append(inds)
                 if self.cfg.CUDA:
-                    X_batch = X_batch.cuda()
-                    y_batch = y_batch.cuda()
+                    X_batch = X_batch.cuda(non_blocking=True)
+                    y_batch = y_batch.cuda(non_blocking=True)
 
                 if self.cfg.LSTM.FLAG:
                     pack = pack_padded_sequence(X_batch, seq_lengths,
                                                 batch_first=True)
                     output_scores, _ = self.RNet(pack, len(seq_lengths),
-                                                 seq_lengths)
+                                                 seq_lengths, lengths=self.batch_lengths(seq_lengths))
                 else:
                     output_scores, _ = self.RNet(X_batch)
 
-                loss = self.loss_func(output_scores.squeeze(), y_batch)
-                total_val_loss += loss.item()
-
-                output_scores = output_scores.data.tolist()
-
-                temp_rating = [0]*len(sort_idx)
-                cnt = 0
-                for s in sort_idx:
-                    temp_rating[s] = output_scores[cnt][0]
-                    cnt += 1
-                for curr_score in temp_rating:
-                    y_preds_lst.append(curr_score*(self.cfg.MAX_VALUE - self.cfg.MIN_VALUE) + self.cfg.MIN_VALUE)
-        y_val = y_val[val_inds]
-        val_coeff = np.corrcoef(np.array(y_preds_lst), np.array(y_val))[0, 1]
+                # accumulated on the device, synced once after the loop
+                total_val_loss += self.loss_func(output_scores.squeeze(), y_batch).double()
+                y_preds.append(output_scores[:, 0])
+        total_val_loss = float(total_val_loss)
+        y_preds = torch.cat(y_preds).double()*(self.cfg.MAX_VALUE - self.cfg.MIN_VALUE) + self.cfg.MIN_VALUE
+        y_val = y_val[np.concatenate(val_inds)]
+        val_coeff = np.corrcoef(y_preds.cpu().numpy(), np.array(y_val))[0, 1]
         return total_val_loss, val_coeff
 
     def evaluate(self, X, max_diff, min_value, sl):
         """Make predictions and evaluate the model
 
         Positional arguments:
-        X -- vector representations for all examples
+        X -- vector representations for all examples (array, memmap or tensor)
         max_diff -- for normalization
         min_value -- for normalization
         sl -- length of the sequence
@@ -301,63 +324,161 @@ class RatingModel(object):
         # gpu
         if self.cfg.CUDA:
             self.RNet.cuda()
+        return self.predict(X, max_diff, min_value, sl)
 
+    def predict(self, X, max_diff, min_value, sl):
+        """Make predictions with the loaded network, see `evaluate`
+
+        Return:
+        preds -- rescaled prediction of every example
+        all_attn -- (examples, LSTM.SEQ_LEN, 1) attention weights, zeros without attention
+        """
         num_items = X.shape[0]
         batch_size = min(num_items, self.batch_size)
 
-        rating_lst = []
-        count = 0
-        all_hiddens_list = []
+        sl = np.asarray(sl)
+        device = 'cuda' if self.cfg.CUDA else 'cpu'
+        # scores stay on the device, in item order, until the end
+        preds = torch.zeros(num_items, dtype=torch.float64, device=device)
         all_attn = np.zeros((num_items, self.cfg.LSTM.SEQ_LEN, 1))
-        diff = 0
-        while count < num_items:
-            iend = count + batch_size
-            if iend > num_items:
-                diff = iend - num_items
-                iend = num_items
-                # break
-                #count = num_items - batch_size
-            X_batch = X[count:iend]
-            seq_lengths = sl[count:iend]
-
-            sort_idx = sorted(range(len(seq_lengths)), key=lambda k: seq_lengths[k], reverse=True)
-            seq_lengths.sort(reverse=True)
-            max_seq_len_batch = seq_lengths[0]
-            X_batch = X_batch[sort_idx]
-            X_batch = X_batch[:, :max_seq_len_batch, :]
+        with torch.no_grad():
+            for count in range(0, num_items, batch_size):
+                # sort the batch by length; rows count + sort_idx of X, in that order
+                sort_idx = np.argsort(-sl[count:count + batch_size], kind='stable')
+                rows = count + sort_idx
+                seq_lengths = sl[rows].tolist()
+                X_batch = X[rows]
+                if self.cfg.LSTM.FLAG:
+                    X_batch = X_batch[:, :seq_lengths[0], :]
+                X_batch = to_float_tensor(X_batch)
 
-            if self.cfg.CUDA:
-                X_batch = X_batch.float().cuda()
+                if self.cfg.CUDA:
+                    X_batch = X_batch.cuda()
 
-            if self.cfg.LSTM.FLAG:
-                pack = pack_padded_sequence(X_batch, seq_lengths, batch_first=True)
-                output_scores, attn_weights = self.RNet(pack, len(seq_lengths), seq_lengths)
-            else:
-                output_scores, attn_weights = self.RNet(X_batch)
-            output_scores = output_scores.data.tolist()
-
-            temp_rating = [0]*len(sort_idx)
-            cnt = 0
-            if attn_weights is not None:
-                revert_attn_weights = np.zeros(attn_weights.shape)  # (batch_size, 8, seq_len, seq_len)
-            for s in sort_idx:
-                temp_rating[s] = output_scores[cnt][0]
+                if self.cfg.LSTM.FLAG:
+                    pack = pack_padded_sequence(X_batch, seq_lengths, batch_first=True)
+                    output_scores, attn_weights = self.RNet(pack, len(seq_lengths), seq_lengths,
+                                                            return_attn=True,
+                                                            lengths=self.batch_lengths(seq_lengths))
+                else:
+                    output_scores, attn_weights = self.RNet(X_batch)
+                # undo the sort by writing every row back to its item
+                preds[rows] = output_scores[:, 0].double()
                 if attn_weights is not None:
-                    revert_attn_weights[s, :, :] = attn_weights[cnt, :, :]
-                cnt += 1
-            #temp_rating = temp_rating[diff:]
-            if attn_weights is not None:
-                all_attn[count:iend, :max_seq_len_batch, :] = revert_attn_weights[:, :, :]
-            for curr_score in temp_rating:
-                rating_lst.append(curr_score*max_diff+min_value)
-            count += batch_size
-        return np.array(rating_lst), all_attn
+                    all_attn[rows, :seq_lengths[0], :] = attn_weights
+        return (preds*max_diff + min_value).cpu().numpy(), all_attn
+
+    def evaluate_checkpoints(self, X, max_diff, min_value, sl, checkpoints, workers=1, store=None):
+        """Make predictions with each of many checkpoints
 
+        The network is built once and every checkpoint is loaded into it in
+        turn. The input batches are gathered (and packed) once, sorted by
+        length, and reused for all checkpoints. With `workers` > 1, the
+        checkpoints are split over that many processes, which memory-map
+        `store` themselves.
+
+        Positional arguments:
+        X -- vector representations for all examples (array, memmap or tensor)
+        max_diff -- for normalization
+        min_value -- for normalization
+        sl -- length of the sequence
+        checkpoints -- paths to the checkpoints
+
+        Keyword arguments:
+        store -- (path to the embedding store, layer to slice or None, rows
+                 of the examples) that X views, see `cv.open_store`; without
+                 it the workers are sent a copy of X
+
+        Return (generator), for each checkpoint in order:
+        checkpoint -- path to the checkpoint
+        preds -- predictions for all examples
+        all_attn -- attention weights, (examples, SEQ_LEN, 1)
+        """
+        if workers > 1 and len(checkpoints) > 1:
+            yield from self._evaluate_checkpoints_parallel(X, max_diff, min_value, sl,
+                                                           checkpoints, workers, store)
+            return
+        self.load_checkpoint = ""
+        self.load_network()
+        self.RNet.eval()
+        if self.cfg.CUDA:
+            self.RNet.cuda()
+
+        num_items = X.shape[0]
+        batches = []
+        for inds, X_batch, _, seq_lengths in BucketedBatches(X, None, sl, self.batch_size,
+                                                             shuffle=False, bucket_batches=0,
+                                                             chop=self.cfg.LSTM.FLAG,
+                                                             pin=self.cfg.CUDA):
+            if self.cfg.CUDA:
+                X_batch = X_batch.cuda(non_blocking=True)
+            lengths = None
+            if self.cfg.LSTM.FLAG:
+                X_batch = pack_padded_sequence(X_batch, seq_lengths, batch_first=True)
+                lengths = self.batch_lengths(seq_lengths)
+            batches.append((inds, X_batch, seq_lengths, lengths))
+
+        for checkpoint in checkpoints:
+            self.RNet.load_state_dict(build_state_dict(checkpoint))
+            preds = np.zeros(num_items)
+            all_attn = np.zeros((num_items, self.cfg.LSTM.SEQ_LEN, 1))
+            with torch.no_grad():
+                for inds, X_batch, seq_lengths, lengths in batches:
+                    if self.cfg.LSTM.FLAG:
+                        output_scores, attn_weights = self.RNet(X_batch, len(seq_lengths), seq_lengths,
+                                                                return_attn=True, lengths=lengths)
+                    else:
+                        output_scores, attn_weights = self.RNet(X_batch)
+                    preds[inds] = output_scores[:, 0].cpu().numpy()
+                    if attn_weights is not None:
+                        all_attn[inds, :seq_lengths[0]] = attn_weights
+            yield checkpoint, preds*max_diff + min_value, all_attn
+
+    def _evaluate_checkpoints_parallel(self, X, max_diff, min_value, sl, checkpoints, workers, store):
+        """Split `evaluate_checkpoints` over spawned processes, one chunk of checkpoints each"""
+        import concurrent.futures
+        import multiprocessing
+        workers = min(workers, len(checkpoints))
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+        if store is not None:
+            # the workers memory-map the store, only its path and the rows are sent
+            X = None
+        else:
+            # send the examples themselves, not the whole store a lazy view points into
+            X = X[np.arange(X.shape[0])]
+        chunks = np.array_split(np.arange(len(checkpoints)), workers)
+        with concurrent.futures.ProcessPoolExecutor(workers,
+                                                    mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(evaluate_checkpoint_chunk, self.cfg, X, max_diff, min_value, sl,
+                                   [checkpoints[c] for c in chunk], num_threads, store)
+                       for chunk in chunks]
+            for future in futures:
+                yield from future.result()
+
+
+def evaluate_checkpoint_chunk(cfg, X, max_diff, min_value, sl, checkpoints, num_threads, store=None):
+    """Worker of `RatingModel.evaluate_checkpoints`: evaluate some checkpoints in this process,
+    on X or on the rows of `store`"""
+    torch.set_num_threads(num_threads)
+    if store is not None:
+        from cv import open_store
+        X = open_store(*store)
+    return list(RatingModel(cfg, None).evaluate_checkpoints(X, max_diff, min_value, sl, checkpoints))
 
 #####################################
 # Helper functions for word vectors #
 #####################################
+def get_glove():
+    """Load the GloVe table on first use, so runs that do not need it skip the import"""
+    global _GLOVE
+    if _GLOVE is None:
+        import torchtext.vocab as vocab
+        _GLOVE = vocab.GloVe(name='6B', dim=GLOVE_DIM)
+    return _GLOVE
+
+
 def get_word(w):
+    glove = get_glove()
     try:
         result = glove.vectors[glove.stoi[w]]
     except KeyError:
@@ -372,62 +493,125 @@ def split_by_whitespace(sentence):
     return [w for w in words if w]
 
 
-def get_sentence_glove(s, LSTM=False, not_contextual=True, seq_len=30):
+def glove_matrix():
+    """GloVe vectors followed by the <bos>, <eos> and an all-zero padding row"""
+    global _GLOVE_MATRIX
+    if _GLOVE_MATRIX is None:
+        _GLOVE_MATRIX = torch.cat([get_glove().vectors,
+                                   torch.stack([_BOS, _EOS, torch.zeros(GLOVE_DIM)])])
+    return _GLOVE_MATRIX
+
+
+def glove_indices(s):
+    """Vocabulary indices of the known words in `s`, and the number of tokens
+
+    Out-of-vocabulary words are dropped.
+    """
     raw_tokens = preprocess_utterance(s)
-    lst = []
-    if LSTM:
-        lst = [_BOS]
-    for w in raw_tokens:
-        curr_emb = get_word(w.lower())
-        if torch.all(torch.eq(curr_emb, _UNK)):
-            continue
-        else:
-            lst.append(curr_emb)
-    if LSTM:
-        lst.append(_EOS)
-    all_embs = torch.stack(lst)
+    stoi = get_glove().stoi
+    ids = [stoi.get(w.lower()) for w in raw_tokens]
+    return [i for i in ids if i is not None], len(raw_tokens)
+
+
+def get_sentences_glove(sentences, LSTM=False, not_contextual=True, seq_len=30):
+    """GloVe representations for a list of sentences
+
+    Sentences are turned into index arrays (chopped/padded like `padded` or
+    `context_padded` if LSTM), then all vectors are looked up with one gather.
+
+    Return:
+    embs -- (len(sentences), seq_len, GLOVE_DIM) if LSTM, otherwise the
+            (len(sentences), GLOVE_DIM) average over the known words
+    sen_len -- length of each sentence
+    """
+    matrix = glove_matrix()
+    bos, eos, pad = matrix.shape[0] - 3, matrix.shape[0] - 2, matrix.shape[0] - 1
+    all_ids = []
+    sen_len = []
+    for s in sentences:
+        ids, num_tokens = glove_indices(s)
+        if LSTM:
+            ids = [bos] + ids + [eos]
+            if seq_len <= len(ids):
+                # chop, keeping <eos> (or <bos> for contexts, which keep the end)
+                if not_contextual:
+                    ids = ids[:seq_len-1] + ids[-1:]
+                else:
+                    ids = ids[:1] + ids[len(ids)-seq_len+1:]
+            num_tokens = len(ids)
+        all_ids.append(ids)
+        sen_len.append(num_tokens)
+    width = seq_len if LSTM else max(len(ids) for ids in all_ids)
+    index = torch.full((len(all_ids), width), pad, dtype=torch.long)
+    for row, ids in enumerate(all_ids):
+        index[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+    embs = matrix[index]
     if not LSTM:
-        return torch.mean(all_embs, 0), len(raw_tokens)
-    if not not_contextual:
-        expected_embedding_padded, sl = context_padded(all_embs, seq_len)
-    else:
-        expected_embedding_padded, sl = padded(all_embs, seq_len)
-    assert sl <= seq_len
-    expected_embedding_tensor = torch.from_numpy(expected_embedding_padded)
-    return expected_embedding_tensor, sl
-
-
-def preprocess_utterance(s, split_off_clitics=True,max_utterances=None):
-  if split_off_clitics:
-    s = s.replace('\'ve', ' \'ve')
-    s = s.replace('\'re', ' \'re')
-    s = s.replace('\'ll', ' \'ll')
-    s = s.replace('n\'t', ' n\'t')
-    s = s.replace('\'d', ' \'d')
-    s = s.replace('-', ' ')
-    s = s.replace('\'s', ' \'s')
-  modified_s = re.sub('#', '.', s).strip('.').split('.')
-  modified_s = list(filter(None, modified_s))
-  if max_utterances and max_utterances < len(modified_s):
-    modified_s = modified_s[-max_utterances]
-  raw_tokens = []
-  for s in modified_s:
-      s = re.sub('speaker[0-9a-z\-\*]*[0-9]', '', s)
-      s = re.sub('[^a-zA-Z0-9- \n\.]', '', s)
-      s = re.sub('n[0-9][0-9a-z]{4,5}', '', s)
-      s = re.sub('[0-9]t[0-9]+', '', s)
-      s = s.replace(' oclock ', ' o\'clock ')
-      s = s.replace(' ve ', ' \'ve ')
-      s = s.replace(' re ', ' \'re ')
-      s = s.replace(' ll ', ' \'ll ')
-      s = s.replace(' nt ', ' n\'t ')
-      s = s.replace(' d ', ' \'d ')
-      s = s.replace(' s ', ' \'s ')
-      s = s.replace('doeuvres', 'd\'oeuvres')
-      s = s.replace('mumblex', 'mumble')
-      raw_tokens += split_by_whitespace(s)
-  
-  return raw_tokens
+        counts = torch.tensor([len(ids) for ids in all_ids], dtype=torch.float)
+        embs = embs.sum(1) / counts.clamp(min=1).unsqueeze(1)
+    return embs, sen_len
+
+
+def get_sentence_glove(s, LSTM=False, not_contextual=True, seq_len=30):
+    embs, sl = get_sentences_glove([s], LSTM=LSTM, not_contextual=not_contextual, seq_len=seq_len)
+    return embs[0], sl[0]
+
+
+# compiled once for preprocess_utterance
+_CLITICS = re.compile("'ve|'re|'ll|n't|'d|'s")
+_HYPHENS = str.maketrans('-', ' ')
+_UTTERANCE_BREAKS = str.maketrans('#', '.')
+_NOISE = [re.compile('speaker[0-9a-z\-\*]*[0-9]'),
+          re.compile('[^a-zA-Z0-9- \n\.]'),
+          re.compile('n[0-9][0-9a-z]{4,5}'),
+          re.compile('[0-9]t[0-9]+')]
+_REWRITES = [(' oclock ', ' o\'clock '),
+             (' ve ', ' \'ve '),
+             (' re ', ' \'re '),
+             (' ll ', ' \'ll '),
+             (' nt ', ' n\'t '),
+             (' d ', ' \'d '),
+             (' s ', ' \'s '),
+             ('doeuvres', 'd\'oeuvres'),
+             ('mumblex', 'mumble')]
+
+
+def normalize_utterances(s):
+    """Remove speaker tags/noise and restore clitics in '.'-separated utterances
+
+    None of the patterns can match across a '.', so the whole text is
+    processed at once instead of utterance by utterance.
+    """
+    for pattern in _NOISE:
+        s = pattern.sub('', s)
+    for (old, new) in _REWRITES:
+        s = s.replace(old, new)
+    return s
+
+
+@lru_cache(maxsize=65536)
+def _preprocess_utterance(s, split_off_clitics, max_utterances):
+    if split_off_clitics:
+        s = _CLITICS.sub(' \\g<0>', s).translate(_HYPHENS)
+    s = s.translate(_UTTERANCE_BREAKS)
+    if max_utterances:
+        modified_s = list(filter(None, s.strip('.').split('.')))
+        if max_utterances < len(modified_s):
+            # same result as before: indexing picks a single utterance, whose
+            # characters are then processed one by one
+            return tuple(w for c in modified_s[-max_utterances]
+                         for w in normalize_utterances(c).split())
+    return tuple(normalize_utterances(s).replace('.', ' ').split())
+
+
+def preprocess_utterance(s, split_off_clitics=True, max_utterances=None):
+    """Split a (Switchboard) utterance into tokens, results are memoized per text"""
+    return list(_preprocess_utterance(s, split_off_clitics, max_utterances))
+
+
+def preprocess_utterances(texts, split_off_clitics=True, max_utterances=None):
+    """`preprocess_utterance` for a batch of texts, e.g. a whole context file"""
+    return [preprocess_utterance(s, split_off_clitics, max_utterances) for s in texts]
 
 
 def tokenizer(s, pad_symbol=True, seq_len=None, from_right=True):
@@ -454,99 +638,267 @@ def tokenizer(s, pad_symbol=True, seq_len=None, from_right=True):
 
 
 # Elmo
-def get_sentence_elmo(s, c, embedder, layer=2, not_contextual=True, LSTM=False, seq_len=None):
-    """Get ELMo vector representation for each sentence"""
-
-    if not not_contextual:
+def elmo_inputs(s, c=None, LSTM=False):
+    """Tokens we feed ELMo for a target utterance (and its context, if `c` is given)"""
+    if c is not None:
       s = s + " </S> <S> " + c
+    return tokenizer(s, pad_symbol=LSTM)
+
+
+def elmo_output(expected_embedding, layer=2, not_contextual=True, LSTM=False, seq_len=None):
+    """Average or chop/pad the [3, num_tokens, 1024] ELMo output of one item"""
     if not LSTM:
-        raw_tokens = tokenizer(s, pad_symbol=False)
-        expected_embedding = embedder.embed_sentence(raw_tokens)
         sl = seq_len
         expected_embedding = np.mean(expected_embedding, axis=1)    # averaging on # of words
-        expected_embedding = expected_embedding[layer, :].squeeze()
+        if layer is not None:
+            expected_embedding = expected_embedding[layer, :].squeeze()
+        return torch.from_numpy(expected_embedding), sl
+    pad_func = padded if not_contextual else context_padded
+    if layer is None:
+        # keep all layers, (3, seq_len, 1024)
+        padded_layers = [pad_func(curr_layer, seq_len) for curr_layer in expected_embedding]
+        expected_embedding_padded = np.stack([p for (p, _) in padded_layers])
+        sl = padded_layers[0][1]
     else:
-        raw_tokens = tokenizer(s)
-        expected_embedding = embedder.embed_sentence(raw_tokens)  # [3, actual_sentence_len+2, 1024]
-        sentence_len = expected_embedding.shape[1]
         expected_embedding = expected_embedding[layer, :, :].squeeze()
         # chop/pad
-        if not_contextual:
-            expected_embedding_padded, sl = padded(expected_embedding, seq_len)
-        else:
-            expected_embedding_padded, sl = context_padded(expected_embedding, seq_len)
-        assert sl <= seq_len
-    expected_embedding_tensor = torch.from_numpy(expected_embedding_padded)
-    # expected_embedding_tensor = torch.from_numpy(expected_embedding)
-    return expected_embedding_tensor, sl
+        expected_embedding_padded, sl = pad_func(expected_embedding, seq_len)
+    assert sl <= seq_len
+    return torch.from_numpy(expected_embedding_padded), sl
+
+
+def iter_elmo_raw_batches(inputs, embedder, batch_size=32):
+    """Run ELMo over tokenized inputs in length-sorted batches
+
+    Yield:
+    idx -- positions (in `inputs`) of the items in the current batch
+    raw_embs -- [3, num_tokens, 1024] ELMo output of each item, see `elmo_outputs`
+    """
+    order = sorted(range(len(inputs)), key=lambda k: len(inputs[k]), reverse=True)
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start + batch_size]
+        yield idx, embedder.embed_batch([inputs[k] for k in idx])
+
+
+def elmo_outputs(raw_embs, layer=2, not_contextual=True, LSTM=False, seq_len=None):
+    """Stack the `elmo_output` of every item of a batch, return (embeddings, sl)"""
+    outputs = [elmo_output(e, layer=layer, not_contextual=not_contextual, LSTM=LSTM,
+                           seq_len=seq_len) for e in raw_embs]
+    return torch.stack([e for (e, _) in outputs]), [l for (_, l) in outputs]
+
+
+def iter_elmo_batches(inputs, embedder, layer=2, not_contextual=True, LSTM=False,
+                      seq_len=None, batch_size=32):
+    """Run ELMo over tokenized inputs in length-sorted batches
+
+    Positional arguments:
+    inputs -- list of token lists, see `elmo_inputs`
+    embedder -- allennlp ElmoEmbedder
+
+    Yield: (idx, embeddings, sl), same as `iter_bert_batches`
+    """
+    for idx, raw_embs in iter_elmo_raw_batches(inputs, embedder, batch_size=batch_size):
+        batch_embs, sl = elmo_outputs(raw_embs, layer=layer, not_contextual=not_contextual,
+                                      LSTM=LSTM, seq_len=seq_len)
+        yield idx, batch_embs, sl
+
+
+def get_sentences_elmo(inputs, embedder, layer=2, not_contextual=True, LSTM=False,
+                       seq_len=None, batch_size=32, out=None, out_idx=None):
+    """Batched ELMo representations for all items, see `get_sentences_bert`"""
+    batches = iter_elmo_batches(inputs, embedder, layer=layer, not_contextual=not_contextual,
+                                LSTM=LSTM, seq_len=seq_len, batch_size=batch_size)
+    return scatter_batches(batches, len(inputs), all_layers=layer is None,
+                           out=out, out_idx=out_idx)
+
+
+def get_sentence_elmo(s, c, embedder, layer=2, not_contextual=True, LSTM=False, seq_len=None):
+    """Get ELMo vector representation for each sentence (all 3 layers if `layer` is None)"""
+    inputs = [elmo_inputs(s, None if not_contextual else c, LSTM=LSTM)]
+    _, expected_embedding_tensor, sl = next(iter_elmo_batches(inputs, embedder, layer=layer,
+                                                              not_contextual=not_contextual,
+                                                              LSTM=LSTM, seq_len=seq_len,
+                                                              batch_size=1))
+    return expected_embedding_tensor[0], sl[0]
+
+
+def scatter_batch(out, rows, batch_embs, all_layers=False):
+    """Write the embeddings of one batch into the `rows` of `out`, see `scatter_batches`"""
+    if all_layers:
+        batch_embs = batch_embs.transpose(0, 1)
+    if isinstance(out, np.ndarray):
+        batch_embs = batch_embs.numpy()
+    if all_layers:
+        out[:, rows] = batch_embs
+    else:
+        out[rows] = batch_embs
+
+
+def scatter_batches(batches, num_items, all_layers=False, out=None, out_idx=None):
+    """Put the (idx, embeddings, sl) batches of an encoder back in item order
+
+    If `out` is given (e.g. a memory-mapped array), the outputs are written
+    into it instead of a new tensor. Items are along the first axis, or along
+    the second one for all-layers outputs, i.e. (layers, items, ...). `out_idx`
+    gives the row of `out` for each item, by default its position in the input.
+
+    Return:
+    embs -- `out`, or a new tensor with the embeddings of all items
+    sen_len -- length of each item
+    """
+    embs = out
+    sen_len = [0] * num_items
+    for idx, batch_embs, sl in batches:
+        if embs is None:
+            embs = torch.zeros((batch_embs.shape[1], num_items) + tuple(batch_embs.shape[2:])
+                               if all_layers else
+                               (num_items,) + tuple(batch_embs.shape[1:]),
+                               dtype=batch_embs.dtype)
+        rows = idx if out_idx is None else [out_idx[k] for k in idx]
+        scatter_batch(embs, rows, batch_embs, all_layers=all_layers)
+        for k, l in zip(idx, sl):
+            sen_len[k] = l
+    return embs, sen_len
+
 
 # BERT from huggingface models
-def get_sentence_bert(s, bert_tokenizer, bert_model, layer = 11, GPU=False, LSTM=False, max_seq_len=None, is_single=True):
+def bert_token_ids(s, bert_tokenizer):
+    """Token ids of the text `s`, looked up if `bert_tokenizer` is a `TokenCache`"""
+    if isinstance(bert_tokenizer, TokenCache):
+        return bert_tokenizer.token_ids(s)
+    return bert_tokenizer.convert_tokens_to_ids(bert_tokenizer.tokenize(s))
+
+
+def bert_inputs(s, bert_tokenizer):
+    """Tokenize a target utterance for BERT
+
+    Return:
+    indexed_tokens -- token ids, including [CLS] and [SEP]
+    segments_ids -- segment id of each token
+    s_len -- number of tokens that we keep as the sentence representation
+    """
     s = " ".join(preprocess_utterance(s, split_off_clitics = False))
-    s = "[CLS] " + s + " [SEP]"
-    tokenized_text = bert_tokenizer.tokenize(s)
-    indexed_tokens = bert_tokenizer.convert_tokens_to_ids(tokenized_text)
+    indexed_tokens = bert_token_ids(bert_text(s), bert_tokenizer)
     segments_ids = [0] * len(indexed_tokens)
-    tokens_tensor = torch.tensor([indexed_tokens])
-    segments_tensors = torch.tensor([segments_ids])
-    bert_output = torch.zeros((1,max_seq_len, bert_model.config.hidden_size))
-    if GPU:
-      tokens_tensor = tokens_tensor.cuda()
-      segments_tensors = segments_tensors.cuda()
-      bert_output = bert_output.cuda()
-      
-    sl = min(len(indexed_tokens), max_seq_len)
-
-    with torch.no_grad():
-        outputs = bert_model(tokens_tensor, token_type_ids=segments_tensors)
-        bert_output[:, :sl, :] = outputs[2][layer][:,:sl, :]
-        bert_output = bert_output.squeeze()  # (max_seq_len, 768)
-
-    if GPU:
-      bert_output = bert_output.cpu()
-
-    if LSTM:
-        return bert_output, sl
-    else:
-        bert_mean = torch.mean(bert_output, axis=0)
-        return bert_mean, sl
+    return indexed_tokens, segments_ids, len(indexed_tokens)
 
-def get_sentence_bert_context(s, c, bert_tokenizer, bert_model, layer = 11,
-                              GPU=False, LSTM=False, max_sentence_len=None, 
-                              max_context_len=None, max_context_utterances=None):
+
+def bert_context_inputs(s, c, bert_tokenizer, max_sentence_len=None,
+                        max_context_len=None, max_context_utterances=None):
+    """Tokenize a target utterance and its discourse context as a sentence pair
+
+    Return: same as `bert_inputs`, where `s_len` is the number of tokens before
+    the first [SEP]
+    """
     s = " ".join(preprocess_utterance(s, split_off_clitics = False))
     s = " ".join(preprocess_utterance(s, split_off_clitics = False, max_utterances=max_context_utterances))
     s = "[CLS]" + s + " [SEP] " + c + " [SEP]" 
-    tokenized_text = bert_tokenizer.tokenize(s)
-    indexed_tokens = bert_tokenizer.convert_tokens_to_ids(tokenized_text)
+    indexed_tokens = bert_token_ids(s, bert_tokenizer)
+    s_len = indexed_tokens.index(bert_tokenizer.sep_token_id)
     if len(indexed_tokens) > max_sentence_len + max_context_len:
       indexed_tokens = indexed_tokens[:(max_sentence_len + max_context_len)]
-    s_len = tokenized_text.index("[SEP]")
     segments_ids = [0] * (s_len + 1) + [1] * (len(indexed_tokens) - s_len - 1)
-    
-    tokens_tensor = torch.tensor([indexed_tokens])
-    segments_tensors = torch.tensor([segments_ids])
-    bert_output = torch.zeros((1,max_sentence_len, bert_model.config.hidden_size))
-    if GPU:
-      tokens_tensor = tokens_tensor.cuda()
-      segments_tensors = segments_tensors.cuda()
-      bert_output = bert_output.cuda()
-      
-    sl = min(s_len, max_sentence_len)
-
-    with torch.no_grad():
-        outputs = bert_model(tokens_tensor, token_type_ids=segments_tensors)
-        bert_output[:, :sl, :] = outputs[2][layer][:,:sl, :]
-        bert_output = bert_output.squeeze()  # (max_seq_len, 768)
-
-    if GPU:
-      bert_output = bert_output.cpu()
-
-    if LSTM:
-        return bert_output, sl
-    else:
-        bert_mean = torch.mean(bert_output, axis=0)
-        return bert_mean, sl
+    return indexed_tokens, segments_ids, s_len
+
+
+def iter_bert_batches(inputs, bert_model, layer=11, GPU=False, LSTM=False,
+                      max_seq_len=None, batch_size=32):
+    """Run BERT over tokenized inputs in padded, length-bucketed batches
+
+    Items are sorted by number of tokens so that each batch only pads up to
+    the longest item in its bucket; padded positions are masked out.
+
+    Positional arguments:
+    inputs -- list of (indexed_tokens, segments_ids, s_len), see `bert_inputs`
+    bert_model -- BertModel with `output_hidden_states=True`
+
+    Keyword arguments:
+    layer -- which hidden layer to keep, or None to keep all of them
+
+    Yield:
+    idx -- positions (in `inputs`) of the items in the current batch
+    bert_output -- (len(idx), max_seq_len, hidden_size) if LSTM, otherwise
+                   the (len(idx), hidden_size) average over max_seq_len;
+                   with layer=None there is an extra layer axis after the first
+    sl -- length of each item after chopping
+    """
+    order = sorted(range(len(inputs)), key=lambda k: len(inputs[k][0]), reverse=True)
+    hidden_size = bert_model.config.hidden_size
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start + batch_size]
+        max_tokens = len(inputs[idx[0]][0])
+        tokens_tensor = torch.zeros((len(idx), max_tokens), dtype=torch.long)
+        segments_tensors = torch.zeros((len(idx), max_tokens), dtype=torch.long)
+        attention_mask = torch.zeros((len(idx), max_tokens), dtype=torch.long)
+        for row, k in enumerate(idx):
+            indexed_tokens, segments_ids, _ = inputs[k]
+            tokens_tensor[row, :len(indexed_tokens)] = torch.tensor(indexed_tokens)
+            segments_tensors[row, :len(segments_ids)] = torch.tensor(segments_ids)
+            attention_mask[row, :len(indexed_tokens)] = 1
+        sl = [min(inputs[k][2], max_seq_len) for k in idx]
+        keep = torch.arange(max_seq_len).unsqueeze(0) < torch.tensor(sl).unsqueeze(1)
+        keep = keep.unsqueeze(2).float()
+        if layer is None:
+            num_layers = bert_model.config.num_hidden_layers + 1
+            bert_output = torch.zeros((len(idx), num_layers, max_seq_len, hidden_size))
+            keep = keep.unsqueeze(1)
+        else:
+            bert_output = torch.zeros((len(idx), max_seq_len, hidden_size))
+        if GPU:
+          tokens_tensor = tokens_tensor.cuda()
+          segments_tensors = segments_tensors.cuda()
+          attention_mask = attention_mask.cuda()
+          keep = keep.cuda()
+          bert_output = bert_output.cuda()
+
+        width = min(max_tokens, max_seq_len)
+        with torch.no_grad():
+            outputs = bert_model(tokens_tensor, attention_mask=attention_mask,
+                                 token_type_ids=segments_tensors)
+            if layer is None:
+                bert_output[:, :, :width, :] = torch.stack([h[:, :width, :] for h in outputs[2]], 1)
+            else:
+                bert_output[:, :width, :] = outputs[2][layer][:, :width, :]
+            bert_output = bert_output * keep
+
+        if GPU:
+          bert_output = bert_output.cpu()
+
+        if not LSTM:
+            bert_output = torch.mean(bert_output, axis=-2)
+        yield idx, bert_output, sl
+
+
+def get_sentences_bert(inputs, bert_model, layer=11, GPU=False, LSTM=False,
+                       max_seq_len=None, batch_size=32, out=None, out_idx=None):
+    """Batched BERT representations for all items, in the order of `inputs`
+
+    See `scatter_batches` for `out` and `out_idx`.
+    """
+    batches = iter_bert_batches(inputs, bert_model, layer=layer, GPU=GPU, LSTM=LSTM,
+                                max_seq_len=max_seq_len, batch_size=batch_size)
+    return scatter_batches(batches, len(inputs), all_layers=layer is None,
+                           out=out, out_idx=out_idx)
+
+
+def get_sentence_bert(s, bert_tokenizer, bert_model, layer = 11, GPU=False, LSTM=False, max_seq_len=None, is_single=True):
+    inputs = [bert_inputs(s, bert_tokenizer)]
+    _, bert_output, sl = next(iter_bert_batches(inputs, bert_model, layer=layer, GPU=GPU,
+                                                LSTM=LSTM, max_seq_len=max_seq_len,
+                                                batch_size=1))
+    return bert_output[0], sl[0]
+
+def get_sentence_bert_context(s, c, bert_tokenizer, bert_model, layer = 11,
+                              GPU=False, LSTM=False, max_sentence_len=None, 
+                              max_context_len=None, max_context_utterances=None):
+    inputs = [bert_context_inputs(s, c, bert_tokenizer,
+                                  max_sentence_len=max_sentence_len,
+                                  max_context_len=max_context_len,
+                                  max_context_utterances=max_context_utterances)]
+    _, bert_output, sl = next(iter_bert_batches(inputs, bert_model, layer=layer, GPU=GPU,
+                                                LSTM=LSTM, max_seq_len=max_sentence_len,
+                                                batch_size=1))
+    return bert_output[0], sl[0]
 
 
 def padded(emb, seq_len):
@@ -75,6 +75,41 @@ class RateNet2D(nn.Module):
         return self.get_score(h)
 
 
+class InitialState(nn.Module):
+    """Initial hidden and cell states (h0, c0) of an LSTM
+
+    mode -- 'zero': zeros, kept in a buffer on the module's device
+            'learned': trainable states shared by all examples, start at zero
+            'random': standard normal states drawn for every batch
+    The zero and learned states are expanded to the batch without copying.
+    """
+    def __init__(self, num_states, hidden_dim, mode='zero', is_gpu=False):
+        super(InitialState, self).__init__()
+        if mode not in ('zero', 'learned', 'random'):
+            raise ValueError(f'Unknown initial state: {mode}')
+        self.num_states = num_states
+        self.hidden_dim = hidden_dim
+        self.mode = mode
+        self.is_gpu = is_gpu
+        if mode == 'learned':
+            self.h0 = nn.Parameter(torch.zeros(num_states, 1, hidden_dim))
+            self.c0 = nn.Parameter(torch.zeros(num_states, 1, hidden_dim))
+        elif mode == 'zero':
+            # not saved, so checkpoints do not depend on the mode
+            self.register_buffer('h0', torch.zeros(num_states, 1, hidden_dim), persistent=False)
+            self.register_buffer('c0', torch.zeros(num_states, 1, hidden_dim), persistent=False)
+
+    def forward(self, batch_size):
+        if self.mode == 'random':
+            h0 = torch.randn(self.num_states, batch_size, self.hidden_dim)
+            c0 = torch.randn(self.num_states, batch_size, self.hidden_dim)
+            if self.is_gpu:
+                h0 = h0.float().cuda()
+                c0 = c0.float().cuda()
+            return h0, c0
+        return self.h0.expand(-1, batch_size, -1), self.c0.expand(-1, batch_size, -1)
+
+
 # (Bi-)LSTM model
 class BiLSTM(nn.Module):
     """
@@ -85,7 +120,8 @@ class BiLSTM(nn.Module):
     Then, the hidden states are fed into a projection layer, which in return is
     passed through a sigmoid function to predict the ratings.
     """
-    def __init__(self, vec_dim, seq_len, hidden_dim, num_layers, drop_prob, dropout, bidirection, is_gpu, batch_size=32):
+    def __init__(self, vec_dim, seq_len, hidden_dim, num_layers, drop_prob, dropout, bidirection, is_gpu, batch_size=32,
+                 init_state='random'):
         super(BiLSTM, self).__init__()
         self.vec_dim = vec_dim
         self.seq_len = seq_len
@@ -96,6 +132,7 @@ class BiLSTM(nn.Module):
         self.bidirect = bidirection
         self.batch_size = batch_size
         self.is_gpu = is_gpu
+        self.init_state_mode = init_state
         self.define_module()
 
     def define_module(self):
@@ -105,6 +142,8 @@ class BiLSTM(nn.Module):
                             batch_first=True,
                             dropout=self.drop_prob,
                             bidirectional=self.bidirect)
+        num_states = self.num_layers*2 if self.bidirect else self.num_layers
+        self.init_state = InitialState(num_states, self.hidden_dim, self.init_state_mode, self.is_gpu)
         if self.bidirect:
             self.get_score = nn.Sequential(
                 nn.Linear(self.hidden_dim*2, 1, bias=True),
@@ -114,43 +153,24 @@ class BiLSTM(nn.Module):
                 nn.Linear(self.hidden_dim, 1, bias=True),
                 nn.Sigmoid())
 
-    def forward(self, x, batch_size, seq_lens):
+    def forward(self, x, batch_size, seq_lens, return_attn=False, lengths=None):
         """
 
         x - Tensor shape (curr_batch_size, seq_len, input_size)
                 we need to permute the first and the second axis
+        lengths - unused, the packed `x` has the lengths
 
         output - Tensor shape (curr_batch_size, 1)
         """
 #        assert x.shape[0] == batch_size
+        h0, c0 = self.init_state(batch_size)
+        # h_n holds the state of every direction after its last valid step:
+        # the forward direction at seq_lens[i]-1, the backward one at 0
+        _, (h_n, _) = self.lstm(x, (h0, c0))
         if self.bidirect:
-            h0 = torch.randn(self.num_layers*2, batch_size, self.hidden_dim)
-            c0 = torch.randn(self.num_layers*2, batch_size, self.hidden_dim)
-        else:
-            h0 = torch.randn(self.num_layers, batch_size, self.hidden_dim)
-            c0 = torch.randn(self.num_layers, batch_size, self.hidden_dim)
-        if self.is_gpu:
-            h0 = h0.float().cuda()
-            c0 = c0.float().cuda()
-        x, _ = self.lstm(x, (h0, c0))
-        x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True)
-        if self.bidirect:
-            x = x.reshape(batch_size, seq_lens[0], self.hidden_dim*2)
-        else:
-            x = x.reshape(batch_size, seq_lens[0], self.hidden_dim)
-        x = x.permute(0, 2, 1)
-        mask = torch.zeros(x.size())
-        if self.bidirect:
-          for i in range(batch_size):
-            mask[i, :self.hidden_dim, seq_lens[i]-1] = 1
-            mask[i, self.hidden_dim:, 0] = 1
+            x = torch.cat((h_n[-2], h_n[-1]), dim=1)  # (batch_size, hidden_dim*2)
         else:
-          for i in range(batch_size):
-              mask[i, :, seq_lens[i]-1] = 1
-        if self.is_gpu:
-            mask = mask.cuda()
-        x = x * mask  # (batch_size, hidden_dim, max_seq_len)
-        x = x.sum(dim=2)  # (batch_size, hidden_dim)
+            x = h_n[-1]  # (batch_size, hidden_dim)
         return self.get_score(x), None
 
 
@@ -163,7 +183,8 @@ class BiLSTMAttn(nn.Module):
     Then, the hidden states are fed into a projection layer, which in return is
     passed through a sigmoid function to predict the ratings.
     """
-    def __init__(self, vec_dim, seq_len, hidden_dim, num_layers, drop_prob, dropout, bidirection, is_gpu, batch_size=32):
+    def __init__(self, vec_dim, seq_len, hidden_dim, num_layers, drop_prob, dropout, bidirection, is_gpu, batch_size=32,
+                 init_state='random'):
         super(BiLSTMAttn, self).__init__()
         self.vec_dim = vec_dim
         self.seq_len = seq_len
@@ -174,6 +195,7 @@ class BiLSTMAttn(nn.Module):
         self.bidirect = bidirection
         self.batch_size = batch_size
         self.is_gpu = is_gpu
+        self.init_state_mode = init_state
         self.define_module()
 
     def define_module(self):
@@ -183,6 +205,8 @@ class BiLSTMAttn(nn.Module):
                             batch_first=True,
                             dropout=self.drop_prob,
                             bidirectional=self.bidirect)
+        num_states = self.num_layers*2 if self.bidirect else self.num_layers
+        self.init_state = InitialState(num_states, self.hidden_dim, self.init_state_mode, self.is_gpu)
         if self.bidirect:
             self.attention = SelfAttention(self.hidden_dim*2, self.is_gpu)
             self.get_score = nn.Sequential(
@@ -194,31 +218,31 @@ class BiLSTMAttn(nn.Module):
                 nn.Linear(self.hidden_dim, 1, bias=True),
                 nn.Sigmoid())
 
-    def forward(self, x, batch_size, seq_lens):
+    def forward(self, x, batch_size, seq_lens, return_attn=False, lengths=None):
         """
 
         x - Tensor shape (batch_size, seq_len, input_size)
                 we need to permute the first and the second axis
+        return_attn - also return the attention weights as a numpy array
+        lengths - `seq_lens` as an int64 Tensor on the device of `x`, built once
+                per batch by the caller; made from `seq_lens` if None
 
-        output - Tensor shape (batch_size, 1)
+        output - Tensor shape (batch_size, 1), attention weights or None
         """
-        if self.bidirect:
-            h0 = torch.randn(self.num_layers*2, batch_size, self.hidden_dim)
-            c0 = torch.randn(self.num_layers*2, batch_size, self.hidden_dim)
-        else:
-            h0 = torch.randn(self.num_layers, batch_size, self.hidden_dim)
-            c0 = torch.randn(self.num_layers, batch_size, self.hidden_dim)
-        if self.is_gpu:
-            h0 = h0.float().cuda()
-            c0 = c0.float().cuda()
+        h0, c0 = self.init_state(batch_size)
         x, _ = self.lstm(x, (h0, c0))
         x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True)
         if self.bidirect:
             x = x.reshape(batch_size, seq_lens[0], self.hidden_dim*2)
         else:
             x = x.reshape(batch_size, seq_lens[0], self.hidden_dim)
-        x, attn_weights = self.attention(x, seq_lens)
-        return self.get_score(x), attn_weights
+        if lengths is None:
+            lengths = torch.as_tensor(seq_lens, device=x.device)
+        x, attn_weights = self.attention(x, lengths)
+        if return_attn:
+            # only evaluation pays for the device sync and host copy
+            return self.get_score(x), attn_weights.detach().cpu().numpy()
+        return self.get_score(x), None
 
 class SelfAttention(nn.Module):
 
@@ -228,17 +252,25 @@ class SelfAttention(nn.Module):
         self.attention1 = nn.Linear(hidden_dim, 50)
         self.attention2 = nn.Linear(50, 1)
 
-    def forward(self, lstm_out, seq_lens):
+    def forward(self, lstm_out, lengths):
+        """
+
+        lstm_out - Tensor shape (batch_size, max_seq_len, hidden_dim)
+        lengths - int64 Tensor shape (batch_size,) on the device of lstm_out,
+                the length of each sequence; padded timesteps get no weight
+
+        output - weighted sum (batch_size, hidden_dim) and the attention
+                 weights (batch_size, max_seq_len, 1), left on the device
+        """
         # B x max_seq_len x 50
-        attention1 = torch.tanh(self.attention1(lstm_out)) 
+        attention1 = torch.tanh(self.attention1(lstm_out))
         # B x max_seq_len x 1
-        attention2 = torch.softmax(self.attention2(attention1), dim=1) 
+        scores = self.attention2(attention1)
+        padding = torch.arange(lstm_out.shape[1], device=lstm_out.device)[None, :] >= lengths[:, None]
+        scores = scores.masked_fill(padding.unsqueeze(2), float('-inf'))
+        attention2 = torch.softmax(scores, dim=1)
         dot_product = torch.sum(torch.mul(lstm_out, attention2), dim=1)
-
-        attention_weights = attention2
-        if self.is_gpu:
-          attention_weights = attention_weights.cpu()
-        return dot_product, attention_weights.detach().numpy()
+        return dot_product, attention2
 
 
 #class MultiHeadAttention(nn.Module):
@@ -9,19 +9,22 @@ import random
 import re
 from statistics import mean
 import sys
+import time
 
-from allennlp.commands.elmo import ElmoEmbedder
 from easydict import EasyDict as edict
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import torch
 from tqdm import tqdm
 import yaml
 
-from models import split_by_whitespace, RatingModel
+from cv import run_folds
+from emb_cache import EmbeddingCache, content_hash
+from extract import extract_embeddings, max_seq_len, tokenize_items, EXTRACT_VERSION
+from token_cache import TokenCache
+from models import split_by_whitespace, RatingModel, PREPROCESS_VERSION
 from split_dataset import split_train_test, k_folds_idx
-from utils import mkdir_p
+from utils import mkdir_p, RowSubset, save_manifest, load_manifest, top_epochs
 
 
 cfg = edict()
@@ -45,12 +48,18 @@ cfg.ELMO_LAYER = 2
 cfg.BERT_LAYER = 11
 cfg.BERT_LARGE = False
 cfg.ELMO_MODE = 'concat'
+cfg.CACHE_ALL_LAYERS = False
+cfg.CACHE_DTYPE = 'float32'
 cfg.SAVE_PREDS = False
 cfg.BATCH_ITEM_NUM = 30
+cfg.EMBED_BATCH_SIZE = 32
+cfg.EMBED_WORKERS = 0
 cfg.PREDON = 'test'
 cfg.CUDA = False
 cfg.GPU_NUM = 1
 cfg.KFOLDS = 5
+cfg.CV_WORKERS = 1
+cfg.CV_THREADS = 0
 cfg.CROSS_VALIDATION_FLAG = True
 cfg.SPLIT_NAME = ""
 
@@ -62,12 +71,15 @@ cfg.LSTM.DROP_PROB = 0.2
 cfg.LSTM.LAYERS = 2
 cfg.LSTM.BIDIRECTION = True
 cfg.LSTM.ATTN = False
+cfg.LSTM.INIT_STATE = 'random'
 
 cfg.TRAIN = edict()
 cfg.TRAIN.FLAG = True
 cfg.TRAIN.BATCH_SIZE = 32
+cfg.TRAIN.BUCKET_BATCHES = 1
 cfg.TRAIN.TOTAL_EPOCH = 200
 cfg.TRAIN.INTERVAL = 4
+cfg.TRAIN.BEST_K = 1
 cfg.TRAIN.START_EPOCH = 0
 cfg.TRAIN.LR_DECAY_EPOCH = 20
 cfg.TRAIN.LR = 5e-2
@@ -83,6 +95,11 @@ cfg.TRAIN.DROPOUT.FC_2 = 0.75
 cfg.EVAL = edict()
 cfg.EVAL.FLAG = False
 cfg.EVAL.BEST_EPOCH = 100
+cfg.EVAL.WORKERS = 1
+cfg.EVAL.SELECT = 'all'
+cfg.EVAL.TOP_K = 3
+cfg.EVAL.EPOCHS = []
+cfg.EVAL.MANIFEST = ''
 
 GLOVE_DIM = 100
 NOT_EXIST = torch.FloatTensor(1, GLOVE_DIM).zero_()
@@ -109,10 +126,15 @@ def merge_yaml(new_cfg, old_cfg):
             old_cfg[k] = v
 
 
+def resolve_cfg(given):
+    """`given`, or the cfg of this module (see `cfg_setup`) if None"""
+    return cfg if given is None else given
+
+
 def cfg_setup(filename):
     """Update values of the parameters based on configuration file"""
     with open(filename, 'r') as f:
-        new_cfg = edict(yaml.load(f))
+        new_cfg = edict(yaml.load(f, Loader=yaml.FullLoader))
     merge_yaml(new_cfg, cfg)
 
 
@@ -160,10 +182,334 @@ def random_input(num_examples):
     return torch.Tensor(res)
 
 
+def item_inputs(target_utterances, contexts, single_sentence):
+    """Return the cache entries ([item ID, text hash] pairs) and texts to encode of all items"""
+    item_ids = list(target_utterances.keys())
+    item_texts = [[target_utterances[k][0]] if single_sentence
+                  else [target_utterances[k][0], contexts[k][0]] for k in item_ids]
+    items = [[k, content_hash(t)] for (k, t) in zip(item_ids, item_texts)]
+    return items, item_texts
+
+
+def encoder_seq_len(single_sentence, cfg=None):
+    """Number of tokens kept per item"""
+    return max_seq_len(resolve_cfg(cfg), single_sentence)
+
+
+def load_encoder(cfg=None):
+    """Load the ELMo/BERT encoder of cfg, GloVe vectors are loaded on first use
+
+    Return:
+    edict() with `elmo` (ElmoEmbedder), or `bert_tokenizer` and `bert_model`
+    """
+    cfg = resolve_cfg(cfg)
+    encoder = edict()
+    # encoders are only imported when there is something to encode
+    if cfg.IS_ELMO:
+        from allennlp.commands.elmo import ElmoEmbedder
+        encoder.elmo = ElmoEmbedder()
+    if cfg.IS_BERT:
+        from transformers import BertTokenizer, BertModel
+        bert_model = 'bert-large-uncased' if cfg.BERT_LARGE else 'bert-base-uncased'
+        encoder.bert_tokenizer = BertTokenizer.from_pretrained(bert_model)
+        encoder.bert_model = BertModel.from_pretrained(bert_model, output_hidden_states=True)
+        encoder.bert_model.eval()
+        if cfg.CUDA:
+            encoder.bert_model = encoder.bert_model.cuda()
+    return encoder
+
+
+def embedding_shape(encoder, single_sentence, all_layers=False, cfg=None):
+    """Shape of the embeddings of one item, with a leading layer axis if `all_layers`"""
+    from models import ELMO_DIM
+    cfg = resolve_cfg(cfg)
+    row_shape = ()
+    if cfg.IS_BERT:
+        if all_layers:
+            row_shape += (encoder.bert_model.config.num_hidden_layers + 1,)
+        dim = encoder.bert_model.config.hidden_size
+    elif cfg.IS_ELMO:
+        if all_layers:
+            row_shape += (3,)
+        dim = ELMO_DIM
+    else:
+        dim = cfg.GLOVE_DIM
+    if cfg.LSTM.FLAG:
+        row_shape += (encoder_seq_len(single_sentence, cfg),)
+    return row_shape + (dim,)
+
+
+def encoder_inputs(item_texts, single_sentence, encoder, progress=True, cfg=None):
+    """Tokenize items for the ELMo/BERT encoder of cfg (GloVe takes the texts)
+
+    Positional arguments: see `encode_items`, only `encoder.bert_tokenizer` is used
+    """
+    return tokenize_items(resolve_cfg(cfg), item_texts, single_sentence, encoder, progress=progress)
+
+
+def encode_inputs(inputs, single_sentence, encoder, all_layers=False, out=None, out_idx=None, cfg=None):
+    """Run the encoder of cfg over the outputs of `encoder_inputs`, see `encode_items`"""
+    cfg = resolve_cfg(cfg)
+    if cfg.IS_BERT:
+        # BERT in length-bucketed batches
+        from models import get_sentences_bert
+        return get_sentences_bert(inputs,
+                                  encoder.bert_model,
+                                  layer=None if all_layers else cfg.BERT_LAYER,
+                                  GPU=cfg.CUDA,
+                                  LSTM=cfg.LSTM.FLAG,
+                                  max_seq_len=encoder_seq_len(single_sentence, cfg),
+                                  batch_size=cfg.EMBED_BATCH_SIZE,
+                                  out=out,
+                                  out_idx=out_idx)
+    elif cfg.IS_ELMO:
+        # ELMo in length-sorted batches
+        from models import get_sentences_elmo
+        return get_sentences_elmo(inputs,
+                                  encoder.elmo,
+                                  layer=None if all_layers else cfg.ELMO_LAYER,
+                                  not_contextual=single_sentence,
+                                  LSTM=cfg.LSTM.FLAG,
+                                  seq_len=cfg.LSTM.SEQ_LEN,
+                                  batch_size=cfg.EMBED_BATCH_SIZE,
+                                  out=out,
+                                  out_idx=out_idx)
+    from models import get_sentences_glove
+    word_embs_stack, sen_len = get_sentences_glove(inputs, LSTM=cfg.LSTM.FLAG,
+                                                   not_contextual=single_sentence,
+                                                   seq_len=cfg.LSTM.SEQ_LEN)
+    if out is None:
+        return word_embs_stack, sen_len
+    out[list(range(len(inputs))) if out_idx is None else out_idx] = word_embs_stack.numpy()
+    return out, sen_len
+
+
+def encode_items(item_texts, single_sentence, encoder, all_layers=False, out=None, out_idx=None, cfg=None):
+    """Encode items with the ELMo/BERT/GloVe encoder of cfg
+
+    Everything is tokenized up front (`encoder_inputs`), then encoded in
+    batches (`encode_inputs`).
+
+    Positional arguments:
+    item_texts -- [target utterance] or [target utterance, context] per item
+    single_sentence -- whether the context is left out
+    encoder -- see `load_encoder`
+
+    Keyword arguments:
+    all_layers -- keep every hidden layer instead of ELMO_LAYER/BERT_LAYER
+    out, out_idx -- where to write the embeddings, see `models.scatter_batches`
+    cfg -- the configuration to encode with, default: the cfg of this module
+
+    Return:
+    embs -- `out`, or a new tensor, (items, embedding_shape) or (layers, items, ...)
+    sen_len -- number of tokens of each item
+    """
+    inputs = encoder_inputs(item_texts, single_sentence, encoder, cfg=cfg)
+    return encode_inputs(inputs, single_sentence, encoder, all_layers=all_layers, out=out, out_idx=out_idx,
+                         cfg=cfg)
+
+
+def load_embeddings(items, item_texts, single_sentence, data_path, cfg=None):
+    """Gather the embeddings of the items from the cache, encoding the missing ones
+
+    Positional arguments:
+    items -- list of [item ID, text hash] pairs
+    item_texts -- [target utterance] or [target utterance, context] per item
+    single_sentence -- whether the context is left out
+    data_path -- directory holding the cache
+
+    Keyword arguments:
+    cfg -- the configuration to load with, default: the cfg of this module
+
+    Return:
+    word_embs_np -- lazy view on the rows of the items in the memory-mapped store
+    sen_len -- number of tokens of each item
+    store -- (path to the store, layer to slice or None, rows of the items),
+             enough for another process to open the same view
+    """
+    cfg = resolve_cfg(cfg)
+    max_context_utterances = cfg.MAX_CONTEXT_UTTERANCES if cfg.MAX_CONTEXT_UTTERANCES > -1 else None
+
+    # type of pre-trained word embedding
+    emb_layer = None
+    if cfg.IS_ELMO:
+        encoder_name = 'elmo_2x4096_512_2048cnn_2xhighway'
+        emb_layer = cfg.ELMO_LAYER
+    elif cfg.IS_BERT:
+        encoder_name = 'bert-large-uncased' if cfg.BERT_LARGE else 'bert-base-uncased'
+        emb_layer = cfg.BERT_LAYER
+    else:  # default: GloVe
+        encoder_name = 'glove.6B.' + format(cfg.GLOVE_DIM) + 'd'
+    seq_len = encoder_seq_len(single_sentence, cfg)
+
+    # everything that changes the embeddings goes into the cache key
+    cache_root = os.path.join(data_path, 'cache')
+    cache_key = {'encoder': encoder_name,
+                 'lstm': cfg.LSTM.FLAG,
+                 'seq_len': seq_len if cfg.LSTM.FLAG else None,
+                 'single_sentence': single_sentence,
+                 'max_context_utterances': max_context_utterances,
+                 'context_len': 120 if cfg.IS_BERT and not single_sentence else None,
+                 'preprocess_version': PREPROCESS_VERSION}
+    if cfg.IS_ELMO or cfg.IS_BERT:
+        cache_key['extract_version'] = EXTRACT_VERSION
+    cache = EmbeddingCache(cache_root, dict(cache_key, layer=emb_layer, dtype=cfg.CACHE_DTYPE))
+    cache_dtype = cfg.CACHE_DTYPE
+
+    # a store with every hidden layer serves all ELMO_LAYER/BERT_LAYER values;
+    # use it if asked to, or if it is there and the single-layer cache is not
+    all_layers = False
+    if emb_layer is not None:
+        all_layers_cache = EmbeddingCache(cache_root, dict(cache_key, layer='all', dtype='float16'))
+        all_layers = cfg.CACHE_ALL_LAYERS or (not cache.has(items) and all_layers_cache.has(items))
+        if all_layers:
+            cache, cache_dtype = all_layers_cache, 'float16'
+    print(cache.cache_dir)
+    logging.info(f'Path to the current word embeddings: {cache.cache_dir}')
+
+    # avoid redundant work if we've generated embeddings already (in previous runs),
+    # for this or any other seed/split
+    rows = cache.lookup(items)
+    todo = [pos for (pos, row) in enumerate(rows) if row is None]
+    if todo:
+        logging.info(f'{len(items) - len(todo)} items found in the cache, computing {len(todo)}.')
+        # items go on the second axis of the all-layers store
+        item_axis = 1 if all_layers else 0
+
+        # Generate and save ELMo/BERT/GloVe word-level embeddings
+        encoder = load_encoder(cfg)
+        if cfg.IS_BERT:
+            # tokenizations are shared by all caches and the analysis scripts
+            encoder.bert_tokenizer = TokenCache(os.path.join(cache_root, 'tokens'), encoder_name,
+                                                encoder.bert_tokenizer)
+        all_embs, all_len, new_items, done = cache.extend([items[pos] for pos in todo],
+                                                          row_shape=embedding_shape(encoder, single_sentence,
+                                                                                    all_layers, cfg),
+                                                          dtype=cache_dtype, item_axis=item_axis)
+        # an interrupted run may have put the new items in another order
+        todo_pos = {tuple(items[pos]): pos for pos in todo}
+        todo = [todo_pos[tuple(it)] for it in new_items]
+        # the new items are appended after the stored ones
+        new_rows = list(range(len(cache.index), len(cache.index) + len(todo)))
+        new_texts = [item_texts[pos] for pos in todo[done:]]
+        if cfg.IS_ELMO or cfg.IS_BERT:
+            # tokenization, encoding and writing overlap; finished chunks are journaled
+            def save_chunk(positions, sen_len):
+                all_len[[new_rows[done + k] for k in positions]] = [sen_len[k] for k in positions]
+                cache.save_progress(all_embs, all_len, done + positions.stop)
+
+            extract_embeddings(cfg, new_texts, single_sentence, encoder, all_embs, new_rows[done:],
+                               all_layers=all_layers, on_chunk=save_chunk)
+        else:
+            _, new_len = encode_items(new_texts, single_sentence, encoder,
+                                      all_layers=all_layers, out=all_embs, out_idx=new_rows[done:], cfg=cfg)
+            all_len[new_rows[done:]] = new_len
+        cache.commit(new_items, all_embs, all_len)
+        if cfg.IS_BERT:
+            encoder.bert_tokenizer.save()
+        del all_embs
+        rows = cache.lookup(items)
+
+    # memory-map the store and gather this split's rows from it lazily
+    all_embs = np.load(cache.embs_path, mmap_mode='r')
+    if all_layers:
+        logging.info(f'Slicing layer {emb_layer} from the all-layers store.')
+        all_embs = all_embs[emb_layer]
+    word_embs_np = RowSubset(all_embs, rows)
+    sen_len = np.load(cache.len_path)[rows].tolist()
+    store = (cache.embs_path, emb_layer if all_layers else None, np.array(rows))
+    return word_embs_np, sen_len, store
+
+
+def load_split(split, data_path, cfg=None):
+    """Load one split (train/test/all) of the seed in cfg and the embeddings of its items
+
+    Keyword arguments:
+    cfg -- the configuration to load with, default: the cfg of this module
+
+    Return:
+    labels -- normalized labels
+    sen_len -- number of tokens of each item
+    store -- see `load_embeddings`
+    """
+    cfg = resolve_cfg(cfg)
+    curr_path = data_path + "/seed_" + str(cfg.SEED)
+    if cfg.SPLIT_NAME != "":
+        curr_path = os.path.join(curr_path, cfg.SPLIT_NAME)
+    load_db = curr_path + "/" + split + "_db.csv"
+    if not os.path.isfile(load_db):
+        split_train_test(cfg.SEED, curr_path)
+    labels, target_utterances, contexts = load_dataset(cfg.SOME_DATABASE,
+                                                       load_db,
+                                                       "./corpus_data/swbdext.csv",
+                                                       cfg.PREDICTION_TYPE)
+    max_diff = cfg.MAX_VALUE - cfg.MIN_VALUE
+    normalized_labels = np.array([(float(v) - cfg.MIN_VALUE) / max_diff for v in labels.values()])
+    items, item_texts = item_inputs(target_utterances, contexts, cfg.SINGLE_SENTENCE)
+    _, sen_len, store = load_embeddings(items, item_texts, cfg.SINGLE_SENTENCE, data_path, cfg=cfg)
+    return normalized_labels, np.array(sen_len), store
+
+
+def ranking_manifest(eval_path, cv_only=False):
+    """Path of the manifest EVAL.SELECT 'top_k' ranks epochs by, None if there is none
+
+    cfg.EVAL.MANIFEST if set, else the fold averages of a cross-validation run
+    (cv_metrics.json in `eval_path`), else the metrics.json of a run with a
+    validation set, unless `cv_only`
+    """
+    if cfg.EVAL.MANIFEST:
+        return cfg.EVAL.MANIFEST
+    for name in ['cv_metrics.json'] if cv_only else ['cv_metrics.json', 'metrics.json']:
+        if os.path.isfile(os.path.join(eval_path, name)):
+            return os.path.join(eval_path, name)
+    return None
+
+
+def epoch_checkpoint(eval_path, epoch):
+    """The checkpoint of `epoch` in 'Model', else in 'Best Model'; None if neither has one"""
+    for model_dir in ['Model', 'Best Model']:
+        checkpoint = os.path.join(eval_path, model_dir, f'RNet_epoch_{epoch}.pth')
+        if os.path.isfile(checkpoint):
+            return checkpoint
+    return None
+
+
+def select_epochs(epoch_lst, eval_path):
+    """Restrict the epochs to test as asked by cfg.EVAL.SELECT
+
+    'all' -- every saved epoch in `epoch_lst`
+    'epochs' -- the epochs listed in cfg.EVAL.EPOCHS
+    'top_k' -- the cfg.EVAL.TOP_K epochs with the highest validation r in
+               the manifest of `ranking_manifest`; the ones without a
+               checkpoint in 'Model' or 'Best Model' are left out with a warning
+    """
+    if cfg.EVAL.SELECT == 'epochs':
+        return list(cfg.EVAL.EPOCHS)
+    if cfg.EVAL.SELECT == 'top_k':
+        manifest_path = ranking_manifest(eval_path) or os.path.join(eval_path, 'metrics.json')
+        selected = top_epochs(load_manifest(manifest_path)['epochs'], cfg.EVAL.TOP_K)
+        if not selected:
+            raise ValueError(f'No epoch has a validation r in {manifest_path}, so EVAL.SELECT '
+                             f'\'top_k\' cannot rank them. Point EVAL.MANIFEST at the cv_metrics.json of a '
+                             f'cross-validation run, or use EVAL.SELECT \'all\' or \'epochs\'.')
+        logging.info(f'Top {cfg.EVAL.TOP_K} epochs in {manifest_path}: '
+                     f'{[(e["epoch"], round(e["val_r"], 4)) for e in selected]}')
+        missing = [e['epoch'] for e in selected if epoch_checkpoint(eval_path, e['epoch']) is None]
+        if missing:
+            logging.warning(f'No checkpoint of the top epochs {missing} in {eval_path}, testing without them. '
+                            f'Training on all the data with EVAL.SELECT \'top_k\' saves them.')
+        selected = [e['epoch'] for e in selected if e['epoch'] not in missing]
+        if not selected:
+            raise ValueError(f'None of the top {cfg.EVAL.TOP_K} epochs has a checkpoint in {eval_path}.')
+        return sorted(selected)
+    return epoch_lst
+
+
 def main():
     ##################
     # Initialization #
     ##################
+    start_t = time.time()
     parser = argparse.ArgumentParser(
         description='Run ...')
     parser.add_argument('--conf', dest='config_file', default='unspecified')
@@ -252,126 +598,18 @@ def main():
     ###################################
     # obtain pre-trained word vectors #
     ###################################
-    sen_len = []
-    word_embs = []
-    word_embs_np = None
-    word_embs_stack = None
-    
-    max_context_utterances = cfg.MAX_CONTEXT_UTTERANCES if cfg.MAX_CONTEXT_UTTERANCES > -1 else None
-    
-    NUMPY_DIR = opt.data_path + '/seed_' + str(cfg.SEED)
-    # is contextual or not
-    if not cfg.SINGLE_SENTENCE:
-        NUMPY_DIR += '_contextual'
-    # if limit the number of utterances in context
-    if max_context_utterances:
-        NUMPY_DIR += "_" + str(max_context_utterances) + '_utt'
+    single_sentence = cfg.SINGLE_SENTENCE or cfg.MODE == 'qual'
 
-    # type of pre-trained word embedding
-    if cfg.IS_ELMO:
-        NUMPY_DIR += '/elmo_' + "layer_" + str(cfg.ELMO_LAYER)
-    elif cfg.IS_BERT:
-        NUMPY_DIR += '/bert_'
-        if cfg.BERT_LARGE:
-            NUMPY_DIR += "large"
-        NUMPY_DIR += "layer_" + str(cfg.BERT_LAYER)
-    else:  # default: GloVe
-        NUMPY_DIR += '/glove'
-
-    # use LSTM or avg to get sentence-level embedding
-    if cfg.LSTM.FLAG:
-        NUMPY_DIR += '_lstm'
-        NUMPY_PATH = NUMPY_DIR + '/embs_' + cfg.PREDON + '_' + format(cfg.LSTM.SEQ_LEN) + '.npy'
-        LENGTH_PATH = NUMPY_DIR + '/len_' + cfg.PREDON + '_' + format(cfg.LSTM.SEQ_LEN) + '.npy'
-    else:
-        NUMPY_PATH = NUMPY_DIR + '/embs_' + cfg.PREDON + '.npy'
-        LENGTH_PATH = NUMPY_DIR + '/len_' + cfg.PREDON + '.npy'
-    mkdir_p(NUMPY_DIR)
-    print(NUMPY_PATH)
-    logging.info(f'Path to the current word embeddings: {NUMPY_PATH}')
-
-    # avoid redundant work if we've generated embeddings already (in previous runs)
-    if os.path.isfile(NUMPY_PATH):
-        word_embs_np = np.load(NUMPY_PATH)
-        len_np = np.load(LENGTH_PATH)
-        sen_len = len_np.tolist()
-        word_embs_stack = torch.from_numpy(word_embs_np)
+    # cache entries are identified by item ID and a hash of the text we encode
+    if cfg.MODE == 'qual':
+        item_ids = list(sentences)
+        item_texts = [[input_text] for input_text in sentences]
+        items = [[k, content_hash(t)] for (k, t) in zip(item_ids, item_texts)]
     else:
-        # Generate and save ELMo/BERT/GloVe word-level embeddings
-        if cfg.IS_ELMO:
-            ELMO_EMBEDDER = ElmoEmbedder()
-        if cfg.IS_BERT:
-            from transformers import BertTokenizer, BertModel
-            bert_model = 'bert-large-uncased' if cfg.BERT_LARGE else 'bert-base-uncased'
-            bert_tokenizer = BertTokenizer.from_pretrained(bert_model)
-            bert_model = BertModel.from_pretrained(bert_model, output_hidden_states=True)
-            bert_model.eval()
-            if cfg.CUDA:
-                bert_model = bert_model.cuda()
-        if cfg.MODE == 'qual':
-            # TODO: currently only BERT, in future maybe need other embedding methods as well
-            from models import get_sentence_bert
-            for input_text in sentences:
-                curr_emb, l = get_sentence_bert(input_text,
-                                                bert_tokenizer,
-                                                bert_model,
-                                                layer=cfg.BERT_LAYER,
-                                                GPU=cfg.CUDA,
-                                                LSTM=cfg.LSTM.FLAG,
-                                                max_seq_len=cfg.LSTM.SEQ_LEN,
-                                                is_single=cfg.SINGLE_SENTENCE)
-                sen_len.append(l)
-                word_embs.append(curr_emb)
-        else:
-            for (k, v) in tqdm(target_utterances.items(), total=len(target_utterances)):
-                context_v = contexts[k]
-                if cfg.SINGLE_SENTENCE:
-                    # only including the target utterance
-                    input_text = v[0]
-                else:
-                    # discourse context + target utterance
-                    input_text = context_v[0] + v[0]
-                if cfg.IS_ELMO:
-                    from models import get_sentence_elmo
-                    embedder = ELMO_EMBEDDER
-                    curr_emb, l = get_sentence_elmo(v[0], context_v[0], embedder=embedder,
-                                                    layer=cfg.ELMO_LAYER,
-                                                    not_contextual=cfg.SINGLE_SENTENCE,
-                                                    LSTM=cfg.LSTM.FLAG,
-                                                    seq_len=cfg.LSTM.SEQ_LEN)
-                elif cfg.IS_BERT:
-                    if cfg.SINGLE_SENTENCE:
-                        from models import get_sentence_bert
-                        curr_emb, l = get_sentence_bert(input_text,
-                                                        bert_tokenizer,
-                                                        bert_model,
-                                                        layer=cfg.BERT_LAYER,
-                                                        GPU=cfg.CUDA,
-                                                        LSTM=cfg.LSTM.FLAG,
-                                                        max_seq_len=cfg.LSTM.SEQ_LEN,
-                                                        is_single=cfg.SINGLE_SENTENCE)
-                    else:
-                        from models import get_sentence_bert_context
-                        curr_emb, l = get_sentence_bert_context(v[0],
-                                                                context_v[0],
-                                                                bert_tokenizer,
-                                                                bert_model,
-                                                                layer=cfg.BERT_LAYER,
-                                                                GPU=cfg.CUDA,
-                                                                LSTM=cfg.LSTM.FLAG,
-                                                                max_sentence_len=30,
-                                                                max_context_len=120,
-                                                                max_context_utterances=max_context_utterances)
-                else:
-                    from models import get_sentence_glove
-                    curr_emb, l = get_sentence_glove(input_text, LSTM=cfg.LSTM.FLAG,
-                                                     not_contextual=cfg.SINGLE_SENTENCE,
-                                                     seq_len=cfg.LSTM.SEQ_LEN)
-                sen_len.append(l)
-                word_embs.append(curr_emb)
-        np.save(LENGTH_PATH, np.array(sen_len))
-        word_embs_stack = torch.stack(word_embs)
-        np.save(NUMPY_PATH, word_embs_stack.numpy())
+        items, item_texts = item_inputs(target_utterances, contexts, single_sentence)
+
+    word_embs_np, sen_len, store = load_embeddings(items, item_texts, single_sentence, opt.data_path)
+    logging.info(f'Embeddings ready after {(time.time()-start_t):.2f}sec.')
 
     #  If want to experiment with random-value embeddings
     fake_embs = None
@@ -396,35 +634,24 @@ def main():
             X, y, L = dict(), dict(), dict()
             if not cfg.CROSS_VALIDATION_FLAG:
                 cfg.BATCH_ITEM_NUM = len(normalized_labels)//cfg.TRAIN.BATCH_SIZE
-                X["train"], X["val"] = word_embs_stack.float(), None
+                X["train"], X["val"] = word_embs_np, None
                 y["train"], y["val"] = np.array(normalized_labels), None
                 L["train"], L["val"] = sen_len, None
                 r_model = RatingModel(cfg, save_path)
+                manifest_path = ranking_manifest(save_path, cv_only=True)
+                if cfg.EVAL.SELECT == 'top_k' and manifest_path is not None:
+                    # test mode picks these epochs, which are not all multiples of TRAIN.INTERVAL
+                    r_model.save_epochs = {e['epoch'] for e in
+                                           top_epochs(load_manifest(manifest_path)['epochs'], cfg.EVAL.TOP_K)}
+                    logging.info(f'Also saving the top {cfg.EVAL.TOP_K} epochs in {manifest_path}: '
+                                 f'{sorted(r_model.save_epochs)}')
                 r_model.train(X, y, L)
             else:
-                # train with k folds cross validation
-                train_loss_history = np.zeros((cfg.TRAIN.TOTAL_EPOCH, cfg.KFOLDS))
-                val_loss_history = np.zeros((cfg.TRAIN.TOTAL_EPOCH, cfg.KFOLDS))
-                val_r_history = np.zeros((cfg.TRAIN.TOTAL_EPOCH, cfg.KFOLDS))
-                normalized_labels = np.array(normalized_labels)
-                sen_len_np = np.array(sen_len)
-                fold_cnt = 1
-                for train_idx, val_idx in k_folds_idx(cfg.KFOLDS, len(normalized_labels), cfg.SEED):
-                    logging.info(f'Fold #{fold_cnt}\n- - - - - - - - - - - - -')
-                    save_sub_path = os.path.join(save_path, format(fold_cnt))
-                    X_train, X_val = word_embs_stack[train_idx], word_embs_stack[val_idx]
-                    y_train, y_val = normalized_labels[train_idx], normalized_labels[val_idx]
-                    L_train, L_val = sen_len_np[train_idx].tolist(), sen_len_np[val_idx].tolist()
-                    X["train"], X["val"] = X_train, X_val
-                    y["train"], y["val"] = y_train, y_val
-                    L["train"], L["val"] = L_train, L_val
-                    cfg.BATCH_ITEM_NUM = len(L_train)//cfg.TRAIN.BATCH_SIZE
-                    r_model = RatingModel(cfg, save_sub_path)
-                    r_model.train(X, y, L)
-                    train_loss_history[:, fold_cnt-1] = np.array(r_model.train_loss_history)
-                    val_loss_history[:, fold_cnt-1] = np.array(r_model.val_loss_history)
-                    val_r_history[:, fold_cnt-1] = np.array(r_model.val_r_history)
-                    fold_cnt += 1
+                # train with k folds cross validation, cfg.CV_WORKERS folds at a time
+                folds = k_folds_idx(cfg.KFOLDS, len(normalized_labels), cfg.SEED)
+                train_loss_history, val_loss_history, val_r_history = \
+                    run_folds(cfg, folds, store, np.array(normalized_labels), np.array(sen_len),
+                              save_path, log_file=file_handler.baseFilename)
                 train_loss_mean = np.mean(train_loss_history, axis=1).tolist()
                 val_loss_mean = np.mean(val_loss_history, axis=1).tolist()
                 val_r_mean = np.mean(val_r_history, axis=1).tolist()
@@ -434,13 +661,21 @@ def main():
                 logging.info(f'Avg. train loss: {train_loss_mean}')
                 logging.info(f'Avg. validation loss: {val_loss_mean}')
                 logging.info(f'Avg. validation r: {val_r_mean}')
+                # the fold averages, from which test mode can pick its epochs; a run on
+                # all the training data later writes its own metrics.json next to them
+                epochs = [{'epoch': cfg.TRAIN.START_EPOCH + e + 1, 'train_loss': train_loss_mean[e],
+                           'val_loss': val_loss_mean[e], 'val_r': val_r_mean[e]}
+                          for e in range(len(val_r_mean))]
+                save_manifest(os.path.join(save_path, 'cv_metrics.json'),
+                              {'folds': cfg.KFOLDS, 'epochs': epochs,
+                               'best': top_epochs(epochs, cfg.TRAIN.BEST_K)})
     elif cfg.MODE == 'qual':
         logging.info("Start qualitative analysis\n===============================")
         best_path = cfg.OUT_PATH + cfg.EXPERIMENT_NAME
         load_path = os.path.join(best_path, "Model")
         cfg.RESUME_DIR = load_path + "/RNet_epoch_" + format(cfg.EVAL.BEST_EPOCH)+ ".pth"
         best_model = RatingModel(cfg, best_path)
-        preds, attn_weights = best_model.evaluate(word_embs_stack.float(), max_diff, cfg.MIN_VALUE, sen_len)
+        preds, attn_weights = best_model.evaluate(word_embs_np, max_diff, cfg.MIN_VALUE, sen_len)
         if cfg.LSTM.ATTN:
             attn_path = os.path.join(best_path, "Attention")
             mkdir_p(attn_path)
@@ -451,16 +686,9 @@ def main():
             pred_file_path = best_path + '/Preds'
             mkdir_p(pred_file_path)
             new_file_name = pred_file_path + '/qualitative_results.csv'
-            f = open(new_file_name, 'w')
-            head_line = "Sentence,predicted\n"
             logging.info(f'Start writing predictions to file:\n{new_file_name}\n...')
-            f.write(head_line)
-            for i in range(len(sentences)):
-                k = sentences[i]
-                pre = preds[i]
-                curr_line = k + ',' + format(pre)
-                f.write(curr_line+"\n")
-            f.close()
+            # sentences with commas or quotes are quoted
+            pd.DataFrame({'Sentence': sentences, 'predicted': preds}).to_csv(new_file_name, index=False)
     else:
         eval_path = cfg.OUT_PATH + cfg.EXPERIMENT_NAME
         epoch_lst = [0, 1]
@@ -468,6 +696,7 @@ def main():
         while i < cfg.TRAIN.TOTAL_EPOCH - cfg.TRAIN.INTERVAL + 1:
             i += cfg.TRAIN.INTERVAL
             epoch_lst.append(i)
+        epoch_lst = select_epochs(epoch_lst, eval_path)
         logging.info(f'epochs to test: {epoch_lst}')
         if cfg.IS_RANDOM:
             eval_path += "_random"
@@ -482,10 +711,14 @@ def main():
             max_value = -1.0
             max_epoch = None
             curr_coeff_lst = []
-            for epoch in epoch_lst:
-                cfg.RESUME_DIR = load_path + "/RNet_epoch_" + format(epoch)+ ".pth"
-                eval_model = RatingModel(cfg, eval_path)
-                preds, attn_weights = eval_model.evaluate(word_embs_stack.float(), max_diff, cfg.MIN_VALUE, sen_len)
+            # one network and one set of input batches for all checkpoints
+            checkpoints = [epoch_checkpoint(eval_path, epoch) or load_path + "/RNet_epoch_" + format(epoch) + ".pth"
+                           for epoch in epoch_lst]
+            eval_model = RatingModel(cfg, eval_path)
+            evaluated = eval_model.evaluate_checkpoints(word_embs_np, max_diff, cfg.MIN_VALUE, sen_len,
+                                                        checkpoints, workers=cfg.EVAL.WORKERS, store=store)
+            for epoch, (checkpoint, preds, attn_weights) in zip(epoch_lst, evaluated):
+                cfg.RESUME_DIR = checkpoint
 
                 if cfg.LSTM.ATTN:
                     attn_path = os.path.join(eval_path, "Attention")
@@ -0,0 +1,218 @@
+"""Stream-score a large corpus of utterances
+
+Usage: python ./code/score.py --conf=CONF.yml --input=UTTERANCES --output=scores.csv [--epoch=N]
+
+The input is a text file with one utterance per line, or a .csv/.tsv file
+with a --sentence_col column (and optionally --context_col and --id_col).
+It is read in chunks of --chunk_size items, which go through three stages
+running concurrently: tokenization, encoding, and scoring plus writing. The
+stages are connected by bounded queues, so memory use does not grow with
+the input. The scores of every chunk are appended to a quoted CSV file (or,
+with --format=parquet, written as one Parquet file per chunk in the output
+directory) and the progress is saved next to the output. An interrupted run
+continues after the last written chunk when started again with the same
+arguments. As in serve.py, an LSTM scores from a zero initial state in place
+of a random one, so the same utterance always gets the same score.
+"""
+import argparse
+import csv
+import glob
+import itertools
+import logging
+import os
+import time
+
+import pandas as pd
+import torch
+
+import run
+from run import cfg
+from serve import Predictor, best_checkpoint
+from utils import mkdir_p, save_manifest, load_manifest, pipeline
+
+
+def read_chunks(path, chunk_size, skip=0, sentence_col='Sentence', context_col=None, id_col=None):
+    """Read the input in chunks of at most `chunk_size` items, skipping the first `skip`
+
+    Yield:
+    ids -- item IDs, or line/row numbers (from 0) without `id_col`
+    item_texts -- [sentence, context] per item, the context is '' without `context_col`
+    """
+    if os.path.splitext(path)[1] not in ('.csv', '.tsv'):
+        with open(path, 'r') as f:
+            lines = itertools.islice((line.rstrip('\n') for line in f), skip, None)
+            row = skip
+            for chunk in iter(lambda: list(itertools.islice(lines, chunk_size)), []):
+                yield list(range(row, row + len(chunk))), [[s, ''] for s in chunk]
+                row += len(chunk)
+        return
+    sep = '\t' if path.endswith('.tsv') else ','
+    reader = pd.read_csv(path, sep=sep, dtype=str, keep_default_na=False, chunksize=chunk_size)
+    row = 0
+    for df in reader:
+        # records, not lines, are skipped: quoted fields can span several lines
+        if row + len(df) <= skip:
+            row += len(df)
+            continue
+        if row < skip:
+            df = df.iloc[skip - row:]
+            row = skip
+        ids = df[id_col].tolist() if id_col else list(range(row, row + len(df)))
+        sentences = df[sentence_col].tolist()
+        if context_col:
+            item_texts = [[s, c] for (s, c) in zip(sentences, df[context_col].tolist())]
+        else:
+            item_texts = [[s, ''] for s in sentences]
+        yield ids, item_texts
+        row += len(df)
+
+
+class CSVWriter(object):
+    """Append scored chunks to a quoted CSV file"""
+
+    def __init__(self, path, progress):
+        self.path = path
+        if progress is None:
+            self.f = open(path, 'w', newline='')
+            csv.writer(self.f).writerow(['Item', 'Sentence', 'predicted'])
+        else:
+            # drop whatever was written after the last saved chunk
+            self.f = open(path, 'r+', newline='')
+            self.f.truncate(progress['bytes'])
+            self.f.seek(progress['bytes'])
+        self.writer = csv.writer(self.f)
+
+    @staticmethod
+    def resumable(path, progress):
+        """Whether `path` still holds what `progress` records"""
+        return os.path.isfile(path) and os.path.getsize(path) >= progress['bytes']
+
+    def write(self, ids, item_texts, preds):
+        self.writer.writerows(zip(ids, (texts[0] for texts in item_texts), preds.tolist()))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def state(self):
+        """What the progress records to resume"""
+        return {'bytes': self.f.tell()}
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter(object):
+    """Write every scored chunk to its own Parquet file in a directory"""
+
+    def __init__(self, path, progress):
+        # fail before any work without pyarrow/fastparquet
+        pd.io.parquet.get_engine('auto')
+        self.path = path
+        self.parts = progress['parts'] if progress else 0
+        mkdir_p(path)
+        # drop the parts written after the last saved chunk
+        for part in sorted(glob.glob(os.path.join(path, 'part-*.parquet')))[self.parts:]:
+            os.remove(part)
+
+    @staticmethod
+    def resumable(path, progress):
+        return len(glob.glob(os.path.join(path, 'part-*.parquet'))) >= progress['parts']
+
+    def write(self, ids, item_texts, preds):
+        df = pd.DataFrame({'Item': ids, 'Sentence': [texts[0] for texts in item_texts],
+                           'predicted': preds})
+        df.to_parquet(os.path.join(self.path, f'part-{self.parts:06d}.parquet'), index=False)
+        self.parts += 1
+
+    def state(self):
+        return {'parts': self.parts}
+
+    def close(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score a large corpus of utterances')
+    parser.add_argument('--conf', dest='config_file', default='unspecified')
+    parser.add_argument('--input', dest='input', required=True)
+    parser.add_argument('--output', dest='output', required=True)
+    parser.add_argument('--format', dest='format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--sentence_col', dest='sentence_col', default='Sentence')
+    parser.add_argument('--context_col', dest='context_col', default=None)
+    parser.add_argument('--id_col', dest='id_col', default=None)
+    parser.add_argument('--chunk_size', dest='chunk_size', type=int, default=1024)
+    parser.add_argument('--epoch', dest='epoch', type=int, default=None,
+                        help='epoch of the checkpoint in Model/, default: the best one in metrics.json')
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None, help='path of the checkpoint')
+    parser.add_argument('--out_path', dest='out_path', default=None)
+    parser.add_argument('--restart', dest='restart', action='store_true',
+                        help='ignore the saved progress and start from the first item')
+    opt = parser.parse_args()
+
+    if opt.config_file != "unspecified":
+        run.cfg_setup(opt.config_file)
+    if opt.out_path is not None:
+        cfg.OUT_PATH = opt.out_path
+    logging.basicConfig(level=logging.INFO)
+    torch.manual_seed(cfg.SEED)
+
+    # the progress is only valid for the same input, checkpoint and output format
+    exp_path = cfg.OUT_PATH + cfg.EXPERIMENT_NAME
+    checkpoint = opt.checkpoint
+    if checkpoint is None and opt.epoch is not None:
+        checkpoint = os.path.join(exp_path, "Model", f"RNet_epoch_{opt.epoch}.pth")
+    checkpoint = checkpoint or best_checkpoint(exp_path)
+    job = {'input': os.path.abspath(opt.input), 'checkpoint': os.path.abspath(checkpoint),
+           'format': opt.format, 'chunk_size': opt.chunk_size}
+    progress_path = opt.output.rstrip('/') + '.progress.json'
+    writer_class = ParquetWriter if opt.format == 'parquet' else CSVWriter
+    progress = None
+    if os.path.isfile(progress_path) and not opt.restart:
+        progress = load_manifest(progress_path)
+        if progress['job'] != job:
+            raise SystemExit(f'{progress_path} belongs to another job ({progress["job"]}), '
+                             f'use --restart to start over.')
+        if not writer_class.resumable(opt.output, progress):
+            logging.warning(f'{opt.output} is missing or shorter than {progress_path} records, '
+                            f'starting over.')
+            progress = None
+    if progress is not None:
+        if progress['done']:
+            logging.info(f'All {progress["rows"]} items are already scored in {opt.output}.')
+            return
+        logging.info(f'Resuming after {progress["rows"]} items.')
+    skip = progress['rows'] if progress else 0
+
+    writer = writer_class(opt.output, progress)
+    predictor = Predictor(checkpoint)
+
+    def tokenize(chunk):
+        ids, item_texts = chunk
+        texts = [t[:1] for t in item_texts] if cfg.SINGLE_SENTENCE else item_texts
+        return ids, item_texts, run.encoder_inputs(texts, cfg.SINGLE_SENTENCE, predictor.encoder)
+
+    def encode(chunk):
+        ids, item_texts, inputs = chunk
+        with torch.no_grad():
+            embs, sen_len = run.encode_inputs(inputs, cfg.SINGLE_SENTENCE, predictor.encoder)
+        return ids, item_texts, embs, sen_len
+
+    start_t = time.time()
+    rows = skip
+    chunks = read_chunks(opt.input, opt.chunk_size, skip, opt.sentence_col, opt.context_col, opt.id_col)
+    stats = []
+    for ids, item_texts, embs, sen_len in pipeline(chunks, [('tokenize', tokenize), ('encode', encode)],
+                                                   stats=stats):
+        preds, _ = predictor.score(embs, sen_len)
+        writer.write(ids, item_texts, preds)
+        rows += len(ids)
+        save_manifest(progress_path, dict(writer.state(), job=job, rows=rows, done=False))
+        logging.info(f'{rows} items scored, {(rows - skip) / (time.time() - start_t):.1f} items/sec')
+    save_manifest(progress_path, dict(writer.state(), job=job, rows=rows, done=True))
+    writer.close()
+    for stage_stats in stats:
+        logging.info(f'Stage {stage_stats}')
+    logging.info(f'Wrote the scores of {rows} items to {opt.output} after {(time.time()-start_t):.2f}sec.')
+
+
+if __name__ == "__main__":
+    main()
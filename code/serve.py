@@ -0,0 +1,254 @@
+"""Online prediction service for implicature strength ratings
+
+Usage: python ./code/serve.py --conf=CONF.yml [--epoch=N | --checkpoint=PATH] [--port=8000]
+
+The encoder and the checkpoint are loaded once. Requests are JSON:
+    POST /predict  {"sentence": "...", "context": "..."}
+                   {"items": [{"sentence": "...", "context": "..."}, ...]}
+    GET  /health
+The context is optional, and only used by models trained with it
+(SINGLE_SENTENCE: False). Every item gets its predicted "rating", plus its
+"attention" weights (one per token) when LSTM.ATTN is set. An LSTM starts
+from its zero or learned initial state (zeros replace a random one). Items of
+concurrent requests are encoded and scored together, in batches of up to
+--max_batch_size items collected for at most --max_wait_ms.
+"""
+import argparse
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import torch
+
+import run
+from run import cfg
+from models import RatingModel
+from utils import load_manifest
+
+
+def best_checkpoint(exp_path):
+    """The best checkpoint in the metrics.json of `exp_path`, else the one of cfg.EVAL.BEST_EPOCH"""
+    manifest_path = os.path.join(exp_path, 'metrics.json')
+    if os.path.isfile(manifest_path):
+        best = load_manifest(manifest_path).get('best', [])
+        if best and 'checkpoint' in best[0]:
+            return os.path.join(exp_path, best[0]['checkpoint'])
+    return os.path.join(exp_path, "Model", f"RNet_epoch_{cfg.EVAL.BEST_EPOCH}.pth")
+
+
+class Predictor(object):
+    """The encoder and rating model of cfg, loaded once
+
+    An LSTM trained from random initial states (LSTM.INIT_STATE 'random')
+    predicts from zero ones, like the exported model, so that the same item
+    always gets the same rating.
+    """
+
+    def __init__(self, checkpoint):
+        cfg.TRAIN.FLAG = False
+        cfg.RESUME_DIR = checkpoint
+        if cfg.LSTM.FLAG and cfg.LSTM.INIT_STATE == 'random':
+            logging.warning('Predicting from a zero initial LSTM state instead of the random one of '
+                            'LSTM.INIT_STATE, so the predictions are deterministic.')
+            cfg.LSTM.INIT_STATE = 'zero'
+        self.checkpoint = checkpoint
+        self.encoder = run.load_encoder()
+        self.model = RatingModel(cfg, os.path.dirname(checkpoint))
+        self.model.load_network()
+        self.model.RNet.eval()
+        if cfg.CUDA:
+            self.model.RNet.cuda()
+
+    def item_texts(self, items):
+        """[sentence] or [sentence, context] of {"sentence": ..., "context": ...} items"""
+        if cfg.SINGLE_SENTENCE:
+            return [[item['sentence']] for item in items]
+        return [[item['sentence'], item.get('context', '')] for item in items]
+
+    def score(self, embs, sen_len):
+        """Rescaled predictions and attention weights of encoded items, see `RatingModel.predict`"""
+        return self.model.predict(embs, cfg.MAX_VALUE - cfg.MIN_VALUE, cfg.MIN_VALUE, sen_len)
+
+    def predict(self, items):
+        """Predict the ratings of a list of {"sentence": ..., "context": ...} items"""
+        embs, sen_len = run.encode_items(self.item_texts(items), cfg.SINGLE_SENTENCE, self.encoder)
+        preds, attn = self.score(embs, sen_len)
+        results = []
+        for i in range(len(items)):
+            result = {'rating': float(preds[i])}
+            if cfg.LSTM.FLAG and cfg.LSTM.ATTN:
+                result['attention'] = attn[i, :sen_len[i], 0].tolist()
+            results.append(result)
+        return results
+
+
+class MicroBatcher(object):
+    """Score the items of concurrent requests together
+
+    A worker thread takes the first waiting request, then collects more for
+    up to `max_wait` seconds or until `max_batch_size` items are queued, and
+    scores all of them with one call of `predict_fn`.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait=0.005):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, items):
+        """Queue the items of one request, return a Future of their results"""
+        future = Future()
+        self.requests.put((items, future))
+        return future
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        num_items = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while num_items < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_items += len(request[0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            items = [item for (request_items, _) in batch for item in request_items]
+            try:
+                with torch.no_grad():
+                    results = self.predict_fn(items)
+            except Exception as e:
+                logging.exception(f'Failed to score a batch of {len(items)} items')
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            logging.debug(f'Scored {len(items)} items of {len(batch)} requests')
+            start = 0
+            for request_items, future in batch:
+                future.set_result(results[start:start + len(request_items)])
+                start += len(request_items)
+
+
+def parse_items(request):
+    """The items of a request body, raise ValueError if it is malformed"""
+    if not isinstance(request, dict):
+        raise ValueError('expected a JSON object')
+    items = request['items'] if 'items' in request else [request]
+    if not isinstance(items, list) or not items:
+        raise ValueError('"items" must be a non-empty list')
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('sentence'), str):
+            raise ValueError('every item needs a "sentence" string')
+        if not isinstance(item.get('context', ''), str):
+            raise ValueError('"context" must be a string')
+    return items
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """JSON endpoints, `self.server` holds the batcher and the service info"""
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        self.send_json(200, dict(self.server.info, status='ok'))
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            items = parse_items(request)
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            results = self.server.batcher.submit(items).result()
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        if 'items' in request:
+            self.send_json(200, {'predictions': results})
+        else:
+            self.send_json(200, results[0])
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # room for many clients connecting at once
+    request_queue_size = 128
+
+
+def make_server(predictor, host, port, max_batch_size=32, max_wait=0.005):
+    server = PredictionServer((host, port), PredictionHandler)
+    server.batcher = MicroBatcher(predictor.predict, max_batch_size, max_wait)
+    server.info = {'checkpoint': predictor.checkpoint,
+                   'single_sentence': cfg.SINGLE_SENTENCE,
+                   'attention': bool(cfg.LSTM.FLAG and cfg.LSTM.ATTN)}
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve rating predictions over HTTP')
+    parser.add_argument('--conf', dest='config_file', default='unspecified')
+    parser.add_argument('--epoch', dest='epoch', type=int, default=None,
+                        help='epoch of the checkpoint in Model/, default: the best one in metrics.json')
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None, help='path of the checkpoint')
+    parser.add_argument('--out_path', dest='out_path', default=None)
+    parser.add_argument('--host', dest='host', default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', dest='max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', dest='max_wait_ms', type=float, default=5.0)
+    opt = parser.parse_args()
+
+    if opt.config_file != "unspecified":
+        run.cfg_setup(opt.config_file)
+    if opt.out_path is not None:
+        cfg.OUT_PATH = opt.out_path
+    logging.basicConfig(level=logging.INFO)
+    torch.manual_seed(cfg.SEED)
+
+    exp_path = cfg.OUT_PATH + cfg.EXPERIMENT_NAME
+    checkpoint = opt.checkpoint
+    if checkpoint is None and opt.epoch is not None:
+        checkpoint = os.path.join(exp_path, "Model", f"RNet_epoch_{opt.epoch}.pth")
+    predictor = Predictor(checkpoint or best_checkpoint(exp_path))
+    server = make_server(predictor, opt.host, opt.port, opt.max_batch_size, opt.max_wait_ms / 1000)
+    logging.info(f'Serving {predictor.checkpoint} on http://{opt.host}:{opt.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
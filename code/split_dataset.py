@@ -6,7 +6,6 @@ import os
 
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import KFold
 
 from utils import mkdir_p
 
@@ -94,6 +93,7 @@ def k_folds_idx(k, total_examples, seed_num):
     Return:
     output -- k (train_idx, val_idx) pairs
     """
+    from sklearn.model_selection import KFold
     all_inds = list(range(total_examples))
     cv = KFold(n_splits=k, shuffle=True, random_state=seed_num)
     output = cv.split(all_inds)
@@ -0,0 +1,197 @@
+"""Hyperparameter sweep: cross-validate many configurations in one process
+
+Usage: python ./code/sweep.py --conf=BASE.yml --grid=GRID.yml [--workers=N]
+
+GRID.yml maps configuration fields (dotted for nested ones) to the list of
+values to try, e.g.
+    LSTM.HIDDEN_DIM: [200, 512, 800]
+    LSTM.ATTN: [True, False]
+    TRAIN.LR: [0.001, 0.0001]
+Every combination is cross-validated. Datasets and embedding caches are loaded
+once for all combinations that share them, all (configuration, fold) jobs go
+to one pool of workers, and the averaged learning curves of all combinations
+end up in one table, in the format of analysis/data/all_learning_curves.csv.
+"""
+import argparse
+from copy import deepcopy
+from datetime import datetime
+import itertools
+import logging
+import os
+import pprint
+import random
+import sys
+import time
+
+from easydict import EasyDict as edict
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+
+import run
+from cv import run_jobs
+from split_dataset import k_folds_idx
+from utils import mkdir_p
+
+# the fields that change the loaded dataset or embeddings; configurations
+# that agree on all of them share one load
+DATA_FIELDS = ['SEED', 'SPLIT_NAME', 'SOME_DATABASE', 'PREDICTION_TYPE', 'MAX_VALUE', 'MIN_VALUE',
+               'SINGLE_SENTENCE', 'MAX_CONTEXT_UTTERANCES', 'GLOVE_DIM', 'IS_ELMO', 'IS_BERT',
+               'ELMO_LAYER', 'BERT_LAYER', 'BERT_LARGE', 'CACHE_ALL_LAYERS', 'CACHE_DTYPE',
+               'LSTM.FLAG', 'LSTM.SEQ_LEN']
+
+
+def get_field(cfg, key):
+    for k in key.split('.'):
+        cfg = cfg[k]
+    return cfg
+
+
+def set_field(cfg, key, value):
+    """Set a (dotted) configuration field, with the type checks of `run.merge_yaml`"""
+    new_cfg = edict()
+    curr = new_cfg
+    keys = key.split('.')
+    for k in keys[:-1]:
+        curr[k] = edict()
+        curr = curr[k]
+    curr[keys[-1]] = value
+    try:
+        run.merge_yaml(new_cfg, cfg)
+    except KeyError:
+        raise ValueError(f'Unknown config key: {key}')
+
+
+def expand_grid(base_cfg, grid):
+    """Return the configuration of every combination of the grid values, with the values"""
+    keys = list(grid.keys())
+    points = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        cfg = deepcopy(base_cfg)
+        for k, v in zip(keys, values):
+            set_field(cfg, k, v)
+        points.append((cfg, dict(zip(keys, values))))
+    return points
+
+
+def load_data(cfg, data_path):
+    """Load the training set of `cfg` and its embeddings, see `run.load_split`"""
+    return run.load_split('train', data_path, cfg=cfg)
+
+
+def run_name(cfg, i):
+    """Name of the i-th configuration of the sweep, and of its output directory"""
+    return f'{cfg.CONFIG_NAME or "config"}_{i}'
+
+
+def embedding_name(cfg):
+    if cfg.IS_ELMO:
+        return "elmo"
+    if cfg.IS_BERT:
+        return "bert_large" if cfg.BERT_LARGE else "bert"
+    return "glove"
+
+
+def curve_rows(cfg, name, values, train_loss, val_loss, val_r):
+    """Rows of the results table for one configuration, one per epoch"""
+    rows = []
+    for epoch in range(train_loss.shape[0]):
+        row = {'epoch': epoch,
+               'avg_train_loss': train_loss[epoch],
+               'avg_val_loss': val_loss[epoch],
+               'avg_val_corr': val_r[epoch],
+               'run': name,
+               'lstm_attn': cfg.LSTM.ATTN,
+               'lstm_bidirectional': cfg.LSTM.BIDIRECTION,
+               'lstm_hiddensize': cfg.LSTM.HIDDEN_DIM,
+               'lstm_dropout': cfg.LSTM.DROP_PROB,
+               'lstm_layers': cfg.LSTM.LAYERS,
+               'elmo_layer': cfg.ELMO_LAYER if cfg.IS_ELMO else -1,
+               'bert_layer': cfg.BERT_LAYER if cfg.IS_BERT else -1,
+               'bert_large': cfg.BERT_LARGE,
+               'embedding': embedding_name(cfg),
+               'context': 'Single' if cfg.SINGLE_SENTENCE else 'Context'}
+        row.update(values)
+        rows.append(row)
+    return rows
+
+
+def main():
+    start_t = time.time()
+    parser = argparse.ArgumentParser(description='Run a hyperparameter sweep')
+    parser.add_argument('--conf', dest='config_file', default='unspecified')
+    parser.add_argument('--grid', dest='grid_file', required=True)
+    parser.add_argument('--out_path', dest='out_path', default=None)
+    parser.add_argument('--data_path', dest='data_path', default='./datasets')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='number of jobs trained concurrently, default: cfg.CV_WORKERS')
+    parser.add_argument('--results', dest='results', default=None,
+                        help='path of the results table, default: {OUT_PATH}{EXPERIMENT_NAME}/sweep_results.csv')
+    opt = parser.parse_args()
+
+    if opt.config_file != "unspecified":
+        run.cfg_setup(opt.config_file)
+    if opt.out_path is not None:
+        run.cfg.OUT_PATH = opt.out_path
+    if run.cfg.EXPERIMENT_NAME == '':
+        run.cfg.EXPERIMENT_NAME = datetime.now().strftime('%m_%d_%H_%M')
+    base_cfg = deepcopy(run.cfg)
+    if base_cfg.MODE != 'train' or not base_cfg.CROSS_VALIDATION_FLAG or base_cfg.IS_RANDOM:
+        sys.exit('A sweep cross-validates: use MODE train with CROSS_VALIDATION_FLAG and without IS_RANDOM.')
+    with open(opt.grid_file, 'r') as f:
+        grid = yaml.load(f, Loader=yaml.FullLoader)
+    points = expand_grid(base_cfg, grid)
+
+    save_path = base_cfg.OUT_PATH + base_cfg.EXPERIMENT_NAME
+    log_path = os.path.join(save_path, "Logging")
+    mkdir_p(log_path)
+    logging.basicConfig(level=logging.INFO)
+    file_handler = logging.FileHandler(os.path.join(log_path, "sweep_log.txt"))
+    logging.getLogger().addHandler(file_handler)
+    logging.info('Base configuration:')
+    logging.info(pprint.pformat(base_cfg))
+    logging.info(f'Sweeping {len(points)} configurations over {pprint.pformat(grid)}')
+
+    random.seed(base_cfg.SEED)
+    torch.manual_seed(base_cfg.SEED)
+
+    # one load per distinct dataset/embedding setting, and one job per (configuration, fold)
+    loaded = dict()
+    jobs = []
+    for i, (cfg, values) in enumerate(points):
+        data_key = tuple(repr(get_field(cfg, k)) for k in DATA_FIELDS)
+        if data_key not in loaded:
+            loaded[data_key] = load_data(cfg, opt.data_path)
+        labels, sen_len, store = loaded[data_key]
+        name = run_name(cfg, i)
+        logging.info(f'Configuration {name}: {values}')
+        for fold, (train_idx, val_idx) in enumerate(k_folds_idx(cfg.KFOLDS, len(labels), cfg.SEED), 1):
+            jobs.append((cfg, fold, store, train_idx, val_idx, labels, sen_len,
+                         os.path.join(save_path, name), f'{name}/{fold}'))
+    logging.info(f'{len(loaded)} dataset/embedding loads, {len(jobs)} jobs ready after '
+                 f'{(time.time()-start_t):.2f}sec.')
+
+    workers = base_cfg.CV_WORKERS if opt.workers is None else opt.workers
+    results = iter(run_jobs(jobs, workers, base_cfg.CV_THREADS, file_handler.baseFilename))
+
+    rows = []
+    best = (-float('inf'), None, None)
+    for i, (cfg, values) in enumerate(points):
+        name = run_name(cfg, i)
+        histories = [next(results)[1:] for _ in range(cfg.KFOLDS)]
+        train_loss, val_loss, val_r = [np.mean([h[j] for h in histories], axis=0) for j in range(3)]
+        rows += curve_rows(cfg, name, values, train_loss, val_loss, val_r)
+        max_r_idx = int(np.argmax(val_r))
+        logging.info(f'{name}: highest avg. r={val_r[max_r_idx]:.4f} at epoch {max_r_idx + 1} with {values}')
+        if val_r[max_r_idx] > best[0]:
+            best = (val_r[max_r_idx], name, values)
+
+    results_path = opt.results or os.path.join(save_path, 'sweep_results.csv')
+    pd.DataFrame(rows).to_csv(results_path, index=False)
+    logging.info(f'Best configuration {best[1]} with avg. r={best[0]:.4f}: {best[2]}')
+    logging.info(f'Wrote {len(rows)} rows to {results_path} after {(time.time()-start_t):.2f}sec.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Resuming interrupted extensions of the embedding cache"""
+import numpy as np
+
+from emb_cache import EmbeddingCache
+
+ITEMS = [[f'item{k}', f'hash{k}'] for k in range(6)]
+
+
+def interrupted(root, row_shape, done=3):
+    """Extend a new store with ITEMS and stop after `done` of them"""
+    cache = EmbeddingCache(str(root), {'encoder': 'test'})
+    out, lens, new_items, _ = cache.extend(ITEMS, row_shape=row_shape)
+    out[:done] = 1.0
+    lens[:done] = 5
+    cache.save_progress(out, lens, done)
+    return cache
+
+
+def test_resume_continues_after_the_written_rows(tmp_path):
+    interrupted(tmp_path, (4,))
+    cache = EmbeddingCache(str(tmp_path), {'encoder': 'test'})
+    out, lens, new_items, done = cache.extend(ITEMS[::-1], row_shape=(4,))
+    assert done == 3
+    assert new_items == ITEMS
+    assert (out[:3] == 1.0).all() and lens[:3].tolist() == [5, 5, 5]
+    out[3:] = 2.0
+    lens[3:] = 7
+    cache.commit(new_items, out, lens)
+    assert cache.lookup(ITEMS) == list(range(6))
+    assert np.load(cache.embs_path).shape == (6, 4)
+
+
+def test_resume_needs_the_same_row_shape(tmp_path):
+    interrupted(tmp_path, (4,))
+    cache = EmbeddingCache(str(tmp_path), {'encoder': 'test'})
+    out, _, _, done = cache.extend(ITEMS, row_shape=(2, 4))
+    assert done == 0 and out.shape == (6, 2, 4)
+
+
+def test_resume_checks_the_files_against_the_journal(tmp_path):
+    cache = interrupted(tmp_path, (4,))
+    # e.g. the .tmp store of another extension that never wrote its journal
+    with open(cache.embs_path + '.tmp', 'wb') as f:
+        np.save(f, np.zeros((6, 3), dtype=np.float32))
+    cache = EmbeddingCache(str(tmp_path), {'encoder': 'test'})
+    out, _, _, done = cache.extend(ITEMS, row_shape=(4,))
+    assert done == 0 and out.shape == (6, 4) and not out.any()
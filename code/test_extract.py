@@ -0,0 +1,115 @@
+"""Embedding extraction driven through `python code/run.py`, with a small randomly initialized BERT"""
+import copy
+import glob
+import json
+import os
+import runpy
+import sys
+
+from easydict import EasyDict as edict
+import numpy as np
+import pytest
+import yaml
+
+from conftest import WORDS
+from extract import tokenize_items
+from models import elmo_inputs
+import run
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+NUM_ITEMS = 24
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    """A small corpus and seed_0 split in the layout run.py expects, as the working directory"""
+    rng = np.random.RandomState(0)
+    items = [f'{1000 + k}:{k % 7}' for k in range(NUM_ITEMS)]
+    (tmp_path / 'corpus_data').mkdir()
+    with open(tmp_path / 'corpus_data' / 'some_database.csv', 'w') as f:
+        f.write("Item\tSentence\n")
+        for it in items:
+            f.write(f"{it}\tsome of {' '.join(rng.choice(WORDS, rng.randint(2, 20)))}.\n")
+    with open(tmp_path / 'corpus_data' / 'swbdext.csv', 'w') as f:
+        f.write("Item_ID\t20-b\n")
+        for it in items:
+            f.write(f"{it}\tspeakera1. {' '.join(rng.choice(WORDS, rng.randint(2, 60)))}.\n")
+    split_path = tmp_path / 'datasets' / 'seed_0'
+    split_path.mkdir(parents=True)
+    for split in ['train', 'test', 'all']:
+        with open(split_path / f'{split}_db.csv', 'w') as f:
+            f.write("Item,StrengthSome,Rating,Partitive,Modification,Subjecthood\n")
+            for it in items:
+                f.write(f"{it},{rng.uniform(1, 7):.2f},{rng.uniform(1, 7):.2f},0,0,0\n")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def write_conf(path, single_sentence, workers):
+    path.write_text(f"""EXPERIMENT_NAME: 'extract'
+IS_ELMO: False
+IS_BERT: True
+BERT_LAYER: 1
+SINGLE_SENTENCE: {single_sentence}
+EMBED_BATCH_SIZE: 4
+EMBED_WORKERS: {workers}
+CROSS_VALIDATION_FLAG: False
+LSTM:
+    FLAG: True
+    SEQ_LEN: 8
+    HIDDEN_DIM: 8
+TRAIN:
+    BATCH_SIZE: 4
+    TOTAL_EPOCH: 1
+    INTERVAL: 1
+""")
+
+
+@pytest.mark.parametrize('single_sentence,workers', [(True, 0), (False, 0), (True, 1)])
+def test_run_main_extracts_with_its_cfg(tiny_bert, corpus, monkeypatch, single_sentence, workers):
+    conf = corpus / 'conf.yml'
+    write_conf(conf, single_sentence, workers)
+    monkeypatch.setattr(sys, 'argv', ['run.py', '--conf', str(conf), '--out_path', './out/'])
+    runpy.run_path(os.path.join(CODE_DIR, 'run.py'), run_name='__main__')
+
+    # the same items, encoded without the extraction pipeline by the imported `run`
+    monkeypatch.setattr(run, 'cfg', copy.deepcopy(run.cfg))
+    run.cfg_setup(str(conf))
+    _, target_utterances, contexts = run.load_dataset(run.cfg.SOME_DATABASE, './datasets/seed_0/train_db.csv',
+                                                      './corpus_data/swbdext.csv', 'rating')
+    items, item_texts = run.item_inputs(target_utterances, contexts, single_sentence)
+    expected, expected_len = run.encode_items(item_texts, single_sentence, run.load_encoder())
+
+    (cache_dir,) = [os.path.dirname(p) for p in glob.glob('./datasets/cache/*/index.json')]
+    with open(os.path.join(cache_dir, 'index.json')) as f:
+        rows = {tuple(it): row for row, it in enumerate(json.load(f))}
+    rows = [rows[tuple(it)] for it in items]
+    embs = np.load(os.path.join(cache_dir, 'embs.npy'))[rows]
+    assert embs.shape == (NUM_ITEMS, run.encoder_seq_len(single_sentence), 768)
+    np.testing.assert_allclose(embs, np.asarray(expected), atol=1e-5)
+    assert np.load(os.path.join(cache_dir, 'len.npy'))[rows].tolist() == list(expected_len)
+
+
+def test_load_split_with_its_own_cfg(tiny_bert, corpus, monkeypatch):
+    conf = corpus / 'conf.yml'
+    write_conf(conf, True, 0)
+    monkeypatch.setattr(run, 'cfg', copy.deepcopy(run.cfg))
+    defaults = copy.deepcopy(run.cfg)
+    split_cfg = copy.deepcopy(run.cfg)
+    run.merge_yaml(edict(yaml.load(conf.read_text(), Loader=yaml.FullLoader)), split_cfg)
+
+    labels, sen_len, store = run.load_split('train', './datasets', cfg=split_cfg)
+    assert run.cfg == defaults
+    embs = np.load(store[0], mmap_mode='r')[store[2]]
+    assert len(labels) == len(sen_len) == NUM_ITEMS
+    assert embs.shape == (NUM_ITEMS, run.encoder_seq_len(True, split_cfg), 768)
+
+
+def test_qualitative_items_use_the_encoder_of_the_cfg():
+    qual_cfg = copy.deepcopy(run.cfg)
+    qual_cfg.MODE = 'qual'
+    qual_cfg.IS_BERT = False
+    qual_cfg.IS_ELMO = True
+    # an ELMo model is given no BERT tokenizer
+    inputs = tokenize_items(qual_cfg, [['Some of the cats were chasing a mouse.']], True, edict())
+    assert inputs == [elmo_inputs('Some of the cats were chasing a mouse.')]
@@ -0,0 +1,102 @@
+"""preprocess_utterance against a frozen copy of its original implementation"""
+import os
+import random
+import re
+
+import pandas as pd
+import pytest
+
+from models import preprocess_utterance, preprocess_utterances
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FLAGS = [(split_off_clitics, max_utterances) for split_off_clitics in (True, False)
+         for max_utterances in (None, 0, 1, 2, 3, 5)]
+
+
+def old_split_by_whitespace(sentence):
+    words = []
+    for space_separated_fragment in sentence.strip('.').strip().split():
+        words.extend(re.split(" ", space_separated_fragment))
+    return [w for w in words if w]
+
+
+def old_preprocess_utterance(s, split_off_clitics=True,max_utterances=None):
+  if split_off_clitics:
+    s = s.replace('\'ve', ' \'ve')
+    s = s.replace('\'re', ' \'re')
+    s = s.replace('\'ll', ' \'ll')
+    s = s.replace('n\'t', ' n\'t')
+    s = s.replace('\'d', ' \'d')
+    s = s.replace('-', ' ')
+    s = s.replace('\'s', ' \'s')
+  modified_s = re.sub('#', '.', s).strip('.').split('.')
+  modified_s = list(filter(None, modified_s))
+  if max_utterances and max_utterances < len(modified_s):
+    modified_s = modified_s[-max_utterances]
+  raw_tokens = []
+  for s in modified_s:
+      s = re.sub(r'speaker[0-9a-z\-\*]*[0-9]', '', s)
+      s = re.sub(r'[^a-zA-Z0-9- \n\.]', '', s)
+      s = re.sub('n[0-9][0-9a-z]{4,5}', '', s)
+      s = re.sub('[0-9]t[0-9]+', '', s)
+      s = s.replace(' oclock ', ' o\'clock ')
+      s = s.replace(' ve ', ' \'ve ')
+      s = s.replace(' re ', ' \'re ')
+      s = s.replace(' ll ', ' \'ll ')
+      s = s.replace(' nt ', ' n\'t ')
+      s = s.replace(' d ', ' \'d ')
+      s = s.replace(' s ', ' \'s ')
+      s = s.replace('doeuvres', 'd\'oeuvres')
+      s = s.replace('mumblex', 'mumble')
+      raw_tokens += old_split_by_whitespace(s)
+
+  return raw_tokens
+
+
+def corpus_lines():
+    """The qualitative sentences, and the Switchboard utterances and contexts if the corpus is there"""
+    with open(os.path.join(REPO_DIR, 'datasets', 'qualitative.txt')) as f:
+        lines = [x.strip() for x in f]
+    corpus_path = os.path.join(REPO_DIR, 'corpus_data')
+    if os.path.isfile(os.path.join(corpus_path, 'some_database.csv')):
+        lines += pd.read_csv(os.path.join(corpus_path, 'some_database.csv'), sep='\t')['Sentence'].tolist()
+    if os.path.isfile(os.path.join(corpus_path, 'swbdext.csv')):
+        lines += pd.read_csv(os.path.join(corpus_path, 'swbdext.csv'), sep='\t')['20-b'].tolist()
+    return [s for s in lines if isinstance(s, str)]
+
+
+# pieces that exercise every rule: clitics, utterance breaks, speaker tags, noise codes, rewrites
+FRAGMENTS = ["some", "of", "them", "don't", "we've", "you're", "they'll", "i'd", "it's", "he's",
+             "n't", "'s", "'d", "'ve", "-", "--", "well-known", "#", ".", "..", "#.", " ", "  ", "\n", "\t",
+             "speakera1", "speakerb23", "speaker*-x9", "speaker", "n1abcd", "n12bcde", "n3ab", "4t56", "t7",
+             "oclock", "ve", "re", "ll", "nt", "d", "s", "doeuvres", "mumblex", "[laughter]", "{f uh}",
+             "/", ",", "?", "!", "'", "\"", "0", "42", "A", "Some", "é", "_"]
+
+
+def random_texts(n, seed=0):
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(n):
+        parts = [rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 25))]
+        texts.append("".join(p + rng.choice(["", " ", " ", "."]) for p in parts))
+    return texts
+
+
+@pytest.mark.parametrize('split_off_clitics,max_utterances', FLAGS)
+def test_corpus_lines(split_off_clitics, max_utterances):
+    for s in corpus_lines():
+        assert preprocess_utterance(s, split_off_clitics, max_utterances) == \
+            old_preprocess_utterance(s, split_off_clitics, max_utterances), s
+
+
+@pytest.mark.parametrize('split_off_clitics,max_utterances', FLAGS)
+def test_random_texts(split_off_clitics, max_utterances):
+    texts = random_texts(5000, seed=FLAGS.index((split_off_clitics, max_utterances)))
+    expected = [old_preprocess_utterance(s, split_off_clitics, max_utterances) for s in texts]
+    assert preprocess_utterances(texts, split_off_clitics, max_utterances) == expected
+    # memoized results come back unchanged, and as fresh lists
+    again = preprocess_utterances(texts, split_off_clitics, max_utterances)
+    assert again == expected
+    if again:
+        again[0].append('x')
+        assert preprocess_utterance(texts[0], split_off_clitics, max_utterances) == expected[0]
@@ -0,0 +1,101 @@
+"""Reading and resuming the inputs and outputs of score.py"""
+import csv
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import WORDS
+from models import RatingModel
+import score
+from score import cfg, read_chunks, CSVWriter, ParquetWriter
+from utils import save_model
+
+
+def has_parquet_engine():
+    try:
+        pd.io.parquet.get_engine('auto')
+    except ImportError:
+        return False
+    return True
+
+
+@pytest.fixture
+def multiline_csv(tmp_path):
+    path = tmp_path / 'utterances.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Item', 'Sentence', 'Context'])
+        for k in range(11):
+            # every other record has quoted fields that span lines
+            sentence = f'some of them, {k}' if k % 2 else f'some\nof the cats\n{k}'
+            writer.writerow([f'item{k}', sentence, f'context "{k}"\nline two'])
+    return str(path)
+
+
+@pytest.mark.parametrize('skip', [0, 3, 4, 8, 11])
+def test_resume_skips_records(multiline_csv, skip):
+    full = [(i, texts) for ids, item_texts in read_chunks(multiline_csv, 4, context_col='Context')
+            for i, texts in zip(ids, item_texts)]
+    assert [i for i, _ in full] == list(range(11))
+    resumed = [(i, texts) for ids, item_texts in read_chunks(multiline_csv, 4, skip, context_col='Context')
+               for i, texts in zip(ids, item_texts)]
+    assert resumed == full[skip:]
+    with_ids = [i for ids, _ in read_chunks(multiline_csv, 4, skip, id_col='Item') for i in ids]
+    assert with_ids == [f'item{k}' for k in range(skip, 11)]
+
+
+def test_resume_needs_the_output(tmp_path):
+    path = str(tmp_path / 'scores.csv')
+    assert not CSVWriter.resumable(path, {'bytes': 10})
+    with open(path, 'w') as f:
+        f.write('Item,Sentence,predicted\n')
+    assert CSVWriter.resumable(path, {'bytes': 10})
+    assert not CSVWriter.resumable(path, {'bytes': 100})
+
+
+@pytest.mark.skipif(not has_parquet_engine(), reason='needs pyarrow or fastparquet')
+def test_parquet_resume_drops_the_unsaved_parts(tmp_path):
+    path = str(tmp_path / 'scores')
+    writer = ParquetWriter(path, None)
+    for k in range(3):
+        writer.write([2 * k, 2 * k + 1], [[f'some {2 * k}', ''], [f'some {2 * k + 1}', '']],
+                     np.array([k, k + 0.5]))
+        if k == 1:
+            # the progress saved after the second chunk; the third part comes after it
+            progress = writer.state()
+    writer.close()
+    assert progress == {'parts': 2} and ParquetWriter.resumable(path, progress)
+
+    writer = ParquetWriter(path, progress)
+    assert sorted(os.listdir(path)) == ['part-000000.parquet', 'part-000001.parquet']
+    writer.write([4, 5], [['some 4', ''], ['some 5', '']], np.array([2., 2.5]))
+    df = pd.concat([pd.read_parquet(os.path.join(path, part)) for part in sorted(os.listdir(path))])
+    assert df['Item'].tolist() == list(range(6))
+    assert df['predicted'].tolist() == [0., 0.5, 1., 1.5, 2., 2.5]
+    assert not ParquetWriter.resumable(path, {'parts': 4})
+
+
+def test_the_same_input_gets_the_same_scores(tiny_bert, tmp_path, monkeypatch):
+    # an LSTM trained from random initial states, the default
+    settings = [(cfg, {'IS_ELMO': False, 'IS_BERT': True, 'BERT_LAYER': 1, 'RESUME_DIR': ''}),
+                (cfg.LSTM, {'FLAG': True, 'ATTN': True, 'SEQ_LEN': 8, 'HIDDEN_DIM': 8, 'INIT_STATE': 'random'}),
+                (cfg.TRAIN, {'FLAG': True})]
+    for section, values in settings:
+        for key, value in values.items():
+            monkeypatch.setattr(section, key, value)
+    model = RatingModel(cfg, str(tmp_path))
+    model.load_network()
+    save_model(model.RNet, 1, model.model_dir)
+
+    sentences = [f'some of {" ".join(WORDS[k:k + 2 + k % 4])}.' for k in range(5)]
+    (tmp_path / 'utterances.txt').write_text('\n'.join(sentences * 2) + '\n')
+    # the second copy of every sentence is in another chunk, at another position in its batch
+    monkeypatch.setattr(sys, 'argv', ['score.py', '--input', str(tmp_path / 'utterances.txt'),
+                                      '--output', str(tmp_path / 'scores.csv'), '--chunk_size', '3',
+                                      '--checkpoint', str(tmp_path / 'Model' / 'RNet_epoch_1.pth')])
+    score.main()
+    preds = pd.read_csv(tmp_path / 'scores.csv')['predicted'].tolist()
+    assert len(preds) == 10 and preds[:5] == preds[5:]
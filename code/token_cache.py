@@ -0,0 +1,168 @@
+"""Persistent BERT tokenizations shared by the extraction and the analysis scripts
+
+Usage: python ./code/token_cache.py --input=./datasets/qualitative.txt [--bert_model=bert-large-uncased]
+
+Tokenizes the [CLS] sentence [SEP] text of every line of --input that is
+not cached yet, so that later runs only look the token ids up.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+# no torch here, the analysis scripts only need numpy
+import numpy as np
+
+# where run.py (with the default --data_path) and the scripts keep the token caches
+TOKEN_CACHE_ROOT = './datasets/cache/tokens'
+
+# bump when what is cached for a text changes
+TOKEN_CACHE_VERSION = 1
+
+
+def text_hash(text):
+    """Return the sha1 hex digest of a text"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def bert_text(s):
+    """The text BERT tokenizes for a single sentence"""
+    return "[CLS] " + s + " [SEP]"
+
+
+class TokenCache(object):
+    """Token ids of texts for one BERT vocabulary, stored in `tokens.npz`
+
+    Texts are identified by their hash. Next to the token ids (concatenated,
+    with `offsets` giving where each text starts) the store keeps the position
+    of the first "some" token of every text (-1 if there is none) and the
+    positions of all its "of" tokens. Texts that are not stored yet are
+    tokenized on lookup and written by `save`; only one process should save a
+    given cache at a time.
+
+    `token_ids` and `sep_token_id` make it a drop-in tokenizer for
+    `models.bert_inputs` and `models.bert_context_inputs`.
+    """
+
+    def __init__(self, root, bert_model, bert_tokenizer=None):
+        """Positional arguments:
+        root -- directory that holds the token caches
+        bert_model -- name of the pre-trained tokenizer
+
+        Keyword arguments:
+        bert_tokenizer -- the tokenizer, loaded on the first cache miss if None
+        """
+        self.bert_model = bert_model
+        self._tokenizer = bert_tokenizer
+        key_fields = {'tokenizer': bert_model, 'version': TOKEN_CACHE_VERSION}
+        self.cache_dir = os.path.join(root, text_hash(json.dumps(key_fields, sort_keys=True))[:16])
+        self.path = os.path.join(self.cache_dir, 'tokens.npz')
+        # text hash -> token ids, in the order they were added
+        self.entries = {}
+        self.num_saved = 0
+        # what `arrays` returns, while no text is added
+        self._arrays = None
+        if os.path.isfile(self.path):
+            with np.load(self.path) as store:
+                self._arrays = {name: store[name] for name in store.files if name != 'hashes'}
+                hashes = store['hashes'].tolist()
+            ids, offsets = self._arrays['ids'], self._arrays['offsets']
+            for k, h in enumerate(hashes):
+                self.entries[h] = ids[offsets[k]:offsets[k + 1]].tolist()
+            self.num_saved = len(self.entries)
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from transformers import BertTokenizer
+            self._tokenizer = BertTokenizer.from_pretrained(self.bert_model)
+        return self._tokenizer
+
+    @property
+    def sep_token_id(self):
+        return self.tokenizer.sep_token_id
+
+    def token_ids(self, text):
+        """Token ids of `text`, tokenized and added to the cache if it is not there"""
+        h = text_hash(text)
+        ids = self.entries.get(h)
+        if ids is None:
+            ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(text))
+            self.entries[h] = ids
+            self._arrays = None
+        return ids
+
+    def new_entries(self, start):
+        """(hash, token ids) of the entries added after the first `start` ones"""
+        return list(self.entries.items())[start:]
+
+    def update(self, entries):
+        """Add (hash, token ids) entries, e.g. the `new_entries` of a worker's copy"""
+        for h, ids in entries:
+            if h not in self.entries:
+                self.entries[h] = ids
+                self._arrays = None
+
+    def rows(self, texts):
+        """Look up (and tokenize, if needed) `texts`, return their rows in `arrays()`"""
+        for text in texts:
+            self.token_ids(text)
+        position = {h: row for row, h in enumerate(self.entries)}
+        return np.array([position[text_hash(text)] for text in texts], dtype=np.int64)
+
+    def arrays(self):
+        """The cache as arrays: token ids, offsets, position of "some", and "of" positions with offsets"""
+        if self._arrays is not None:
+            return self._arrays
+        lengths = np.array([len(ids) for ids in self.entries.values()], dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = np.fromiter((i for ids in self.entries.values() for i in ids), dtype=np.int32,
+                          count=offsets[-1])
+        # text and position within the text of every token
+        text_of = np.repeat(np.arange(len(lengths)), lengths)
+        pos = np.arange(len(ids)) - offsets[text_of]
+        some_id, of_id = self.tokenizer.convert_tokens_to_ids(['some', 'of'])
+        some_pos = np.full(len(lengths), -1, dtype=np.int32)
+        hits = np.flatnonzero(ids == some_id)
+        texts, first = np.unique(text_of[hits], return_index=True)
+        some_pos[texts] = pos[hits[first]]
+        hits = np.flatnonzero(ids == of_id)
+        of_pos = pos[hits].astype(np.int32)
+        of_offsets = np.searchsorted(text_of[hits], np.arange(len(lengths) + 1))
+        self._arrays = {'ids': ids, 'offsets': offsets, 'some_pos': some_pos,
+                        'of_pos': of_pos, 'of_offsets': of_offsets}
+        return self._arrays
+
+    def save(self):
+        """Write the cache if texts were added since it was loaded"""
+        if len(self.entries) == self.num_saved:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        hashes = np.array(list(self.entries), dtype='U40')
+        with open(self.path + '.tmp', 'wb') as f:
+            np.savez(f, hashes=hashes, **self.arrays())
+        os.replace(self.path + '.tmp', self.path)
+        logging.info(f'Saved the tokens of {len(self.entries) - self.num_saved} new texts to {self.path}.')
+        self.num_saved = len(self.entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tokenize a sentence file into the token cache')
+    parser.add_argument('--input', dest='input', required=True, help='file with one sentence per line')
+    parser.add_argument('--bert_model', dest='bert_model', default='bert-large-uncased')
+    parser.add_argument('--cache_root', dest='cache_root', default=TOKEN_CACHE_ROOT)
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(opt.input, 'r') as f:
+        sentences = [x.strip() for x in f.readlines()]
+    token_cache = TokenCache(opt.cache_root, opt.bert_model)
+    token_cache.rows([bert_text(s) for s in sentences])
+    token_cache.save()
+    logging.info(f'{len(token_cache.entries)} texts in {token_cache.path}.')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import os
 import errno
+import json
 from copy import deepcopy
+import queue
 import string
+import threading
+import time
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from torch.nn import init
@@ -52,3 +55,209 @@ def save_model(RNet, epoch, model_dir):
         '%s/RNet_epoch_%d.pth' % (model_dir, epoch)
     )
     print(f'Save model to {model_dir}')
+
+
+def save_manifest(path, manifest):
+    """Write a metrics manifest (JSON), replacing the previous one atomically"""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def top_epochs(epochs, k):
+    """Return the `k` entries of a manifest's per-epoch metrics with the highest val_r"""
+    ranked = [e for e in epochs if e.get('val_r') is not None and not np.isnan(e['val_r'])]
+    ranked.sort(key=lambda e: e['val_r'], reverse=True)
+    return ranked[:k]
+
+
+class RowSubset(object):
+    """Lazy view on some rows of an array, e.g. one split or fold of a
+    memory-mapped embedding cache. Indexing it only reads the requested rows."""
+
+    def __init__(self, data, idx):
+        if isinstance(data, RowSubset):
+            data, idx = data.data, data.idx[np.asarray(idx)]
+        self.data = data
+        self.idx = np.asarray(idx)
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self, inds):
+        return self.data[self.idx[inds]]
+
+    @property
+    def shape(self):
+        return (len(self.idx),) + tuple(self.data.shape[1:])
+
+
+def to_float_tensor(X):
+    """Convert a batch gathered from the embedding cache (any float dtype) to a FloatTensor"""
+    if torch.is_tensor(X):
+        return X.float()
+    return torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
+
+
+def lengths_tensor(seq_lengths, cuda=False):
+    """The lengths of a batch as an int64 Tensor, copied to the GPU without blocking if `cuda`"""
+    lengths = torch.as_tensor(seq_lengths, dtype=torch.int64)
+    if cuda:
+        lengths = lengths.pin_memory().cuda(non_blocking=True)
+    return lengths
+
+
+class BucketedBatches(object):
+    """Length-bucketed batches of (X, y, lengths), ready to be packed
+
+    The batches of an epoch are laid out up front with one shuffle and one
+    sort: the examples are shuffled (unless `shuffle` is False), grouped into
+    pools of `bucket_batches` batches, sorted by decreasing length inside each
+    pool and cut into batches, whose order is shuffled again. Every batch thus
+    comes out sorted by length, so packing it needs no permutation, and with
+    `bucket_batches` > 1 batches hold examples of similar length, so less
+    padding is gathered. Each batch is read from X with a single gather,
+    chopped to its longest sequence if `chop` is True and pinned if `pin` is
+    True.
+    """
+
+    def __init__(self, X, y, L, batch_size, shuffle=True, bucket_batches=1, chop=True, pin=False):
+        """Positional arguments:
+        X -- vector representations, anything that supports gathering rows by
+             an index array (array, memmap, `RowSubset`)
+        y -- targets, one row per example, or None
+        L -- number of tokens of each example
+        batch_size -- number of examples per batch
+        """
+        self.X = X
+        self.y = None if y is None else torch.from_numpy(np.asarray(y, dtype=np.float32))
+        self.L = np.asarray(L)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+        self.chop = chop
+        self.pin = pin
+
+    def __len__(self):
+        return (len(self.L) + self.batch_size - 1) // self.batch_size
+
+    def batch_indices(self):
+        """Return the example indices of every batch of one epoch"""
+        num = len(self.L)
+        order = torch.randperm(num).numpy() if self.shuffle else np.arange(num)
+        pool_size = self.batch_size * self.bucket_batches if self.bucket_batches > 0 else num
+        pool = np.arange(num) // pool_size
+        # stable sort by (pool, -length): ties keep the shuffled order
+        order = order[np.lexsort((-self.L[order], pool))]
+        batches = [order[start:start + self.batch_size] for start in range(0, num, self.batch_size)]
+        if self.shuffle and self.bucket_batches != 1:
+            batches = [batches[b] for b in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def __iter__(self):
+        """Yield (inds, X_batch, y_batch, seq_lengths) for every batch"""
+        for inds in self.batch_indices():
+            seq_lengths = self.L[inds]
+            X_batch = self.X[inds]
+            if self.chop:
+                X_batch = X_batch[:, :seq_lengths[0]]
+            X_batch = to_float_tensor(X_batch)
+            if self.pin:
+                X_batch = X_batch.pin_memory()
+            y_batch = None if self.y is None else self.y[inds]
+            yield inds, X_batch, y_batch, seq_lengths.tolist()
+
+
+# marks the end of the stream on a pipeline queue
+_DONE = object()
+
+
+class StageError(object):
+    """Carries the exception of a stage down the pipeline"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class StageStats(object):
+    """Number of items a pipeline stage processed, and the seconds it was busy doing it
+
+    The seconds of a stage with several `workers` add up over the workers.
+    """
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.seconds = 0.
+
+    def add(self, items, seconds):
+        self.items += items
+        self.seconds += seconds
+
+    def __str__(self):
+        rate = self.items * self.workers / self.seconds if self.seconds > 0 else float('inf')
+        workers = f' ({self.workers} workers)' if self.workers > 1 else ''
+        return f'{self.name}{workers}: {self.items} items in {self.seconds:.2f}sec, {rate:.1f} items/sec'
+
+
+def run_stage(fn, inputs, outputs, stats):
+    """Put `fn(chunk)` on `outputs` for every chunk on `inputs`, in order"""
+    try:
+        while True:
+            chunk = inputs.get()
+            if chunk is _DONE or isinstance(chunk, StageError):
+                outputs.put(chunk)
+                return
+            start = time.perf_counter()
+            result = fn(chunk)
+            stats.add(len(result[0]), time.perf_counter() - start)
+            outputs.put(result)
+    except Exception as e:
+        outputs.put(StageError(e))
+
+
+def feed(chunks, outputs):
+    """Put every chunk of the iterator `chunks` on `outputs`"""
+    try:
+        for chunk in chunks:
+            outputs.put(chunk)
+        outputs.put(_DONE)
+    except Exception as e:
+        outputs.put(StageError(e))
+
+
+def pipeline(chunks, stages, depth=2, stats=None):
+    """Run `chunks` through `stages`, one thread per stage, and yield the results in order
+
+    Positional arguments:
+    chunks -- iterator of tuples whose first element lists the items of the chunk
+    stages -- list of (name, fn), every fn maps a chunk to the chunk of the next stage
+
+    Keyword arguments:
+    depth -- number of chunks every queue between two stages holds at most
+    stats -- list that gets the `StageStats` of every stage, which are only
+             busy time, so the slowest stage is the one with the lowest rate
+    """
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=feed, args=(chunks, queues[0]), daemon=True)]
+    for i, (name, fn) in enumerate(stages):
+        stage_stats = StageStats(name)
+        if stats is not None:
+            stats.append(stage_stats)
+        threads.append(threading.Thread(target=run_stage, args=(fn, queues[i], queues[i + 1], stage_stats),
+                                        daemon=True))
+    for thread in threads:
+        thread.start()
+    while True:
+        result = queues[-1].get()
+        if result is _DONE:
+            return
+        if isinstance(result, StageError):
+            raise result.error
+        yield result
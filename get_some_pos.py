@@ -1,23 +1,20 @@
 import os
-from tqdm import tqdm
-from transformers import BertTokenizer
+import sys
 
-
-bert_model = 'bert-large-uncased'
-bert_tokenizer = BertTokenizer.from_pretrained(bert_model)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code'))
+from token_cache import TokenCache, TOKEN_CACHE_ROOT, bert_text
 
 
-def bert_some_pos(s, bert_tokenizer):
-    s = "[CLS] " + s + " [SEP]"
-    tokenized_text = bert_tokenizer.tokenize(s)
-    return tokenized_text.index("some")
+bert_model = 'bert-large-uncased'
+# the tokenizer is only loaded for sentences that are not in the token cache
+token_cache = TokenCache(TOKEN_CACHE_ROOT, bert_model)
 
 
 load_db = "./datasets/qualitative.txt"
 with open(load_db, "r") as qual_file:
     sentences = [x.strip() for x in qual_file.readlines()]
-output = []
-for s in tqdm(sentences, total=len(sentences)):
-    output.append(bert_some_pos(s, bert_tokenizer))
+rows = token_cache.rows([bert_text(s) for s in sentences])
+token_cache.save()
+# position of the first "some" of each sentence, -1 if there is none
+output = token_cache.arrays()['some_pos'][rows].tolist()
 print(output)
-    
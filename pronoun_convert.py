@@ -1,50 +1,265 @@
+"""Partitive "some of" filters and NP/pronoun rewrites of sentence files
+
+Usage: python pronoun_convert.py [filter_of|np_to_pronoun|pronoun_to_np] [--input=./qualitative_results]
+
+The --input is a file name without its .txt extension. filter_of keeps the
+sentences with "some of" followed by a pronoun (BERT tokens, from the token
+cache). np_to_pronoun rewrites "some of the cats" as "some of them", and
+pronoun_to_np rewrites "some of them" as "some of the ones", and write the
+sentences they changed to a CSV file. All three stream the input in chunks.
+"""
+import argparse
+import csv
+import itertools
 import os
 import re
+import sys
 import numpy as np
-from tqdm import tqdm
-from transformers import BertTokenizer
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code'))
+from token_cache import TokenCache, TOKEN_CACHE_ROOT, bert_text
 
 
 bert_model = 'bert-large-uncased'
-bert_tokenizer = BertTokenizer.from_pretrained(bert_model)
+# the tokenizer is only loaded for sentences that are not in the token cache
+token_cache = TokenCache(TOKEN_CACHE_ROOT, bert_model)
 
 
 candidates = ["these", "those", "this", "that", "them", "it", "him", "her", "its"]
 
+# determiners that start the NP of a partitive
+determiners = ["the", "these", "those", "my", "your", "his", "her", "its", "our", "their"]
+# words that end the NP after its determiner: punctuation is added by `word_classes`
+boundaries = ["that", "who", "which", "whom", "whose", "and", "or", "but",
+              "at", "in", "on", "with", "from", "for", "to", "by", "about", "of", "into", "over",
+              "is", "are", "was", "were", "be", "been", "being", "has", "have", "had",
+              "do", "does", "did", "will", "would", "can", "could", "should", "may", "might", "must",
+              "i", "you", "he", "she", "we", "they", "it", "them"] + determiners
+irregular_plurals = ["people", "children", "men", "women", "police", "mice", "feet", "teeth", "geese"]
+# at most this many words between the determiner and the end of the NP
+MAX_NP_WORDS = 3
+
+# NP that replaces each pronoun after "some of"
+pronoun_nps = {"them": "the ones", "these": "these ones", "those": "those ones",
+               "it": "the thing", "this": "this thing", "that": "that thing"}
+
+# words and punctuation, plus the whitespace between them
+TOKEN_RE = re.compile(r"\n|[^\S\n]+|\w+(?:'\w+)?|[^\w\s]")
+SOME_OF_RE = re.compile(r"\bsome\s+of\b", re.IGNORECASE)
+
+
+def bert_tokens(texts):
+    """Token ids of `texts` from the token cache, concatenated, and where each text starts"""
+    token_ids = [token_cache.token_ids(text) for text in texts]
+    offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in token_ids], out=offsets[1:])
+    ids = np.fromiter(itertools.chain.from_iterable(token_ids), dtype=np.int64, count=offsets[-1])
+    return ids, offsets
+
+
+def bert_of_pos(ids, offsets):
+    """Text and position of every "of" token in the first 30 tokens of the texts, see `bert_tokens`
+
+    Return: texts, positions, and the index of each token in `ids`
+    """
+    of_id = token_cache.tokenizer.convert_tokens_to_ids("of")
+    of_index = np.flatnonzero(ids == of_id)
+    of_texts = np.searchsorted(offsets, of_index, side='right') - 1
+    of_pos = of_index - offsets[of_texts]
+    keep = (of_pos > 1) & (of_pos < 29)
+    return of_texts[keep], of_pos[keep], of_index[keep]
+
+
+def read_chunks(filename, chunk_size):
+    """Yield the (stripped) lines of `filename` in lists of at most `chunk_size`"""
+    with open(filename, "r") as f:
+        lines = (x.strip() for x in f)
+        for chunk in iter(lambda: list(itertools.islice(lines, chunk_size)), []):
+            yield chunk
+
+
+def word_arrays(sentences):
+    """Split sentences into words, all sentences at once
+
+    Return:
+    vocab -- sorted lowercased words of the chunk
+    word_ids -- index in `vocab` of every word, all sentences concatenated
+    rows -- sentence of every word
+    starts, ends -- character span of every word in its sentence
+    """
+    # the tokens cover the whole text, so their offsets add up; newlines end the sentences
+    tokens = TOKEN_RE.findall("\n".join(sentences))
+    lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+    ends = np.cumsum(lengths)
+    codes, uniques = pd.factorize(pd.Series(tokens, dtype=object))
+    vocab, lower_ids = np.unique(np.array([w.lower() for w in uniques], dtype=str), return_inverse=True)
+    token_ids = lower_ids.reshape(-1)[codes]
+    newline = np.isin(token_ids, np.flatnonzero(vocab == "\n"))
+    space = np.isin(token_ids, np.flatnonzero(np.char.isspace(vocab))) if len(vocab) else newline
+    rows = np.cumsum(newline)
+    sentence_starts = np.cumsum([0] + [len(s) + 1 for s in sentences])
+    word = ~space
+    ends = ends[word] - sentence_starts[rows[word]]
+    return vocab, token_ids[word], rows[word], ends - lengths[word], ends
+
+
+def word_classes(vocab):
+    """Boolean tables over `vocab` for the word classes of the rewrites"""
+    punctuation = np.array([not w[0].isalnum() for w in vocab], dtype=bool)
+    return {'some': vocab == "some",
+            'of': vocab == "of",
+            'determiner': np.isin(vocab, determiners),
+            'boundary': np.isin(vocab, boundaries) | punctuation,
+            'past': np.char.endswith(vocab, "ed") if len(vocab) else np.zeros(0, dtype=bool),
+            'plural': (np.isin(vocab, irregular_plurals)
+                       | (np.char.endswith(vocab, "s") & ~np.char.endswith(vocab, "ss")
+                          & ~np.char.endswith(vocab, "us") & ~np.char.endswith(vocab, "is"))
+                       if len(vocab) else np.zeros(0, dtype=bool)),
+            'pronoun': np.isin(vocab, list(pronoun_nps)),
+            'demonstrative': np.isin(vocab, ["these", "those", "this", "that"]),
+            'relativizer': np.isin(vocab, ["that", "who", "which", "whom", "whose"])}
+
+
+def some_of(word_ids, rows, classes, next_class):
+    """Index of every "some" that is followed by "of" and a word of `next_class` in the same sentence"""
+    n = len(word_ids)
+    i = np.flatnonzero(classes['some'][word_ids[:max(n - 2, 0)]])
+    i = i[classes['of'][word_ids[i + 1]] & classes[next_class][word_ids[i + 2]] & (rows[i + 2] == rows[i])]
+    return i
+
+
+def np_spans(word_ids, rows, classes):
+    """Find the "some of" + determiner + NP spans, see `np_to_pronoun`
+
+    The NP runs from the determiner up to MAX_NP_WORDS words that are not
+    boundaries (nor past tense forms after the first one). Its head is the
+    last of the first plural-looking words, or else the last word of the
+    run. NPs with a relative clause are left out.
+
+    Return: index of the determiner, index of the head, whether it is plural
+    """
+    i = some_of(word_ids, rows, classes, 'determiner')
+    det = i + 2
+    running = np.ones(len(det), dtype=bool)
+    head = np.full(len(det), -1, dtype=np.int64)
+    plural = np.zeros(len(det), dtype=bool)
+    for k in range(MAX_NP_WORDS):
+        j = det + 1 + k
+        inside = j < len(word_ids)
+        j = np.where(inside, j, 0)
+        w = word_ids[j]
+        running &= inside & (rows[j] == rows[det]) & ~classes['boundary'][w]
+        if k > 0:
+            running &= ~classes['past'][w]
+        # after a plural word, the NP only goes on with more of them ("sales representatives")
+        running &= ~plural | classes['plural'][w]
+        head[running] = j[running]
+        plural |= running & classes['plural'][w]
+    # a relative clause cannot modify a pronoun
+    after = np.minimum(head + 1, len(word_ids) - 1)
+    relative = (head >= 0) & (head + 1 < len(word_ids)) & (rows[after] == rows[det]) \
+        & classes['relativizer'][word_ids[after]]
+    found = (head >= 0) & ~relative
+    return det[found], head[found], plural[found]
+
+
+def rewrite(sentences, rows, starts, ends, replacements):
+    """Replace the character spans [starts, ends) of the sentences at `rows` by `replacements`
+
+    Return: (row, rewritten sentence) of every sentence with a replacement
+    """
+    changed = []
+    order = np.lexsort((-starts, rows))
+    for row, group in itertools.groupby(order.tolist(), key=lambda k: rows[k]):
+        s = sentences[row]
+        # from the end, so the earlier spans stay valid
+        for k in group:
+            s = s[:starts[k]] + replacements[k] + s[ends[k]:]
+        changed.append((row, s))
+    return changed
+
+
+def convert(filename, suffix, convert_chunk, chunk_size=10000):
+    """Stream `filename`.txt through `convert_chunk` and write the changed sentences
+
+    Writes `filename``suffix`.csv with the line number (from 0), the sentence
+    and its rewrite, and returns the number of rewritten sentences.
+    """
+    num_changed = 0
+    line = 0
+    with open(filename + suffix + ".csv", "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'Sentence', 'Converted'])
+        for sentences in read_chunks(filename + ".txt", chunk_size):
+            # only sentences with "some of" are split into words
+            partitive = [row for (row, s) in enumerate(sentences) if SOME_OF_RE.search(s)]
+            changed = convert_chunk([sentences[row] for row in partitive])
+            writer.writerows((line + partitive[row], sentences[partitive[row]], s) for (row, s) in changed)
+            num_changed += len(changed)
+            line += len(sentences)
+    print(f'Rewrote {num_changed} of {line} sentences into {filename + suffix}.csv')
+    return num_changed
+
+
+def np_to_pronoun_chunk(sentences):
+    vocab, word_ids, rows, starts, ends = word_arrays(sentences)
+    det, head, plural = np_spans(word_ids, rows, word_classes(vocab))
+    replacements = np.where(plural, "them", "it")
+    return rewrite(sentences, rows[det], starts[det], ends[head], replacements.tolist())
+
 
-def bert_of_pos(s, bert_tokenizer):
-    s = "[CLS] " + s + " [SEP]"
-    tokenized_text = bert_tokenizer.tokenize(s)
-    ids = [i for i, d in enumerate(tokenized_text) if d == 'of' and i > 1 and i < 29]
-    return ids, tokenized_text
+def pronoun_to_np_chunk(sentences):
+    vocab, word_ids, rows, starts, ends = word_arrays(sentences)
+    classes = word_classes(vocab)
+    pronoun = some_of(word_ids, rows, classes, 'pronoun') + 2
+    # "some of these cats" has a determiner, not a pronoun
+    after = np.minimum(pronoun + 1, len(word_ids) - 1)
+    alone = ((pronoun + 1 >= len(word_ids)) | (rows[after] != rows[pronoun])
+             | classes['boundary'][word_ids[after]] | classes['past'][word_ids[after]])
+    pronoun = pronoun[alone | ~classes['demonstrative'][word_ids[pronoun]]]
+    replacements = [pronoun_nps[w] for w in vocab[word_ids[pronoun]].tolist()]
+    return rewrite(sentences, rows[pronoun], starts[pronoun], ends[pronoun], replacements)
 
 
 # for articial sentences
-def np_to_pronoun(filename):
-    return
+def np_to_pronoun(filename, chunk_size=10000):
+    return convert(filename, "_pronoun", np_to_pronoun_chunk, chunk_size)
 
 
 # for natural sentences
-def pronoun_to_np(filename):
-    return
+def pronoun_to_np(filename, chunk_size=10000):
+    return convert(filename, "_np", pronoun_to_np_chunk, chunk_size)
 
 
-def filter_of(filename):
-    with open(filename + ".txt", "r") as f:
-        sentences = [x.strip() for x in f.readlines()]
+def filter_of(filename, chunk_size=10000):
+    """Write the sentences of `filename`.txt with "some of" + pronoun to `filename`_partitive_compare.txt
 
+    The input is read in chunks of `chunk_size` sentences. Returns the number of sentences kept.
+    """
+    some_id = token_cache.tokenizer.convert_tokens_to_ids("some")
+    vocab = token_cache.tokenizer.vocab
+    candidate_ids = [vocab[c] for c in candidates if c in vocab]
+    num_kept = 0
     with open(filename + "_partitive_compare.txt", "w") as nf:
-        for s in tqdm(sentences, total=len(sentences)):
-            curr_ids, tokenized = bert_of_pos(s, bert_tokenizer)
-            flag = False
-            if len(curr_ids) > 0:
-                for look_up_index in curr_ids:
-                    if tokenized[look_up_index-1] == "some":
-                        if tokenized[look_up_index+1] in candidates:
-                            flag = True
-                if flag:
-                    nf.write(s+"\n")
+        for sentences in read_chunks(filename + ".txt", chunk_size):
+            # "some" + "of" + candidate, over all "of" tokens of the chunk at once
+            ids, offsets = bert_tokens([bert_text(s) for s in sentences])
+            of_texts, _, of_index = bert_of_pos(ids, offsets)
+            match = (ids[of_index - 1] == some_id) & \
+                np.isin(ids[np.minimum(of_index + 1, len(ids) - 1)], candidate_ids)
+            kept = np.unique(of_texts[match])
+            nf.writelines(sentences[row] + "\n" for row in kept)
+            num_kept += len(kept)
+    token_cache.save()
+    return num_kept
 
 
 if __name__ == "__main__":
-    filter_of("./qualitative_results")
+    parser = argparse.ArgumentParser(description='Filter or rewrite "some of" partitives')
+    parser.add_argument('command', nargs='?', default='filter_of',
+                        choices=['filter_of', 'np_to_pronoun', 'pronoun_to_np'])
+    parser.add_argument('--input', dest='input', default='./qualitative_results',
+                        help='sentence file without its .txt extension')
+    opt = parser.parse_args()
+    globals()[opt.command](opt.input)